@@ -15,6 +15,23 @@ from plotly.subplots import make_subplots
 import random
 import io
 import math
+import sys
+import json
+import time
+import threading
+import smtplib
+import gzip
+import socketserver
+import http.server
+import mmap
+import asyncio
+import ssl
+import html
+import csv
+import re
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
 # ML Model Imports
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
@@ -30,7 +47,134 @@ import joblib
 DB_PATH = os.path.join(os.path.dirname(__file__), "broadband.db")
 SALT = "broadband_demo_salt"
 MOCK_DATA_CREATED_FLAG = "mock_data_created"
-DB_MIGRATION_FLAG = "db_migrated_v3"
+DB_MIGRATION_FLAG = "db_migrated_v16"
+
+# Outbound notification delivery
+NOTIFICATION_CHANNELS = ("email", "sms")
+NOTIFICATION_OUTBOX_WATERMARK = "notification_outbox_last_id"
+DELIVERY_RATE_LIMITS = {"email": 500.0, "sms": 100.0}  # messages per second, per channel
+DELIVERY_MAX_ATTEMPTS = 5
+DELIVERY_BACKOFF_SECONDS = 30  # doubled after every failed attempt
+DELIVERY_BACKOFF_MAX_SECONDS = 3600
+DELIVERY_LEASE_SECONDS = 300  # 'sending' rows older than this are handed back to the queue
+DELIVERY_SINK_DIR = os.path.join(os.path.dirname(__file__), "outbox")
+
+# Notification retention (days after created_date; None keeps a type forever and types
+# not listed get NOTIFICATION_RETENTION_DEFAULT_DAYS). Expiry reminders go out at most
+# 7 days before expiry, so 21 days after creation is always at least 14 days after the
+# plan expired. Quota notices only concern their own billing period.
+NOTIFICATION_RETENTION_DAYS = {
+    "admin_broadcast": 30,
+    "admin_message": 30,
+    "expiry_reminder": 21,
+    "plan_upgrade": 365,
+    "plan_downgrade": 365,
+    "plan_migration": 365,
+    "subscription_cancelled": 365,
+    "subscription_renewed": 365,
+    "subscription_suspended": 365,
+    "payment_failed": 90,
+    "payment_retry_failed": 90,
+    "payment_recovered": 365,
+    "payment_credit": 365,
+    "quota_warning": 60,
+    "quota_exceeded": 60,
+}
+NOTIFICATION_RETENTION_DEFAULT_DAYS = 365
+DELIVERY_RETENTION_DAYS = 14  # sent/dead outbox rows
+RETENTION_BATCH_SIZE = 2000
+NOTIFICATION_ARCHIVE_DIR = os.path.join(os.path.dirname(__file__), "archive")
+
+# Billing
+GST_RATE = 0.18
+LOYALTY_DISCOUNT_RATE = 0.05  # applied to renewals (renewal_count > 0)
+BILLING_CHUNK_SIZE = 1000
+BILLING_HISTORY_PAGE_SIZE = 20
+PLAN_MIGRATION_CHUNK_SIZE = 1000
+
+# Admin user grid: keyset-paginated; a page never holds more rows than the largest size
+USER_PAGE_SIZES = (25, 50, 100)
+USER_GRID_SORTS = {  # label -> (sort key, descending); each key has a matching index on users
+    'Newest': ("u.id", True),
+    'Name': ("COALESCE(u.name, '')", False),
+    'City': ("COALESCE(u.city, '')", False),
+    'Signup date': ("COALESCE(u.signup_date, '')", True),
+}
+# Bulk user import / export
+USER_IMPORT_COLUMNS = ('username', 'password', 'name', 'email', 'role', 'city', 'state', 'phone', 'address', 'signup_date')
+USER_EXPORT_COLUMNS = ('id', 'username', 'role', 'name', 'email', 'phone', 'address', 'city', 'state', 'signup_date',
+                       'last_login', 'is_autopay_enabled')
+USER_IMPORT_CHUNK_ROWS = 50000  # rows per validation pass and per insert transaction
+
+# Plan catalog: triggers bump this meta counter on every plan write; plan caches reload when it moves
+PLAN_CATALOG_VERSION_KEY = "plan_catalog_version"
+PLAN_IMPORT_COLUMNS = ('name', 'speed_mbps', 'data_limit_gb', 'price', 'validity_days', 'description', 'plan_type',
+                       'is_unlimited', 'features', 'upload_speed_mbps')
+PLAN_IMPORT_REQUIRED = ('name', 'speed_mbps', 'data_limit_gb', 'price', 'validity_days', 'description')
+PLAN_INDEX_REFRESH_SECONDS = 2.0  # how often PlanIndex checks the catalog version
+COMPARISON_CACHE_SIZE = 256  # plan sets whose comparison metrics stay in memory
+# All Plans filters as inclusive (low, high) ranges for PlanIndex; nextafter makes a bound strict
+PLAN_PRICE_FILTERS = {
+    "Under ₹500": (None, np.nextafter(500, 0)),
+    "₹500-₹1000": (500, 1000),
+    "Above ₹1000": (np.nextafter(1000, np.inf), None),
+}
+PLAN_SPEED_FILTERS = {
+    "Up to 100 Mbps": (None, 100),
+    "100-500 Mbps": (np.nextafter(100, np.inf), 500),
+    "500+ Mbps": (np.nextafter(500, np.inf), None),
+}
+
+# Support tickets: status buckets for the Support tabs (unlisted statuses count as ongoing)
+TICKET_STATUS_CLASSES = {
+    'resolved': ('resolved', 'solved', 'completed'),
+    'not_resolved': ('closed', 'rejected', 'cancelled', "won't fix", 'invalid'),
+    'ongoing': ('open', 'in_progress', 'in progress', 'pending', 'assigned', 'acknowledged'),
+}
+TICKET_PAGE_SIZE = 50
+SLA_REFRESH_MINUTES = 15  # the Support tab folds newly resolved tickets in when metrics are older than this
+TICKET_PRIORITIES = ('urgent', 'high', 'medium', 'low')  # assignment order; unknown priorities go last
+TICKET_SLA_HOURS = {'urgent': 4, 'high': 8, 'medium': 24, 'low': 72}
+TICKET_LEASE_SECONDS = 900  # a claimed ticket returns to the queue if not finished or renewed by then
+
+# Full-text search: kind -> (FTS5 table, content table, {indexed column: bm25 weight})
+SEARCH_INDEXES = {
+    'ticket': ('support_tickets_fts', 'support_tickets', {'subject': 4.0, 'description': 1.0}),
+    'user': ('users_fts', 'users', {'name': 6.0, 'username': 6.0, 'email': 4.0, 'city': 1.0}),
+    'plan': ('plans_fts', 'plans', {'name': 6.0, 'description': 1.0, 'features': 1.0}),
+}
+SEARCH_RESULT_LIMIT = 20
+
+# Dunning (retries of failed payments)
+DUNNING_WATERMARK = "dunning_last_payment_id"
+DUNNING_RETRY_HOURS = (24, 72, 168)  # wait after the 1st, 2nd, 3rd failure; the last value repeats
+DUNNING_MAX_FAILURES = 4  # the user's subscription is suspended on this failure
+DUNNING_BATCH_SIZE = 500
+DUNNING_LEASE_SECONDS = 600  # claimed retries not finished by then become due again
+DUNNING_ENROLL_WINDOW_DAYS = 30  # failures older than this are not retried or notified
+
+# Monthly statements (content-addressed: statements/<sha256[:2]>/<sha256>.<format>)
+STATEMENT_DIR = os.path.join(os.path.dirname(__file__), "statements")
+STATEMENT_FORMATS = ("txt", "html", "pdf")
+STATEMENT_CHUNK_USERS = 500
+
+# Payments <-> subscriptions reconciliation
+RECONCILE_CHUNK_ROWS = 20000  # payments per merge range (whole users, so ranges can be larger)
+RECONCILE_GRACE_DAYS = 3  # a payment may precede its subscription's start by this much
+
+# Usage ingestion from network accounting records
+USAGE_INGEST_BATCH = 20000  # records per transaction
+USAGE_PEAK_HOURS = (8, 23)  # sessions starting in [8:00, 23:00) count as peak-hour usage
+
+# Data quotas
+QUOTA_THRESHOLDS = (80, 100)  # percent of the plan's data limit; each notifies once per billing period
+QUOTA_REFRESH_SECONDS = 5.0  # how stale QuotaEngine answers may be
+
+# Payment gateway (charges are simulated locally unless PAYMENT_GATEWAY_URL is set)
+GATEWAY_CONCURRENCY = 50
+GATEWAY_TIMEOUT_SECONDS = 5.0
+GATEWAY_MAX_RETRIES = 3
+GATEWAY_RETRY_BACKOFF_SECONDS = 0.2  # doubled per retry, with jitter
 
 # Custom CSS for modern UI including semi-circular progress
 def load_css():
@@ -333,6 +477,231 @@ def add_column_if_not_exists(table_name, column_name, column_type, default_value
 # ---------------------------
 # Schema & Database Migration
 # ---------------------------
+# Ledger entries for one payment: paid -> charge, tax, discount; refunded -> refund.
+# `running` is the cumulative amount within the payment, so the entries sum to it.
+_LEDGER_ENTRIES_SQL = '''
+    SELECT {cols}1 AS seq, 'charge' AS entry_type,
+           {p}.amount - COALESCE({p}.tax_amount, 0) + COALESCE({p}.discount, 0) AS amount,
+           {p}.amount - COALESCE({p}.tax_amount, 0) + COALESCE({p}.discount, 0) AS running
+    {src} WHERE {p}.status = 'paid'
+    UNION ALL
+    SELECT {cols}2, 'tax', COALESCE({p}.tax_amount, 0), {p}.amount + COALESCE({p}.discount, 0)
+    {src} WHERE {p}.status = 'paid'
+    UNION ALL
+    SELECT {cols}3, 'discount', -COALESCE({p}.discount, 0), {p}.amount
+    {src} WHERE {p}.status = 'paid'
+    UNION ALL
+    SELECT {cols}4, 'refund', -ABS({p}.amount), -ABS({p}.amount)
+    {src} WHERE {p}.status = 'refunded'
+'''
+
+# One payment's contribution to account_balances
+_BALANCE_DELTA_SQL = '''
+    CASE {p}.status WHEN 'paid' THEN {p}.amount WHEN 'refunded' THEN -ABS({p}.amount) ELSE 0 END AS balance,
+    CASE WHEN {p}.status = 'paid' THEN {p}.amount ELSE 0 END AS total_paid,
+    CASE WHEN {p}.status = 'paid' THEN COALESCE({p}.tax_amount, 0) ELSE 0 END AS total_tax,
+    CASE WHEN {p}.status = 'paid' THEN COALESCE({p}.discount, 0) ELSE 0 END AS total_discount,
+    CASE WHEN {p}.status = 'refunded' THEN ABS({p}.amount) ELSE 0 END AS total_refunded,
+    {p}.status = 'paid' AS paid_count,
+    {failed} AS failed_count,
+    CASE WHEN {p}.status = 'paid' THEN {p}.payment_date END AS last_payment_date
+'''
+
+
+def _ledger_posting_sql(failed_delta):
+    """Trigger body posting NEW (a payments row) to the ledger and its account balance"""
+    return f'''
+            INSERT INTO ledger_entries (user_id, payment_id, entry_type, amount, balance_after, created_date)
+            SELECT NEW.user_id, NEW.id, e.entry_type, e.amount,
+                   COALESCE((SELECT balance FROM account_balances WHERE user_id = NEW.user_id), 0) + e.running,
+                   COALESCE(NEW.payment_date, strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+            FROM ({_LEDGER_ENTRIES_SQL.format(p='NEW', src='', cols='')}) AS e
+            WHERE e.amount != 0
+            ORDER BY e.seq;
+            INSERT INTO account_balances (user_id, balance, total_paid, total_tax, total_discount, total_refunded,
+                                          paid_count, failed_count, last_payment_date, updated_date)
+            SELECT NEW.user_id, {_BALANCE_DELTA_SQL.format(p='NEW', failed=failed_delta)},
+                   strftime('%Y-%m-%dT%H:%M:%f', 'now')
+            WHERE true
+            ON CONFLICT(user_id) DO UPDATE SET
+                balance = balance + excluded.balance,
+                total_paid = total_paid + excluded.total_paid,
+                total_tax = total_tax + excluded.total_tax,
+                total_discount = total_discount + excluded.total_discount,
+                total_refunded = total_refunded + excluded.total_refunded,
+                paid_count = paid_count + excluded.paid_count,
+                failed_count = failed_count + excluded.failed_count,
+                last_payment_date = COALESCE(MAX(last_payment_date, excluded.last_payment_date),
+                                             last_payment_date, excluded.last_payment_date),
+                updated_date = excluded.updated_date;
+    '''
+
+
+# Upserts quota_usage from NEW (a subscriptions row). Period-to-date usage is summed
+# from daily rows; rebuild_quota_usage also counts packed months.
+_QUOTA_SUBSCRIPTION_SQL = '''
+            INSERT INTO quota_usage (subscription_id, user_id, period_start, period_end, limit_gb, used_gb, active, version)
+            SELECT NEW.id, NEW.user_id, substr(NEW.start_date, 1, 10), substr(NEW.end_date, 1, 10),
+                   CASE WHEN COALESCE(p.is_unlimited, 0) THEN NULL ELSE p.data_limit_gb END,
+                   (SELECT COALESCE(SUM(u.data_used_gb), 0) FROM usage u
+                    WHERE u.user_id = NEW.user_id
+                      AND u.date BETWEEN substr(NEW.start_date, 1, 10) AND substr(NEW.end_date, 1, 10)),
+                   NEW.status = 'active',
+                   (SELECT COALESCE(MAX(version), 0) + 1 FROM quota_usage)
+            FROM (SELECT 1) LEFT JOIN plans p ON p.id = NEW.plan_id
+            WHERE NEW.start_date IS NOT NULL AND NEW.end_date IS NOT NULL
+            ON CONFLICT(subscription_id) DO UPDATE SET
+                user_id = excluded.user_id,
+                period_start = excluded.period_start,
+                period_end = excluded.period_end,
+                limit_gb = excluded.limit_gb,
+                -- The running total includes days pack_usage has moved out of usage, which a
+                -- recount of usage misses: keep it for an unchanged period, and carry the packed
+                -- share over when only the end moves (upgrades and migrations close on today)
+                used_gb = CASE
+                    WHEN quota_usage.user_id IS NOT excluded.user_id OR quota_usage.period_start IS NOT excluded.period_start
+                        THEN excluded.used_gb
+                    WHEN quota_usage.period_end IS excluded.period_end
+                        THEN quota_usage.used_gb
+                    ELSE excluded.used_gb + quota_usage.used_gb
+                         - (SELECT COALESCE(SUM(u.data_used_gb), 0) FROM usage u
+                            WHERE u.user_id = quota_usage.user_id
+                              AND u.date BETWEEN quota_usage.period_start AND quota_usage.period_end)
+                END,
+                active = excluded.active,
+                version = excluded.version;
+'''
+
+
+def _quota_usage_delta_sql(delta):
+    """Trigger body adding `delta` GB of usage on NEW.date to the subscription period it falls in"""
+    return f'''
+            UPDATE quota_usage
+            SET used_gb = used_gb + {delta},
+                version = (SELECT MAX(version) + 1 FROM quota_usage)
+            WHERE user_id = NEW.user_id AND NEW.date BETWEEN period_start AND period_end;
+    '''
+
+
+_QUOTA_THRESHOLDS_SQL = " UNION ALL ".join(f"SELECT {pct} AS pct" for pct in QUOTA_THRESHOLDS)
+
+# Notifies and records each threshold NEW (a quota_usage row) has newly reached; the
+# (subscription_id, period_start, threshold) key makes every event fire once per period.
+# NOT EXISTS rather than INSERT OR IGNORE: the firing statement's conflict policy overrides a trigger's.
+_QUOTA_NEW_THRESHOLD = '''NEW.used_gb >= NEW.limit_gb * t.pct / 100.0
+              AND NOT EXISTS (SELECT 1 FROM quota_events e
+                              WHERE e.subscription_id = NEW.subscription_id
+                                AND e.period_start = NEW.period_start AND e.threshold = t.pct)'''
+_QUOTA_EVENTS_SQL = f'''
+            INSERT INTO notifications (user_id, message, notification_type, created_date)
+            SELECT NEW.user_id,
+                   CASE WHEN t.pct >= 100
+                        THEN 'You have used your full ' || printf('%g', NEW.limit_gb) || ' GB data allowance for this billing period.'
+                        ELSE 'You have used ' || t.pct || '% of your ' || printf('%g', NEW.limit_gb) || ' GB data allowance for this billing period.'
+                   END,
+                   CASE WHEN t.pct >= 100 THEN 'quota_exceeded' ELSE 'quota_warning' END,
+                   strftime('%Y-%m-%dT%H:%M:%f', 'now')
+            FROM ({_QUOTA_THRESHOLDS_SQL}) AS t
+            WHERE {_QUOTA_NEW_THRESHOLD};
+            INSERT INTO quota_events (subscription_id, user_id, period_start, threshold, used_gb, limit_gb, created_date)
+            SELECT NEW.subscription_id, NEW.user_id, NEW.period_start, t.pct, NEW.used_gb, NEW.limit_gb,
+                   strftime('%Y-%m-%dT%H:%M:%f', 'now')
+            FROM ({_QUOTA_THRESHOLDS_SQL}) AS t
+            WHERE {_QUOTA_NEW_THRESHOLD};
+'''
+# Periods that have already ended never notify, so late usage or a rebuild stays silent for them
+_QUOTA_EVENTS_WHEN = (f"NEW.active AND NEW.limit_gb > 0 AND NEW.used_gb >= NEW.limit_gb * {min(QUOTA_THRESHOLDS)} / 100.0"
+                      " AND NEW.period_end >= date('now')")
+
+
+def _create_quota_subscription_triggers(c):
+    """Triggers keeping a subscription's quota_usage row in step with its period, plan and status"""
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_subscriptions_quota_insert
+        AFTER INSERT ON subscriptions WHEN NEW.status = 'active'
+        BEGIN
+            {_QUOTA_SUBSCRIPTION_SQL}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_subscriptions_quota_update
+        AFTER UPDATE OF status, start_date, end_date, plan_id ON subscriptions
+        BEGIN
+            {_QUOTA_SUBSCRIPTION_SQL}
+        END
+    ''')
+
+
+def _create_quota_event_triggers(c):
+    """Threshold notification triggers on quota_usage, firing under _QUOTA_EVENTS_WHEN"""
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_quota_events_insert
+        AFTER INSERT ON quota_usage WHEN {_QUOTA_EVENTS_WHEN}
+        BEGIN
+            {_QUOTA_EVENTS_SQL}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_quota_events_update
+        AFTER UPDATE OF used_gb, limit_gb, active ON quota_usage WHEN {_QUOTA_EVENTS_WHEN}
+        BEGIN
+            {_QUOTA_EVENTS_SQL}
+        END
+    ''')
+
+
+def _ticket_status_class_sql(status):
+    """SQL CASE mapping a support ticket status to its TICKET_STATUS_CLASSES class ('ongoing' if unlisted)"""
+    whens = " ".join(
+        "WHEN LOWER(TRIM({s})) IN ({values}) THEN '{cls}'".format(
+            s=status, cls=cls, values=", ".join("'" + v.replace("'", "''") + "'" for v in statuses))
+        for cls, statuses in TICKET_STATUS_CLASSES.items() if cls != 'ongoing'
+    )
+    return f"CASE {whens} ELSE 'ongoing' END"
+
+
+def _ticket_counts_sql(p, sign):
+    """Trigger statement adding `sign` to the status and category counts of row p (NEW or OLD)"""
+    return f'''
+            INSERT INTO support_ticket_counts (dimension, value, count)
+            VALUES ('status', LOWER(TRIM(COALESCE({p}.status, ''))), {sign}), ('category', COALESCE({p}.category, ''), {sign})
+            ON CONFLICT(dimension, value) DO UPDATE SET count = count + excluded.count;
+    '''
+
+
+def _ticket_queue_insert_sql(p, when="true"):
+    """Statement queueing ticket row p (NEW) for assignment, ranked by priority and SLA deadline"""
+    rank = " ".join(f"WHEN '{name}' THEN {rank}" for rank, name in enumerate(TICKET_PRIORITIES))
+    hours = " ".join(f"WHEN '{name}' THEN {TICKET_SLA_HOURS[name]}" for name in TICKET_PRIORITIES)
+    return f'''
+            INSERT INTO ticket_queue (ticket_id, priority_rank, sla_deadline, created_date)
+            SELECT {p}.id,
+                   CASE LOWER({p}.priority) {rank} ELSE {len(TICKET_PRIORITIES)} END,
+                   strftime('%Y-%m-%dT%H:%M:%S', COALESCE({p}.created_date, 'now'),
+                            '+' || (CASE LOWER({p}.priority) {hours} ELSE {max(TICKET_SLA_HOURS.values())} END) || ' hours'),
+                   {p}.created_date
+            WHERE {when}
+            ON CONFLICT(ticket_id) DO UPDATE SET
+                priority_rank = excluded.priority_rank,
+                sla_deadline = excluded.sla_deadline;
+    '''
+
+
+_PLAN_CATALOG_BUMP_SQL = f'''
+            INSERT INTO meta (k, v) VALUES ('{PLAN_CATALOG_VERSION_KEY}', '1')
+            ON CONFLICT(k) DO UPDATE SET v = CAST(v AS INTEGER) + 1;
+'''
+
+
+def _search_sync_sql(fts, columns, p, delete=False):
+    """Statement adding row p (NEW) to an external-content FTS5 index, or removing it (OLD, delete=True)"""
+    cols = ", ".join(columns)
+    values = ", ".join(f"{p}.{col}" for col in columns)
+    if delete:
+        return f"INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', {p}.id, {values});"
+    return f"INSERT INTO {fts} (rowid, {cols}) VALUES ({p}.id, {values});"
+
+
 def create_tables():
     conn = get_conn()
     c = conn.cursor()
@@ -348,9 +717,21 @@ def create_tables():
             email TEXT,
             address TEXT,
             phone TEXT,
-            is_autopay_enabled INTEGER DEFAULT 0
+            is_autopay_enabled INTEGER DEFAULT 0,
+            city TEXT,
+            state TEXT,
+            signup_date TEXT,
+            last_login TEXT,
+            notification_preferences TEXT DEFAULT 'email,sms'
         )
     ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_city ON users (city)')
+    # Sort keys of the admin user grid (USER_GRID_SORTS); the rowid breaks ties
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_sort_name ON users (COALESCE(name, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_sort_city ON users (COALESCE(city, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_sort_signup ON users (COALESCE(signup_date, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_city_name ON users (COALESCE(city, ''), COALESCE(name, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_city_signup ON users (COALESCE(city, ''), COALESCE(signup_date, ''))")
     c.execute('''
         CREATE TABLE IF NOT EXISTS plans (
             id INTEGER PRIMARY KEY,
@@ -359,7 +740,12 @@ def create_tables():
             data_limit_gb REAL,
             price REAL,
             validity_days INTEGER,
-            description TEXT
+            description TEXT,
+            plan_type TEXT DEFAULT 'basic',
+            is_unlimited INTEGER DEFAULT 0,
+            created_date TEXT,
+            features TEXT,
+            upload_speed_mbps INTEGER
         )
     ''')
     c.execute('''
@@ -371,10 +757,26 @@ def create_tables():
             end_date TEXT,
             status TEXT,
             auto_renew INTEGER DEFAULT 0,
+            created_date TEXT,
+            renewal_count INTEGER DEFAULT 0,
             FOREIGN KEY(user_id) REFERENCES users(id),
             FOREIGN KEY(plan_id) REFERENCES plans(id)
         )
     ''')
+    # Plan changes written by process_plan_upgrade/process_plan_downgrade
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS subscription_log (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            subscription_id INTEGER,
+            action TEXT,
+            from_plan_id INTEGER,
+            to_plan_id INTEGER,
+            created_date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(subscription_id) REFERENCES subscriptions(id)
+        )
+    ''')
     c.execute('''
         CREATE TABLE IF NOT EXISTS payments (
             id INTEGER PRIMARY KEY,
@@ -385,6 +787,11 @@ def create_tables():
             status TEXT,
             bill_month INTEGER,
             bill_year INTEGER,
+            payment_method TEXT DEFAULT 'credit_card',
+            late_fee REAL DEFAULT 0,
+            discount REAL DEFAULT 0,
+            tax_amount REAL DEFAULT 0,
+            transaction_id TEXT,
             FOREIGN KEY(subscription_id) REFERENCES subscriptions(id),
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
@@ -395,9 +802,40 @@ def create_tables():
             user_id INTEGER,
             date TEXT,
             data_used_gb REAL,
+            peak_hour_usage REAL,
+            off_peak_usage REAL,
+            upload_usage REAL,
+            average_speed REAL,
+            session_seconds REAL,
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     ''')
+    # One row per user and day, so ingested usage can be upserted onto it. Databases that
+    # already hold duplicate days get the index from merge_duplicate_usage_days() in the migration
+    try:
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_usage_user_date ON usage (user_id, date)')
+    except sqlite3.IntegrityError:
+        pass
+    # 24 hourly float32 GB values per user and day from ingested accounting records
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS usage_hourly (
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            hours BLOB NOT NULL,
+            PRIMARY KEY (user_id, date)
+        ) WITHOUT ROWID
+    ''')
+    # Closed months of daily usage packed into one float32 BLOB per user and month (see pack_usage)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS usage_packed (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            days_present INTEGER NOT NULL,
+            total_gb REAL NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
     c.execute('''
         CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)
     ''')
@@ -412,6 +850,21 @@ def create_tables():
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_plan_comparisons_user ON plan_comparisons (user_id, plan_ids)')
+    # One row per distinct plan set (sorted ids, hashed): how often it was saved, plus its
+    # comparison metrics as of catalog_version
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS plan_comparison_sets (
+            set_hash TEXT PRIMARY KEY,
+            plan_ids TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            first_seen TEXT,
+            last_seen TEXT,
+            catalog_version INTEGER,
+            metrics TEXT
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_plan_comparison_sets_hits ON plan_comparison_sets (hits)')
     
     c.execute('''
         CREATE TABLE IF NOT EXISTS notifications (
@@ -424,9 +877,492 @@ def create_tables():
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     ''')
-    create_admins_table()
-    
+
+    # Outbound delivery queue: one row per notification per channel
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY,
+            notification_id INTEGER,
+            user_id INTEGER,
+            channel TEXT,
+            recipient TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TEXT,
+            claimed_by TEXT,
+            claimed_at TEXT,
+            created_date TEXT,
+            sent_date TEXT,
+            last_error TEXT,
+            UNIQUE(notification_id, channel),
+            FOREIGN KEY(notification_id) REFERENCES notifications(id),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_claim
+        ON notification_outbox (status, channel, next_attempt_at)
+    ''')
+
+    # Per-user unread counter, kept in step with notifications by triggers
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS notification_counters (
+            user_id INTEGER PRIMARY KEY,
+            unread_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_user_unread
+        ON notifications (user_id, is_read, id)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_type_created
+        ON notifications (notification_type, created_date)
+    ''')
+
+    # Automated renewal runs; last_subscription_id is the resume checkpoint and
+    # max_subscription_id keeps renewals created by the run itself out of it
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS billing_runs (
+            id INTEGER PRIMARY KEY,
+            as_of TEXT,
+            status TEXT,
+            started_date TEXT,
+            finished_date TEXT,
+            max_subscription_id INTEGER,
+            last_subscription_id INTEGER DEFAULT 0,
+            renewed INTEGER DEFAULT 0,
+            billed_amount REAL DEFAULT 0
+        )
+    ''')
+    # Bulk moves of a plan's subscribers; last_subscription_id is the resume checkpoint
+    # and max_subscription_id keeps subscriptions created by the run itself out of it
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS plan_migration_runs (
+            id INTEGER PRIMARY KEY,
+            source_plan_id INTEGER,
+            target_plan_id INTEGER,
+            status TEXT,
+            started_date TEXT,
+            finished_date TEXT,
+            max_subscription_id INTEGER,
+            last_subscription_id INTEGER DEFAULT 0,
+            migrated INTEGER DEFAULT 0,
+            charged_amount REAL DEFAULT 0,
+            credited_amount REAL DEFAULT 0,
+            FOREIGN KEY(source_plan_id) REFERENCES plans(id),
+            FOREIGN KEY(target_plan_id) REFERENCES plans(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_plan_status ON subscriptions (plan_id, status, id)')
+    # Failed payments awaiting retry; (status, next_retry_at) orders the due queue
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS dunning_queue (
+            payment_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            subscription_id INTEGER,
+            amount REAL,
+            status TEXT DEFAULT 'active',
+            failures INTEGER DEFAULT 1,
+            next_retry_at TEXT,
+            last_error TEXT,
+            created_date TEXT,
+            updated_date TEXT,
+            FOREIGN KEY(payment_id) REFERENCES payments(id),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_dunning_due ON dunning_queue (status, next_retry_at)')
+    # Reconciliation runs (last_user_id is the resume checkpoint) and their exceptions report
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS reconciliation_runs (
+            id INTEGER PRIMARY KEY,
+            status TEXT,
+            started_date TEXT,
+            finished_date TEXT,
+            last_user_id INTEGER DEFAULT 0,
+            payments_scanned INTEGER DEFAULT 0,
+            linked INTEGER DEFAULT 0,
+            exceptions INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS reconciliation_exceptions (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER,
+            payment_id INTEGER,
+            user_id INTEGER,
+            kind TEXT,
+            subscription_id INTEGER,
+            candidate_ids TEXT,
+            detail TEXT,
+            FOREIGN KEY(run_id) REFERENCES reconciliation_runs(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reconciliation_exceptions_run ON reconciliation_exceptions (run_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_start ON subscriptions (user_id, start_date, id)')
+    # Generated monthly statements; the files live in the content-addressed STATEMENT_DIR
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS statements (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            format TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            size_bytes INTEGER,
+            created_date TEXT,
+            UNIQUE(user_id, period, format),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_renewal
+        ON subscriptions (status, auto_renew, id)
+    ''')
+
+    # Append-only account ledger posted from payments, with a materialized balance per user
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            payment_id INTEGER,
+            entry_type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            created_date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(payment_id) REFERENCES payments(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger_entries (user_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ledger_payment ON ledger_entries (payment_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ledger_created ON ledger_entries (created_date, amount)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS account_balances (
+            user_id INTEGER PRIMARY KEY,
+            balance REAL NOT NULL DEFAULT 0,
+            total_paid REAL NOT NULL DEFAULT 0,
+            total_tax REAL NOT NULL DEFAULT 0,
+            total_discount REAL NOT NULL DEFAULT 0,
+            total_refunded REAL NOT NULL DEFAULT 0,
+            paid_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            last_payment_date TEXT,
+            updated_date TEXT
+        )
+    ''')
+    # Paid totals per user and month for billing trend charts
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS payment_monthly_totals (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            total_paid REAL NOT NULL DEFAULT 0,
+            paid_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_date ON payments (user_id, payment_date, id)')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_seek ON payments (user_id, COALESCE(payment_date, ''), id)")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_monthly_insert
+        AFTER INSERT ON payments WHEN NEW.status = 'paid'
+        BEGIN
+            INSERT INTO payment_monthly_totals (user_id, month, total_paid, paid_count)
+            VALUES (NEW.user_id, substr(NEW.payment_date, 1, 7), NEW.amount, 1)
+            ON CONFLICT(user_id, month) DO UPDATE SET
+                total_paid = total_paid + excluded.total_paid,
+                paid_count = paid_count + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_monthly_update
+        AFTER UPDATE OF status ON payments WHEN (OLD.status IS 'paid') != (NEW.status IS 'paid')
+        BEGIN
+            INSERT INTO payment_monthly_totals (user_id, month, total_paid, paid_count)
+            VALUES (NEW.user_id, substr(NEW.payment_date, 1, 7),
+                    CASE WHEN NEW.status = 'paid' THEN NEW.amount ELSE -NEW.amount END,
+                    CASE WHEN NEW.status = 'paid' THEN 1 ELSE -1 END)
+            ON CONFLICT(user_id, month) DO UPDATE SET
+                total_paid = total_paid + excluded.total_paid,
+                paid_count = paid_count + excluded.paid_count;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_no_update
+        BEFORE UPDATE ON ledger_entries
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger_entries is append-only');
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_no_delete
+        BEFORE DELETE ON ledger_entries
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger_entries is append-only');
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_ledger_insert
+        AFTER INSERT ON payments
+        BEGIN
+            {_ledger_posting_sql("NEW.status = 'failed'")}
+        END
+    ''')
+    # Pending/failed payments post once they settle; settled rows are only reversed by refunds
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_ledger_update
+        AFTER UPDATE OF status ON payments
+        WHEN OLD.status IS NOT NEW.status AND COALESCE(OLD.status, '') NOT IN ('paid', 'refunded')
+        BEGIN
+            {_ledger_posting_sql("(NEW.status = 'failed') - (OLD.status IS 'failed')")}
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_insert
+        AFTER INSERT ON notifications WHEN COALESCE(NEW.is_read, 0) = 0
+        BEGIN
+            INSERT INTO notification_counters (user_id, unread_count) VALUES (NEW.user_id, 1)
+            ON CONFLICT(user_id) DO UPDATE SET unread_count = unread_count + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_update
+        AFTER UPDATE OF is_read ON notifications WHEN COALESCE(OLD.is_read, 0) != COALESCE(NEW.is_read, 0)
+        BEGIN
+            UPDATE notification_counters
+            SET unread_count = MAX(0, unread_count + CASE WHEN COALESCE(NEW.is_read, 0) = 0 THEN 1 ELSE -1 END)
+            WHERE user_id = NEW.user_id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_delete
+        AFTER DELETE ON notifications WHEN COALESCE(OLD.is_read, 0) = 0
+        BEGIN
+            UPDATE notification_counters SET unread_count = MAX(0, unread_count - 1)
+            WHERE user_id = OLD.user_id;
+        END
+    ''')
+
+    # Period-to-date usage per subscription, kept current by triggers on usage and
+    # subscriptions; version orders changes for QuotaEngine's incremental refresh
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS quota_usage (
+            subscription_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            period_start TEXT NOT NULL,
+            period_end TEXT NOT NULL,
+            limit_gb REAL,
+            used_gb REAL NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(subscription_id) REFERENCES subscriptions(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_quota_user ON quota_usage (user_id, period_start)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_quota_version ON quota_usage (version)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS quota_events (
+            id INTEGER PRIMARY KEY,
+            subscription_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            period_start TEXT NOT NULL,
+            threshold INTEGER NOT NULL,
+            used_gb REAL,
+            limit_gb REAL,
+            created_date TEXT,
+            UNIQUE(subscription_id, period_start, threshold),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    _create_quota_subscription_triggers(c)
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_plans_quota_update
+        AFTER UPDATE OF data_limit_gb, is_unlimited ON plans
+        BEGIN
+            UPDATE quota_usage
+            SET limit_gb = CASE WHEN COALESCE(NEW.is_unlimited, 0) THEN NULL ELSE NEW.data_limit_gb END,
+                version = (SELECT MAX(version) + 1 FROM quota_usage)
+            WHERE subscription_id IN (SELECT id FROM subscriptions WHERE plan_id = NEW.id);
+        END
+    ''')
+    c.execute(f"INSERT OR IGNORE INTO meta (k, v) VALUES ('{PLAN_CATALOG_VERSION_KEY}', '0')")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_plans_catalog_{event.lower()}
+            AFTER {event} ON plans
+            BEGIN
+                {_PLAN_CATALOG_BUMP_SQL}
+            END
+        ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_usage_quota_insert
+        AFTER INSERT ON usage WHEN NEW.data_used_gb != 0
+        BEGIN
+            {_quota_usage_delta_sql("NEW.data_used_gb")}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_usage_quota_update
+        AFTER UPDATE OF data_used_gb ON usage WHEN NEW.data_used_gb IS NOT OLD.data_used_gb
+        BEGIN
+            {_quota_usage_delta_sql("COALESCE(NEW.data_used_gb, 0) - COALESCE(OLD.data_used_gb, 0)")}
+        END
+    ''')
+    _create_quota_event_triggers(c)
+
+    # Support tickets. status_class (resolved / not_resolved / ongoing) is derived from
+    # status by triggers so the Support tabs can seek on (status_class, created_date)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS support_tickets (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            subject TEXT,
+            description TEXT,
+            category TEXT,
+            status TEXT,
+            priority TEXT,
+            created_date TEXT,
+            resolved_date TEXT,
+            status_class TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    # Older databases have the table without status_class; the index below needs it now,
+    # the values are backfilled by rebuild_ticket_counts() during migration
+    if 'status_class' not in {r[1] for r in c.execute("PRAGMA table_info(support_tickets)")}:
+        c.execute("ALTER TABLE support_tickets ADD COLUMN status_class TEXT")
+    # Seek key for the Support tabs; NULL created dates sort as '' so they stay reachable
+    c.execute('DROP INDEX IF EXISTS idx_tickets_class_created')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tickets_class_seek ON support_tickets (status_class, COALESCE(created_date, ''), id)")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tickets_resolved ON support_tickets (resolved_date, id)')
+    # Resolution-time histograms per dimension value plus the open-backlog age snapshot
+    # (dimension 'backlog'), maintained by refresh_ticket_sla from a watermark
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_sla_rollup (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, value, bucket)
+        ) WITHOUT ROWID
+    ''')
+    # Ticket counts per status and per category, kept in step by triggers
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS support_ticket_counts (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, value)
+        ) WITHOUT ROWID
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_insert
+        AFTER INSERT ON support_tickets
+        BEGIN
+            UPDATE support_tickets SET status_class = {_ticket_status_class_sql("NEW.status")} WHERE id = NEW.id;
+            {_ticket_counts_sql("NEW", 1)}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_update
+        AFTER UPDATE OF status, category ON support_tickets
+        WHEN OLD.status IS NOT NEW.status OR OLD.category IS NOT NEW.category
+        BEGIN
+            UPDATE support_tickets SET status_class = {_ticket_status_class_sql("NEW.status")} WHERE id = NEW.id;
+            {_ticket_counts_sql("OLD", -1)}
+            {_ticket_counts_sql("NEW", 1)}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_delete
+        AFTER DELETE ON support_tickets
+        BEGIN
+            {_ticket_counts_sql("OLD", -1)}
+        END
+    ''')
+    # Open tickets awaiting or under assignment. Unclaimed rows (lease_until NULL) sit in a
+    # partial index in pull order, so the next ticket is found with one index seek
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_queue (
+            ticket_id INTEGER PRIMARY KEY,
+            priority_rank INTEGER NOT NULL,
+            sla_deadline TEXT NOT NULL,
+            created_date TEXT,
+            agent TEXT,
+            lease_until TEXT,
+            claims INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(ticket_id) REFERENCES support_tickets(id)
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ticket_queue_next
+        ON ticket_queue (priority_rank, sla_deadline, ticket_id) WHERE lease_until IS NULL
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ticket_queue_lease
+        ON ticket_queue (lease_until) WHERE lease_until IS NOT NULL
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_queue_insert
+        AFTER INSERT ON support_tickets WHEN {_ticket_status_class_sql("NEW.status")} = 'ongoing'
+        BEGIN
+            {_ticket_queue_insert_sql("NEW")}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_queue_update
+        AFTER UPDATE OF status, priority ON support_tickets
+        BEGIN
+            DELETE FROM ticket_queue
+            WHERE ticket_id = NEW.id AND {_ticket_status_class_sql("NEW.status")} != 'ongoing';
+            {_ticket_queue_insert_sql("NEW", _ticket_status_class_sql("NEW.status") + " = 'ongoing'")}
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_queue_delete
+        AFTER DELETE ON support_tickets
+        BEGIN
+            DELETE FROM ticket_queue WHERE ticket_id = OLD.id;
+        END
+    ''')
+
+    # Full-text indexes for the admin search box. External-content FTS5 tables keep only the
+    # index (the text stays in the base table); triggers mirror every write into them
+    for fts, table, weights in SEARCH_INDEXES.values():
+        columns = tuple(weights)
+        c.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {", ".join(columns)}, content='{table}', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert
+            AFTER INSERT ON {table}
+            BEGIN
+                {_search_sync_sql(fts, columns, "NEW")}
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_update
+            AFTER UPDATE OF {", ".join(columns)} ON {table}
+            BEGIN
+                {_search_sync_sql(fts, columns, "OLD", delete=True)}
+                {_search_sync_sql(fts, columns, "NEW")}
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete
+            AFTER DELETE ON {table}
+            BEGIN
+                {_search_sync_sql(fts, columns, "OLD", delete=True)}
+            END
+        ''')
+    # Commit before create_admins_table opens its own connection; the meta seed above
+    # holds a write transaction until then
     conn.commit()
+    create_admins_table()
     conn.close()
 
 def create_admins_table():
@@ -466,6 +1402,39 @@ def migrate_database():
     
     # ... existing migration code ...
     
+    # Session time lets ingested usage keep an exact average speed per day
+    add_column_if_not_exists('usage', 'session_seconds', 'REAL')
+    
+    # Fold duplicate usage days together so the (user_id, date) unique index can be built
+    merge_duplicate_usage_days()
+    
+    # Renewals carry the period count (for the loyalty discount) and their creation time
+    add_column_if_not_exists('subscriptions', 'created_date', 'TEXT')
+    add_column_if_not_exists('subscriptions', 'renewal_count', 'INTEGER', 0)
+    
+    # Seed unread counters for notifications created before the counter triggers existed
+    rebuild_notification_counters()
+    
+    # Post payments recorded before the ledger triggers existed
+    rebuild_account_ledger()
+    rebuild_payment_monthly_totals()
+    
+    # Seed period-to-date quota usage for subscriptions that predate the quota triggers,
+    # after replacing triggers from earlier versions (event triggers that notified for closed
+    # periods, subscription triggers that recounted packed usage away)
+    refresh_quota_triggers()
+    rebuild_quota_usage()
+    
+    # Classify and count tickets created before the ticket triggers existed
+    rebuild_ticket_counts()
+    rebuild_ticket_queue()
+    
+    # Index tickets, users and plans written before the search triggers existed
+    rebuild_search_index()
+    
+    # Count saved comparisons per plan set from the existing history
+    rebuild_plan_comparison_sets()
+    
     # Create admins table if it doesn't exist
     create_admins_table()
     
@@ -675,10 +1644,10 @@ def create_comprehensive_mock_data():
                     
                     # Calculate taxes and discounts
                     base_amount = plan_price
-                    tax_amount = base_amount * 0.18  # 18% GST
+                    tax_amount = base_amount * GST_RATE  # 18% GST
                     discount = 0
                     if renewal_count > 0:  # Loyalty discount
-                        discount = base_amount * 0.05
+                        discount = base_amount * LOYALTY_DISCOUNT_RATE
                     
                     total_amount = base_amount + tax_amount - discount
                     
@@ -830,7 +1799,10 @@ def populate_usage_for_all_users(days=60):
     conn.close()
 
     for uid in user_ids:
-        existing = exec_query("SELECT COUNT(*) FROM usage WHERE user_id = ?", (uid,), fetch=True)[0][0]
+        existing = exec_query(
+            "SELECT (SELECT COUNT(*) FROM usage WHERE user_id = ?) + (SELECT COUNT(*) FROM usage_packed WHERE user_id = ?)",
+            (uid, uid), fetch=True,
+        )[0][0]
         if existing == 0:  # Only populate if no usage exists
             generate_usage_for_user(uid, days)
             print(f"✅ Inserted {days} days of usage for user {uid}")
@@ -899,9 +1871,20 @@ def get_user_by_id(uid):
     return None
 
 
+_PLAN_CACHE = {'version': None, 'plans': []}
+
+
+def plan_catalog_version():
+    return int(meta_get(PLAN_CATALOG_VERSION_KEY) or 0)
+
+
 def get_all_plans():
-    rows = exec_query("SELECT * FROM plans ORDER BY price ASC", fetch=True)
-    return [row_to_dict(r) for r in rows]
+    """All plans by price, reloaded only when the plan catalog version moves"""
+    version = plan_catalog_version()
+    if _PLAN_CACHE['version'] != version:
+        rows = exec_query("SELECT * FROM plans ORDER BY price ASC", fetch=True)
+        _PLAN_CACHE.update(version=version, plans=[row_to_dict(r) for r in rows])
+    return list(_PLAN_CACHE['plans'])
 
 def get_plan(plan_id):
     r = exec_query("SELECT * FROM plans WHERE id = ?", (plan_id,), fetch=True)
@@ -935,20 +1918,20 @@ def subscribe_user_to_plan(user_id, plan_id, auto_renew=1):
     plan = get_plan(plan_id)
     end = today + timedelta(days=plan['validity_days'])
     
-    if column_exists('subscriptions', 'created_date'):
-        exec_query(
+    conn = get_conn()
+    try:
+        cur = conn.execute(
             "INSERT INTO subscriptions (user_id, plan_id, start_date, end_date, status, auto_renew, created_date) VALUES (?, ?, ?, ?, ?, ?, ?)",
             (user_id, plan_id, today.isoformat(), end.isoformat(), 'active', auto_renew, utcnow_naive().isoformat()),
         )
-    else:
-        exec_query(
-            "INSERT INTO subscriptions (user_id, plan_id, start_date, end_date, status, auto_renew) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, plan_id, today.isoformat(), end.isoformat(), 'active', auto_renew),
-        )
+        conn.commit()
+        return cur.lastrowid
+    finally:
+        conn.close()
 
 def create_payment(subscription_id, user_id, amount, status='paid', payment_method='credit_card'):
     now = utcnow_naive()
-    tax_amount = amount * 0.18
+    tax_amount = amount * GST_RATE
     total_amount = amount + tax_amount
     
     if column_exists('payments', 'payment_method') and column_exists('payments', 'tax_amount'):
@@ -962,27 +1945,145 @@ def create_payment(subscription_id, user_id, amount, status='paid', payment_meth
             (subscription_id, user_id, amount, now.isoformat(), status, now.month, now.year),
         )
 
+def get_billing_summary(user_id):
+    """Lifetime billing totals for a user from the materialized account balance"""
+    row = exec_query("SELECT * FROM account_balances WHERE user_id = ?", (user_id,), fetch=True)
+    summary = row_to_dict(row[0]) if row else {
+        'user_id': user_id, 'balance': 0.0, 'total_paid': 0.0, 'total_tax': 0.0, 'total_discount': 0.0,
+        'total_refunded': 0.0, 'paid_count': 0, 'failed_count': 0, 'last_payment_date': None, 'updated_date': None,
+    }
+    summary['average_payment'] = summary['total_paid'] / summary['paid_count'] if summary['paid_count'] else 0.0
+    return summary
+
+def get_billing_history(user_id, before=None, limit=BILLING_HISTORY_PAGE_SIZE):
+    """One page of a user's payments, newest first, seeking on (sort_key, id).
+
+    sort_key is payment_date with NULL as '', so undated payments come last and stay
+    reachable. Pass (sort_key, id) of the last row of the previous page as before to get
+    the next page.
+    """
+    query = """
+        SELECT p.id, p.amount, p.payment_date, p.status, p.bill_month, p.bill_year,
+               p.payment_method, p.transaction_id, p.tax_amount, p.discount,
+               s.start_date, s.end_date, pl.name AS plan_name, COALESCE(p.payment_date, '') AS sort_key
+        FROM payments p
+        LEFT JOIN subscriptions s ON p.subscription_id = s.id
+        LEFT JOIN plans pl ON s.plan_id = pl.id
+        WHERE p.user_id = ?
+    """
+    params = [user_id]
+    if before is not None:
+        # The plain bound lets SQLite seek idx_payments_user_seek; the row value alone would scan
+        query += " AND COALESCE(p.payment_date, '') <= ? AND (COALESCE(p.payment_date, ''), p.id) < (?, ?)"
+        params.extend((before[0], before[0], before[1]))
+    query += " ORDER BY COALESCE(p.payment_date, '') DESC, p.id DESC LIMIT ?"
+    params.append(limit)
+    return df_from_query(query, tuple(params))
+
+def get_monthly_payment_totals(user_id):
+    """Paid amount per month for a user, oldest first"""
+    return df_from_query(
+        "SELECT month, total_paid, paid_count FROM payment_monthly_totals WHERE user_id = ? AND paid_count > 0 ORDER BY month",
+        (user_id,),
+    )
+
+def rebuild_payment_monthly_totals():
+    """Recompute payment_monthly_totals from payments"""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM payment_monthly_totals")
+        conn.execute("""
+            INSERT INTO payment_monthly_totals (user_id, month, total_paid, paid_count)
+            SELECT user_id, substr(payment_date, 1, 7), SUM(amount), COUNT(*)
+            FROM payments WHERE status = 'paid' AND payment_date IS NOT NULL
+            GROUP BY user_id, substr(payment_date, 1, 7)
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_ledger_entries(user_id, limit=50):
+    """Most recent ledger entries for a user, newest first"""
+    return df_from_query(
+        "SELECT id, payment_id, entry_type, amount, balance_after, created_date FROM ledger_entries WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (user_id, limit),
+    )
+
+def rebuild_account_ledger():
+    """Post payments that have no ledger entries yet and recompute account_balances from payments"""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        entries = _LEDGER_ENTRIES_SQL.format(p='todo', src='FROM todo', cols='todo.user_id, todo.id AS payment_id, todo.payment_date, ')
+        posted = conn.execute(f'''
+            INSERT INTO ledger_entries (user_id, payment_id, entry_type, amount, balance_after, created_date)
+            WITH todo AS (
+                SELECT * FROM payments p
+                WHERE p.status IN ('paid', 'refunded')
+                  AND NOT EXISTS (SELECT 1 FROM ledger_entries l WHERE l.payment_id = p.id)
+            )
+            SELECT e.user_id, e.payment_id, e.entry_type, e.amount,
+                   COALESCE((SELECT l.balance_after FROM ledger_entries l WHERE l.user_id = e.user_id ORDER BY l.id DESC LIMIT 1), 0)
+                   + SUM(e.amount) OVER (PARTITION BY e.user_id ORDER BY e.payment_date, e.payment_id, e.seq),
+                   e.payment_date
+            FROM ({entries}) AS e
+            WHERE e.amount != 0
+            ORDER BY e.user_id, e.payment_date, e.payment_id, e.seq
+        ''').rowcount
+        conn.execute("DELETE FROM account_balances")
+        accounts = conn.execute(f'''
+            INSERT INTO account_balances (user_id, balance, total_paid, total_tax, total_discount, total_refunded,
+                                          paid_count, failed_count, last_payment_date, updated_date)
+            SELECT user_id, SUM(balance), SUM(total_paid), SUM(total_tax), SUM(total_discount), SUM(total_refunded),
+                   SUM(paid_count), SUM(failed_count), MAX(last_payment_date), ?
+            FROM (SELECT p.user_id, {_BALANCE_DELTA_SQL.format(p='p', failed="p.status = 'failed'")} FROM payments p)
+            GROUP BY user_id
+        ''', (utcnow_naive().isoformat(),)).rowcount
+        conn.commit()
+        return posted, accounts
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 def get_usage_for_user(user_id, days=30):
-    query = "SELECT date, data_used_gb"
-    if column_exists('usage', 'peak_hour_usage'):
-        query += ", peak_hour_usage, off_peak_usage"
-    if column_exists('usage', 'upload_usage'):
-        query += ", upload_usage, average_speed"
-    query += f" FROM usage WHERE user_id = ? ORDER BY date DESC LIMIT {days}"
-    
-    rows = exec_query(query, (user_id,), fetch=True)
-    if not rows:
+    # One connection for the column check, daily rows and packed months: opening a
+    # connection and loading the schema costs more than the reads themselves
+    conn = get_conn()
+    try:
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(usage)")}
+        query = "SELECT date, data_used_gb"
+        if 'peak_hour_usage' in columns:
+            query += ", peak_hour_usage, off_peak_usage"
+        if 'upload_usage' in columns:
+            query += ", upload_usage, average_speed"
+        query += f" FROM usage WHERE user_id = ? ORDER BY date DESC LIMIT {days}"
+
+        rows = conn.execute(query, (user_id,)).fetchall()
+        packed = read_packed_usage(user_id, days, conn=conn)
+    finally:
+        conn.close()
+    if not rows and packed.empty:
         return pd.DataFrame(columns=['date', 'data_used_gb'])
+    if not rows:
+        return packed
     cols = rows[0].keys()
     data = [tuple(r) for r in rows]
-    return pd.DataFrame(data, columns=cols)
+    df = pd.DataFrame(data, columns=cols)
+    if packed.empty:
+        return df
+    # Daily rows win over a packed day until the next pack_usage run folds them in
+    packed = packed.loc[~packed['date'].isin(df['date']), list(cols)]
+    return pd.concat([df, packed], ignore_index=True).sort_values('date', ascending=False).head(days).reset_index(drop=True)
 
 
 def get_user_notifications(user_id, limit=10, unread_only=False):
     """Get recent notifications for a user, optionally only unread ones"""
-    if not column_exists('notifications', 'created_date'):
-        return []
-    
     base_query = "SELECT * FROM notifications WHERE user_id = ?"
     params = [user_id]
     
@@ -997,8 +2098,63 @@ def get_user_notifications(user_id, limit=10, unread_only=False):
 
 def mark_notification_read(notification_id):
     """Mark a notification as read"""
-    if column_exists('notifications', 'is_read'):
-        exec_query("UPDATE notifications SET is_read = 1 WHERE id = ?", (notification_id,))
+    exec_query("UPDATE notifications SET is_read = 1 WHERE id = ? AND is_read = 0", (notification_id,))
+
+def mark_all_read(user_id, up_to_id=None):
+    """Mark every unread notification of a user with id <= up_to_id as read in one statement.
+
+    Pass the newest id the user has actually seen so messages arriving meanwhile stay unread.
+    """
+    conn = get_conn()
+    try:
+        if up_to_id is None:
+            cur = conn.execute("UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0", (user_id,))
+        else:
+            cur = conn.execute(
+                "UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0 AND id <= ?",
+                (user_id, up_to_id)
+            )
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+def get_unread_notification_count(user_id):
+    """Unread notification count from the per-user counter (single primary-key lookup)"""
+    r = exec_query("SELECT unread_count FROM notification_counters WHERE user_id = ?", (user_id,), fetch=True)
+    return r[0][0] if r else 0
+
+def rebuild_notification_counters():
+    """Recompute all unread counters from the notifications table"""
+    conn = get_conn()
+    try:
+        conn.execute("DELETE FROM notification_counters")
+        conn.execute("""
+            INSERT INTO notification_counters (user_id, unread_count)
+            SELECT user_id, COUNT(*) FROM notifications
+            WHERE is_read = 0 AND user_id IS NOT NULL
+            GROUP BY user_id
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_notification_history(user_id, before_id=None, limit=20):
+    """One page of a user's notifications, newest first, seeking on id.
+
+    Pass the smallest id of the previous page as before_id to get the next page.
+    """
+    if before_id is None:
+        rows = exec_query(
+            "SELECT * FROM notifications WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit), fetch=True
+        )
+    else:
+        rows = exec_query(
+            "SELECT * FROM notifications WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (user_id, before_id, limit), fetch=True
+        )
+    return [row_to_dict(r) for r in rows]
 
 def send_message_to_users(audience, message):
     """Send a message to selected users (active, inactive, or all)"""
@@ -1059,13 +2215,32 @@ def check_expiry_reminders(user_id):
     except:
         return []
 
+def comparison_set_key(plan_ids):
+    """(hash, canonical id list) of a plan set; order and repeats do not change it"""
+    canonical = ",".join(str(i) for i in sorted({int(i) for i in plan_ids}))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16], canonical
+
+
 def save_plan_comparison(user_id, plan_ids):
-    """Save plan comparison for user"""
-    if column_exists('plan_comparisons', 'created_date'):
-        exec_query(
-            "INSERT INTO plan_comparisons (user_id, plan_ids, created_date) VALUES (?, ?, ?)",
-            (user_id, ','.join(map(str, plan_ids)), utcnow_naive().isoformat())
-        )
+    """Count a saved comparison against its plan set and record it once in the user's history"""
+    set_hash, canonical = comparison_set_key(plan_ids)
+    now = utcnow_naive().isoformat()
+    conn = get_conn()
+    try:
+        conn.execute("""
+            INSERT INTO plan_comparison_sets (set_hash, plan_ids, hits, first_seen, last_seen)
+            VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT(set_hash) DO UPDATE SET hits = hits + 1, last_seen = excluded.last_seen
+        """, (set_hash, canonical, now, now))
+        # Saving the same set again only moves it to the top of the user's history
+        if not conn.execute("UPDATE plan_comparisons SET created_date = ? WHERE user_id = ? AND plan_ids = ?",
+                            (now, user_id, canonical)).rowcount:
+            conn.execute("INSERT INTO plan_comparisons (user_id, plan_ids, created_date) VALUES (?, ?, ?)",
+                         (user_id, canonical, now))
+        conn.commit()
+    finally:
+        conn.close()
+    return set_hash
 
 def get_plan_comparison_history(user_id, limit=5):
     """Get recent plan comparisons for user"""
@@ -1079,55 +2254,335 @@ def get_plan_comparison_history(user_id, limit=5):
     )
     return [row_to_dict(r) for r in rows]
 
-def bulk_create_plans_from_csv(csv_data):
-    """Create plans from CSV data"""
-    try:
-        df = pd.read_csv(io.StringIO(csv_data))
-        
-        # Expected columns: name, speed_mbps, data_limit_gb, price, validity_days, description, plan_type, features, upload_speed_mbps
-        required_columns = ['name', 'speed_mbps', 'data_limit_gb', 'price', 'validity_days', 'description']
-        
-        for col in required_columns:
-            if col not in df.columns:
-                return False, f"Missing required column: {col}"
-        
-        created_count = 0
-        for _, row in df.iterrows():
-            try:
-                # Check if plan already exists
-                existing = exec_query("SELECT id FROM plans WHERE name = ?", (row['name'],), fetch=True)
-                if existing:
-                    continue
-                
-                # Set default values for optional columns
-                plan_type = row.get('plan_type', 'standard')
-                features = row.get('features', '')
-                upload_speed = row.get('upload_speed_mbps', row['speed_mbps'] // 10)
-                is_unlimited = 1 if row.get('is_unlimited', '').lower() in ['true', '1', 'yes'] else 0
-                
-                if column_exists('plans', 'plan_type') and column_exists('plans', 'features'):
-                    exec_query(
-                        "INSERT INTO plans (name, speed_mbps, data_limit_gb, price, validity_days, description, plan_type, is_unlimited, features, upload_speed_mbps, created_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (row['name'], row['speed_mbps'], row['data_limit_gb'], row['price'], 
-                         row['validity_days'], row['description'], plan_type, is_unlimited, 
-                         features, upload_speed, utcnow_naive().isoformat())
-                    )
-                else:
-                    exec_query(
-                        "INSERT INTO plans (name, speed_mbps, data_limit_gb, price, validity_days, description) VALUES (?, ?, ?, ?, ?, ?)",
-                        (row['name'], row['speed_mbps'], row['data_limit_gb'], row['price'], row['validity_days'], row['description'])
-                    )
-                
-                created_count += 1
-                
-            except Exception as e:
-                print(f"Error creating plan from row: {e}")
-                continue
-        
-        return True, f"Successfully created {created_count} plans"
-        
+
+def plan_comparison_metrics(plans):
+    """Comparison metrics for N plans computed as arrays, one row per plan.
+
+    monthly_price normalises the price to 30 days of validity. price_per_gb is NaN for
+    unlimited plans and mbps_per_rupee for free ones. A plan is dominated when another plan
+    in the set costs no more per 30 days and has at least its download, upload and data,
+    and is better on at least one of them.
+    """
+    frame = pd.DataFrame(plans, columns=None if plans else ['id', 'name', 'price', 'speed_mbps', 'validity_days',
+                                                             'data_limit_gb', 'is_unlimited', 'plan_type'])
+    name = frame['name'].astype(str).to_numpy()
+    price = pd.to_numeric(frame['price'], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    speed = pd.to_numeric(frame['speed_mbps'], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    upload = (pd.to_numeric(frame['upload_speed_mbps'], errors='coerce').to_numpy(dtype=np.float64)
+              if 'upload_speed_mbps' in frame else np.full(len(frame), np.nan))
+    upload = np.where(np.isnan(upload), speed // 10, upload)
+    validity = pd.to_numeric(frame['validity_days'], errors='coerce').fillna(30).clip(lower=1).to_numpy(dtype=np.float64)
+    limit = pd.to_numeric(frame['data_limit_gb'], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    unlimited = (pd.to_numeric(frame.get('is_unlimited', 0), errors='coerce').fillna(0) != 0).to_numpy()
+    data = np.where(unlimited, np.inf, limit)
+    monthly_price = price * 30 / validity
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price_per_gb = np.where(~unlimited & (limit > 0), price / limit, np.nan)
+        mbps_per_rupee = np.where(price > 0, speed / price, np.nan)
+
+    # at_least[i, j]: plan i is no worse than plan j on every axis; better[i, j]: strictly better on one
+    axes = (-monthly_price, speed, upload, data)
+    at_least = np.logical_and.reduce([a[:, None] >= a[None, :] for a in axes])
+    better = np.logical_or.reduce([a[:, None] > a[None, :] for a in axes])
+    dominates = at_least & better
+    return pd.DataFrame({
+        'id': frame['id'].astype(np.int64).to_numpy(),
+        'name': name,
+        'plan_type': frame.get('plan_type', pd.Series('basic', index=frame.index)).fillna('basic').astype(str).to_numpy(),
+        'price': price,
+        'validity_days': validity.astype(np.int64),
+        'monthly_price': monthly_price,
+        'speed_mbps': speed,
+        'upload_mbps': upload,
+        'is_unlimited': unlimited,
+        'data_limit_gb': np.where(unlimited, np.nan, limit),
+        'price_per_gb': price_per_gb,
+        'mbps_per_rupee': mbps_per_rupee,
+        'dominated_by': [", ".join(name[dominates[:, j]]) for j in range(len(name))],
+    })
+
+
+_COMPARISON_CACHE = {}  # (set_hash, catalog version) -> metrics frame, oldest first
+
+
+def get_plan_comparison(plan_ids, monthly_gb=None):
+    """Comparison metrics for a plan set, in the order of plan_ids.
+
+    The plan-only metrics are cached per canonical set and plan catalog version: first in
+    process (COMPARISON_CACHE_SIZE sets, least recently used dropped), then in
+    plan_comparison_sets, so popular comparisons are computed once per catalog change.
+    With monthly_gb (the user's projected usage) it adds covers_usage and cost_for_usage:
+    the 30-day price times the packs needed to cover that usage on capped plans.
+    """
+    set_hash, canonical = comparison_set_key(plan_ids)
+    version = plan_catalog_version()
+    key = (set_hash, version)
+    metrics = _COMPARISON_CACHE.pop(key, None)
+    if metrics is None:
+        row = exec_query("SELECT metrics FROM plan_comparison_sets WHERE set_hash = ? AND catalog_version = ?",
+                         (set_hash, version), fetch=True)
+        if row and row[0][0]:
+            metrics = pd.read_json(io.StringIO(row[0][0]), orient='split')
+        else:
+            plans = [row_to_dict(r) for r in exec_query(
+                "SELECT * FROM plans WHERE id IN (SELECT value FROM json_each(?))", (f"[{canonical}]",), fetch=True)]
+            metrics = plan_comparison_metrics(plans)
+            exec_query("""
+                INSERT INTO plan_comparison_sets (set_hash, plan_ids, hits, catalog_version, metrics)
+                VALUES (?, ?, 0, ?, ?)
+                ON CONFLICT(set_hash) DO UPDATE SET catalog_version = excluded.catalog_version, metrics = excluded.metrics
+            """, (set_hash, canonical, version, metrics.to_json(orient='split', index=False)))
+    _COMPARISON_CACHE[key] = metrics
+    while len(_COMPARISON_CACHE) > COMPARISON_CACHE_SIZE:
+        _COMPARISON_CACHE.pop(next(iter(_COMPARISON_CACHE)))
+
+    row_of = {plan_id: i for i, plan_id in enumerate(metrics['id'].tolist())}
+    result = metrics.iloc[[row_of[i] for i in dict.fromkeys(int(i) for i in plan_ids) if i in row_of]]
+    if monthly_gb is None:
+        return result.reset_index(drop=True)
+    limit = result['data_limit_gb'].to_numpy(dtype=np.float64)
+    capped = ~result['is_unlimited'].to_numpy(dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        packs = np.where(capped, np.maximum(np.ceil(monthly_gb / limit), 1.0), 1.0)
+    packs[capped & ~(limit > 0)] = np.nan
+    return result.reset_index(drop=True).assign(
+        covers_usage=~capped | (limit >= monthly_gb),
+        cost_for_usage=result['monthly_price'].to_numpy() * packs,
+    )
+
+
+def get_popular_comparisons(limit=10):
+    """Most saved plan sets with their plan names, for the admin analytics"""
+    return df_from_query("""
+        SELECT s.hits AS saves,
+               (SELECT group_concat(p.name, ' vs ') FROM json_each('[' || s.plan_ids || ']') j
+                JOIN plans p ON p.id = j.value) AS plans,
+               s.first_seen, s.last_seen, s.set_hash
+        FROM plan_comparison_sets s
+        WHERE s.hits > 0
+        ORDER BY s.hits DESC
+        LIMIT ?
+    """, (limit,))
+
+
+def rebuild_plan_comparison_sets():
+    """Recount saves per plan set from the plan_comparisons history (which may hold unsorted lists)"""
+    counts = {}
+    for plan_ids, created in exec_query("SELECT plan_ids, created_date FROM plan_comparisons", fetch=True):
+        ids = [i for i in str(plan_ids or '').split(',') if i.strip().isdigit()]
+        if not ids:
+            continue
+        key = comparison_set_key(ids)
+        hits, first, last = counts.get(key, (0, created, created))
+        counts[key] = (hits + 1, min(first or created, created or first), max(last or created, created or last))
+    conn = get_conn()
+    try:
+        conn.execute("UPDATE plan_comparison_sets SET hits = 0")
+        conn.executemany("""
+            INSERT INTO plan_comparison_sets (set_hash, plan_ids, hits, first_seen, last_seen) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(set_hash) DO UPDATE SET hits = excluded.hits, first_seen = excluded.first_seen,
+                last_seen = excluded.last_seen
+        """, [(h, canonical, hits, first, last) for (h, canonical), (hits, first, last) in counts.items()])
+        conn.commit()
+    finally:
+        conn.close()
+    return len(counts)
+
+
+def projected_monthly_usage_gb(user_id):
+    """30 days at the user's average daily usage over the last 30 days, or None without usage"""
+    usage_df = get_usage_for_user(user_id, 30)
+    if usage_df.empty:
+        return None
+    return float(usage_df['data_used_gb'].mean() * 30)
+
+
+def benchmark_plan_comparison(plans=8, repeats=200):
+    """Time computing metrics for a set of the cheapest `plans` plans against cached lookups"""
+    plan_ids = [p['id'] for p in get_all_plans()[:plans]]
+    if not plan_ids:
+        return {'plans': 0}
+    catalog = [row_to_dict(r) for r in exec_query(
+        "SELECT * FROM plans WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(plan_ids),), fetch=True)]
+    started = time.perf_counter()
+    for _ in range(repeats):
+        plan_comparison_metrics(catalog)
+    compute_ms = (time.perf_counter() - started) / repeats * 1000
+    set_hash, _ = comparison_set_key(plan_ids)
+    _COMPARISON_CACHE.clear()
+    exec_query("UPDATE plan_comparison_sets SET catalog_version = NULL WHERE set_hash = ?", (set_hash,))
+    started = time.perf_counter()
+    get_plan_comparison(plan_ids, monthly_gb=150)
+    cold_ms = (time.perf_counter() - started) * 1000
+    _COMPARISON_CACHE.clear()
+    started = time.perf_counter()
+    get_plan_comparison(plan_ids, monthly_gb=150)
+    stored_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    for _ in range(repeats):
+        get_plan_comparison(plan_ids, monthly_gb=150)
+    cached_ms = (time.perf_counter() - started) / repeats * 1000
+    return {'plans': len(plan_ids), 'metrics_compute_ms': round(compute_ms, 3), 'cold_ms': round(cold_ms, 3),
+            'from_store_ms': round(stored_ms, 3), 'from_memory_ms': round(cached_ms, 3)}
+
+
+def coerce_plan_frame(df):
+    """Vectorized validation of an imported plan catalog; returns (clean rows, {row: error})"""
+    missing = [c for c in PLAN_IMPORT_REQUIRED if c not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required column: {', '.join(missing)}")
+    out = pd.DataFrame(index=df.index)
+    out['name'] = df['name'].fillna('').astype(str).str.strip()
+    for col in ('speed_mbps', 'data_limit_gb', 'price', 'validity_days', 'upload_speed_mbps'):
+        out[col] = pd.to_numeric(df[col], errors='coerce') if col in df else np.nan
+    out['upload_speed_mbps'] = out['upload_speed_mbps'].fillna(out['speed_mbps'] // 10)
+    for col, default in (('description', ''), ('plan_type', 'standard'), ('features', '')):
+        out[col] = df[col].fillna('').astype(str).str.strip() if col in df else ''
+        out[col] = out[col].replace('', default)
+    # Text flags ("yes", "True") and numbers (1, 1.0) both count as unlimited
+    flags = df['is_unlimited'] if 'is_unlimited' in df else pd.Series(0, index=df.index)
+    out['is_unlimited'] = (
+        flags.astype(str).str.strip().str.lower().isin(('true', 'yes', 'y', 't'))
+        | (pd.to_numeric(flags, errors='coerce').fillna(0) != 0)
+    ).astype(int)
+
+    checks = (
+        (out['name'] == '', "missing name"),
+        (~(out['speed_mbps'] > 0), "speed_mbps must be a positive number"),
+        (~(out['data_limit_gb'] >= 0), "data_limit_gb must be zero or more"),
+        (~(out['price'] >= 0), "price must be zero or more"),
+        (~(out['validity_days'] > 0), "validity_days must be a positive number"),
+        (out['name'].duplicated(keep='last') & (out['name'] != ''), "superseded by a later row with the same name"),
+    )
+    errors = {}
+    for failed, message in reversed(checks):
+        errors.update(dict.fromkeys(out.index[failed.to_numpy()], message))
+    out = out.drop(index=list(errors))
+    for col in ('speed_mbps', 'validity_days', 'upload_speed_mbps'):
+        out[col] = out[col].astype(np.int64)
+    return out, errors
+
+
+def diff_plan_catalog(df):
+    """Compare an imported catalog with the plans table, resolving every name in one query.
+
+    Returns a dict of DataFrames: insert (new names), update (existing plans whose values
+    differ, with their id and the changed columns), errors (CSV line, name, error), plus the
+    count of unchanged rows and the columns an update may set. Optional columns missing from
+    the CSV get defaults on new plans and are left alone on existing ones.
+    """
+    clean, errors = coerce_plan_frame(df)
+    fields = list(PLAN_IMPORT_COLUMNS)
+    compared = [col for col in fields[1:] if col in df.columns]
+    existing = df_from_query(
+        f"SELECT id, {', '.join(fields)} FROM plans WHERE name IN (SELECT value FROM json_each(?))",
+        (json.dumps(clean['name'].tolist()),),
+    )
+    if existing.empty:
+        existing = pd.DataFrame(columns=['id'] + fields)
+    for col in fields[1:]:
+        if pd.api.types.is_numeric_dtype(clean[col]):
+            existing[col] = pd.to_numeric(existing[col], errors='coerce')
+        else:
+            existing[col] = existing[col].fillna('').astype(str)
+    merged = clean.reset_index().merge(existing, on='name', how='left', suffixes=('', '_old'))
+    is_new = merged['id'].isna()
+    changed = pd.DataFrame({
+        col: ~((merged[col] == merged[f'{col}_old']) | (merged[col].isna() & merged[f'{col}_old'].isna()))
+        for col in compared
+    }, index=merged.index)
+    labels = np.full(len(merged), '', dtype=object)
+    for col in compared:
+        labels = labels + np.where(changed[col].to_numpy(), f"{col}, ", '')
+    merged['changed'] = pd.Series(labels, index=merged.index, dtype=object).str.rstrip(', ')
+    is_changed = ~is_new & changed.any(axis=1)
+    return {
+        'insert': merged.loc[is_new, fields].reset_index(drop=True),
+        'update': merged.loc[is_changed, ['id'] + fields + ['changed']].astype({'id': np.int64}).reset_index(drop=True),
+        'unchanged': int((~is_new & ~is_changed).sum()),
+        'columns': compared,
+        'errors': pd.DataFrame(
+            [(i + 2, '' if pd.isna(df.at[i, 'name']) else df.at[i, 'name'], msg) for i, msg in sorted(errors.items())],
+            columns=['line', 'name', 'error'],
+        ),
+    }
+
+
+def apply_plan_catalog(diff):
+    """Apply a diff_plan_catalog result: all inserts and updates in one transaction.
+
+    Rows are staged in a temp table and written with one INSERT ... SELECT and one
+    UPDATE ... FROM, so the plans triggers (search index, quotas, catalog version) run
+    inside a single statement each and plan caches see one new catalog version.
+    """
+    fields = list(PLAN_IMPORT_COLUMNS)
+    staged = pd.concat([diff['insert'].assign(id=None), diff['update'][['id'] + fields]], ignore_index=True)
+    conn = get_ingest_conn()
+    try:
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS plan_import_rows (id INTEGER, {', '.join(fields)})")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM plan_import_rows")
+            conn.executemany(
+                f"INSERT INTO plan_import_rows (id, {', '.join(fields)}) VALUES ({', '.join('?' * (len(fields) + 1))})",
+                zip(*([None if pd.isna(v) else int(v) for v in staged['id']],
+                      *(staged[col].tolist() for col in fields))),
+            )
+            conn.execute(f"""
+                INSERT INTO plans ({', '.join(fields)}, created_date)
+                SELECT {', '.join(fields)}, ? FROM plan_import_rows WHERE id IS NULL ORDER BY rowid
+            """, (utcnow_naive().isoformat(),))
+            conn.execute(f"""
+                UPDATE plans SET {', '.join(f'{col} = i.{col}' for col in diff['columns'])}
+                FROM plan_import_rows i WHERE plans.id = i.id
+            """)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+    return {'created': len(diff['insert']), 'updated': len(diff['update']), 'unchanged': diff['unchanged'],
+            'rejected': len(diff['errors']), 'catalog_version': plan_catalog_version()}
+
+
+def bulk_create_plans_from_csv(csv_data):
+    """Create new plans and update existing ones (matched by name) from CSV data"""
+    try:
+        result = apply_plan_catalog(diff_plan_catalog(pd.read_csv(io.StringIO(csv_data))))
     except Exception as e:
         return False, f"Error processing CSV: {str(e)}"
+    return True, (f"Created {result['created']} plans, updated {result['updated']}, "
+                  f"{result['unchanged']} unchanged, {result['rejected']} rejected")
+
+
+def benchmark_plan_import(plans=20000, changed_fraction=0.1):
+    """Import a synthetic regional catalog, then re-import it with some prices changed"""
+    rng = np.random.default_rng(0)
+    tag = uuid.uuid4().hex[:6]
+    speeds = rng.choice([50, 100, 200, 300, 500, 1000], plans)
+    catalog = pd.DataFrame({
+        'name': [f"Regional {tag} {i}" for i in range(plans)],
+        'speed_mbps': speeds,
+        'data_limit_gb': rng.choice([100, 250, 500, 1000, 0], plans),
+        'price': rng.integers(3, 40, plans) * 50,
+        'validity_days': 30,
+        'description': [f"{s} Mbps plan for region {i % 500}" for i, s in enumerate(speeds)],
+        'plan_type': rng.choice(['basic', 'standard', 'premium', 'business'], plans),
+        'is_unlimited': rng.choice(['no', 'yes', 0, 1], plans),
+    })
+    timings = {}
+    for label in ('first', 'second'):
+        started = time.perf_counter()
+        diff = diff_plan_catalog(catalog)
+        diffed = time.perf_counter()
+        result = apply_plan_catalog(diff)
+        timings[f'{label}_diff_seconds'] = round(diffed - started, 3)
+        timings[f'{label}_apply_seconds'] = round(time.perf_counter() - diffed, 3)
+        timings[f'{label}_result'] = f"{result['created']} created, {result['updated']} updated, {result['unchanged']} unchanged"
+        repriced = rng.random(plans) < changed_fraction
+        catalog.loc[repriced, 'price'] += 50
+    return {'plans': plans, **timings}
 
 
 def transfer_user_to_admin(user_id):
@@ -1668,6 +3123,47 @@ def admin_delete_user(user_id):
     exec_query("DELETE FROM users WHERE id = ?", (user_id,))
     return True, "User deleted."
 
+def get_users_page(filters=None, sort='Newest', after=None, limit=USER_PAGE_SIZES[0]):
+    """One page of the admin user grid, seeking on (sort key, id) instead of OFFSET.
+
+    filters may hold role, city, state, active (True: has an active subscription, False: has
+    none), signup_from and signup_to (dates, inclusive). Pass the sort_key and id of the last
+    row of the previous page as after to get the next page. limit is capped at the largest
+    USER_PAGE_SIZES entry.
+    """
+    filters = filters or {}
+    key, descending = USER_GRID_SORTS[sort]
+    # City and signup filters are written like the index expressions so the grid indexes apply
+    where, params = [], []
+    for col, expr in (('role', "u.role"), ('city', "COALESCE(u.city, '')"), ('state', "u.state")):
+        if filters.get(col):
+            where.append(f"{expr} = ?")
+            params.append(filters[col])
+    if filters.get('active') is not None:
+        where.append(f"u.id {'' if filters['active'] else 'NOT '}IN (SELECT user_id FROM subscriptions WHERE status = 'active')")
+    if filters.get('signup_from'):
+        where.append("COALESCE(u.signup_date, '') >= ?")
+        params.append(str(filters['signup_from']))
+    if filters.get('signup_to'):
+        where.append("COALESCE(u.signup_date, '') < ?")
+        params.append(str(pd.Timestamp(filters['signup_to']).date() + timedelta(days=1)))
+    if after is not None:
+        # The plain bound lets SQLite seek the index; the row value alone would make it scan
+        op = '<' if descending else '>'
+        where.append(f"{key} {op}= ? AND ({key}, u.id) {op} (?, ?)")
+        params.extend((after[0], after[0], after[1]))
+    direction = "DESC" if descending else "ASC"
+    params.append(min(int(limit), max(USER_PAGE_SIZES)))
+    return df_from_query(f"""
+        SELECT u.id, u.username, u.name, u.email, u.role, u.city, u.state, u.signup_date,
+               EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = u.id AND s.status = 'active') AS active,
+               {key} AS sort_key
+        FROM users u
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY {key} {direction}, u.id {direction}
+        LIMIT ?
+    """, tuple(params))
+
 def admin_create_plan(name, speed_mbps, data_limit_gb, price, validity_days, description='', plan_type='basic', is_unlimited=0, features='', upload_speed_mbps=None):
     existing = exec_query("SELECT id FROM plans WHERE name = ?", (name,), fetch=True)
     if existing:
@@ -1706,45 +3202,3849 @@ def admin_update_plan(plan_id, **kwargs):
     exec_query(f"UPDATE plans SET {', '.join(sets)} WHERE id = ?", tuple(vals))
     return True, "Plan updated."
 
-def admin_delete_plan(plan_id):
-    deps = exec_query("SELECT COUNT(*) FROM subscriptions WHERE plan_id = ?", (plan_id,), fetch=True)[0][0]
-    if deps and deps > 0:
-        return False, "Cannot delete: plan is referenced in subscriptions."
-    exec_query("DELETE FROM plans WHERE id = ?", (plan_id,))
-    return True, "Plan deleted."
+def admin_delete_plan(plan_id):
+    deps = exec_query("SELECT COUNT(*) FROM subscriptions WHERE plan_id = ?", (plan_id,), fetch=True)[0][0]
+    if deps and deps > 0:
+        return False, "Cannot delete: plan is referenced in subscriptions."
+    exec_query("DELETE FROM plans WHERE id = ?", (plan_id,))
+    return True, "Plan deleted."
+
+def admin_send_message(message, target="all"):
+    """
+    Send a custom message from admin to users.
+    target: "all", "active", "inactive"
+    """
+    now = utcnow_naive().isoformat()
+
+    if target == "all":
+        user_rows = exec_query("SELECT id FROM users WHERE role = 'user'", fetch=True)
+    elif target == "active":
+        user_rows = exec_query("""
+            SELECT DISTINCT u.id 
+            FROM users u
+            JOIN subscriptions s ON u.id = s.user_id
+            WHERE u.role = 'user' AND s.status = 'active'
+        """, fetch=True)
+    elif target == "inactive":
+        user_rows = exec_query("""
+            SELECT id FROM users
+            WHERE role = 'user' AND id NOT IN (
+                SELECT user_id FROM subscriptions WHERE status = 'active'
+            )
+        """, fetch=True)
+    else:
+        return False, "Invalid target"
+
+    for row in user_rows:
+        exec_query(
+            "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, ?, ?)",
+            (row[0], message, "admin_broadcast", now)
+        )
+    return True, f"Message sent to {len(user_rows)} users."
+
+# ---------------------------
+# Notification Delivery (Email / SMS)
+# ---------------------------
+class RateLimiter:
+    """Thread-safe token bucket shared by every worker sending on one channel"""
+    def __init__(self, rate_per_sec, burst=None):
+        self.rate = float(rate_per_sec) if rate_per_sec else None
+        self.capacity = float(burst or max(1.0, self.rate or 1.0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DeliveryStats:
+    """Counters and latency samples collected by the delivery workers"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.failed = {}
+        self.latencies = []
+        self.started = time.perf_counter()
+
+    def record(self, channel, latencies, failed_count):
+        with self.lock:
+            self.sent[channel] = self.sent.get(channel, 0) + len(latencies)
+            self.failed[channel] = self.failed.get(channel, 0) + failed_count
+            self.latencies.extend(latencies)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        total_sent = sum(self.sent.values())
+        lat = np.asarray(self.latencies, dtype=float)
+        return {
+            'sent': total_sent,
+            'failed': sum(self.failed.values()),
+            'sent_by_channel': dict(self.sent),
+            'failed_by_channel': dict(self.failed),
+            'elapsed_seconds': round(elapsed, 3),
+            'messages_per_second': round(total_sent / elapsed, 1) if elapsed > 0 else 0.0,
+            'latency_p50_seconds': round(float(np.percentile(lat, 50)), 3) if lat.size else None,
+            'latency_p95_seconds': round(float(np.percentile(lat, 95)), 3) if lat.size else None,
+            'latency_p99_seconds': round(float(np.percentile(lat, 99)), 3) if lat.size else None,
+        }
+
+
+class _SmtpSinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue (HELO/EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT)"""
+    def _reply(self, text):
+        self.wfile.write((text + "\r\n").encode())
+
+    def handle(self):
+        self._reply("220 trailblazer-sink ESMTP")
+        mail_from, rcpts = "", []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self._reply("250 trailblazer-sink")
+            elif verb == 'MAIL':
+                mail_from, rcpts = command.partition(':')[2].strip(' <>'), []
+                self._reply("250 OK")
+            elif verb == 'RCPT':
+                rcpts.append(command.partition(':')[2].strip(' <>'))
+                self._reply("250 OK")
+            elif verb == 'DATA':
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                chunks = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    chunks.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                self.server.sink.store(mail_from, rcpts, b"".join(chunks))
+                self._reply("250 OK: queued")
+            elif verb == 'RSET':
+                mail_from, rcpts = "", []
+                self._reply("250 OK")
+            elif verb == 'NOOP':
+                self._reply("250 OK")
+            elif verb == 'QUIT':
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class LocalSmtpSink:
+    """Local stand-in for an SMTP relay: accepts mail on localhost and appends it to an mbox file"""
+    def __init__(self, mbox_path, host='127.0.0.1', port=0):
+        self.mbox_path = mbox_path
+        self.host = host
+        self.port = port
+        self.received = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.fh = None
+
+    def start(self):
+        self.fh = open(self.mbox_path, 'ab')
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), _SmtpSinkHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def store(self, mail_from, rcpts, data):
+        envelope = f"From {mail_from or 'MAILER-DAEMON'} {time.asctime()}\n".encode()
+        with self.lock:
+            self.fh.write(envelope + data.replace(b"\r\n", b"\n") + b"\n")
+            self.received += 1
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.fh:
+            self.fh.close()
+
+
+class SmtpEmailTransport:
+    """Sends email notifications over SMTP, keeping one connection open per worker thread"""
+    def __init__(self, host, port=25, sender="noreply@trailblazer.local"):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = smtplib.SMTP(self.host, self.port, timeout=10)
+            self._local.client = client
+        return client
+
+    def send(self, delivery):
+        body = (
+            f"From: Trailblazer Broadband <{self.sender}>\r\n"
+            f"To: {delivery['recipient']}\r\n"
+            f"Subject: Trailblazer Broadband notification\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n\r\n"
+            f"{delivery['message']}\r\n"
+        )
+        try:
+            self._client().sendmail(self.sender, [delivery['recipient']], body.encode('utf-8'))
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self._local.client = None
+            raise
+
+    def close(self):
+        client = getattr(self._local, 'client', None)
+        if client is not None:
+            try:
+                client.quit()
+            except Exception:
+                pass
+            self._local.client = None
+
+
+class FileSmsSink:
+    """Local stand-in for an SMS gateway: appends one JSON line per message"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fh = open(path, 'a', encoding='utf-8')
+
+    def send(self, delivery):
+        line = json.dumps({
+            'to': delivery['recipient'],
+            'text': delivery['message'],
+            'sent_at': datetime.utcnow().isoformat(),
+        })
+        with self.lock:
+            self.fh.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.fh.flush()
+
+
+def default_delivery_transports():
+    """Transports used when none are given: SMTP_HOST if configured, otherwise local sinks in DELIVERY_SINK_DIR.
+
+    Returns (transports, sinks); the caller stops the sinks when done.
+    """
+    os.makedirs(DELIVERY_SINK_DIR, exist_ok=True)
+    sinks = []
+    if os.environ.get('SMTP_HOST'):
+        email = SmtpEmailTransport(os.environ['SMTP_HOST'], int(os.environ.get('SMTP_PORT', 25)))
+    else:
+        sink = LocalSmtpSink(os.path.join(DELIVERY_SINK_DIR, 'email.mbox')).start()
+        sinks.append(sink)
+        email = SmtpEmailTransport(sink.host, sink.port)
+    sms = FileSmsSink(os.path.join(DELIVERY_SINK_DIR, 'sms.jsonl'))
+    return {'email': email, 'sms': sms}, sinks
+
+
+def enqueue_notification_deliveries(batch_size=5000):
+    """Fan new notifications out into the outbox, one row per channel in the user's preferences.
+
+    Progress is tracked with a notification id watermark in meta, so each run only reads new rows.
+    """
+    recipient_columns = {'email': 'u.email', 'sms': 'u.phone'}
+    conn = get_conn()
+    try:
+        row = conn.execute("SELECT v FROM meta WHERE k = ?", (NOTIFICATION_OUTBOX_WATERMARK,)).fetchone()
+        last_id = int(row[0]) if row else 0
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM notifications").fetchone()[0]
+        queued = 0
+        while last_id < max_id:
+            upper = min(last_id + batch_size, max_id)
+            now = datetime.utcnow().isoformat()
+            for channel in NOTIFICATION_CHANNELS:
+                col = recipient_columns[channel]
+                cur = conn.execute(f"""
+                    INSERT OR IGNORE INTO notification_outbox
+                        (notification_id, user_id, channel, recipient, message, status, attempts, next_attempt_at, created_date)
+                    SELECT n.id, n.user_id, ?, {col}, n.message, 'queued', 0, ?, ?
+                    FROM notifications n
+                    JOIN users u ON u.id = n.user_id
+                    WHERE n.id > ? AND n.id <= ?
+                      AND ',' || REPLACE(COALESCE(u.notification_preferences, ''), ' ', '') || ',' LIKE ?
+                      AND COALESCE({col}, '') != ''
+                """, (channel, now, now, last_id, upper, f"%,{channel},%"))
+                queued += cur.rowcount
+            conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)", (NOTIFICATION_OUTBOX_WATERMARK, str(upper)))
+            conn.commit()
+            last_id = upper
+        return queued
+    finally:
+        conn.close()
+
+
+def requeue_stale_deliveries(lease_seconds=DELIVERY_LEASE_SECONDS):
+    """Hand 'sending' rows claimed by a worker that died back to the queue"""
+    cutoff = (datetime.utcnow() - timedelta(seconds=lease_seconds)).isoformat()
+    conn = get_conn()
+    try:
+        cur = conn.execute(
+            "UPDATE notification_outbox SET status = 'queued', claimed_by = NULL WHERE status = 'sending' AND claimed_at < ?",
+            (cutoff,)
+        )
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def claim_delivery_batch(conn, worker_id, channel, batch_size=200):
+    """Atomically claim up to batch_size due messages on one channel for this worker"""
+    now = datetime.utcnow().isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    rows = conn.execute("""
+        UPDATE notification_outbox
+        SET status = 'sending', claimed_by = ?, claimed_at = ?
+        WHERE id IN (
+            SELECT id FROM notification_outbox
+            WHERE status = 'queued' AND channel = ? AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        )
+        RETURNING id, user_id, channel, recipient, message, attempts, created_date
+    """, (worker_id, now, channel, now, batch_size)).fetchall()
+    conn.commit()
+    return [row_to_dict(r) for r in rows]
+
+
+def _delivery_backoff(attempts):
+    return min(DELIVERY_BACKOFF_MAX_SECONDS, DELIVERY_BACKOFF_SECONDS * (2 ** max(0, attempts - 1)))
+
+
+def _finish_delivery_batch(conn, sent, failed):
+    """Record the outcome of one claimed batch in a single transaction"""
+    now = datetime.utcnow()
+    if sent:
+        conn.executemany(
+            "UPDATE notification_outbox SET status = 'sent', sent_date = ?, attempts = attempts + 1 WHERE id = ?",
+            [(now.isoformat(), d['id']) for d in sent]
+        )
+    if failed:
+        params = []
+        for d, error in failed:
+            attempts = d['attempts'] + 1
+            status = 'dead' if attempts >= DELIVERY_MAX_ATTEMPTS else 'queued'
+            next_at = (now + timedelta(seconds=_delivery_backoff(attempts))).isoformat()
+            params.append((status, attempts, next_at, error[:500], d['id']))
+        conn.executemany(
+            "UPDATE notification_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, claimed_by = NULL WHERE id = ?",
+            params
+        )
+    conn.commit()
+
+
+def _delivery_worker(worker_id, transports, limiters, stats, stop_event, batch_size, drain, poll_interval):
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    try:
+        while not stop_event.is_set():
+            claimed = 0
+            for channel, transport in transports.items():
+                batch = claim_delivery_batch(conn, worker_id, channel, batch_size)
+                if not batch:
+                    continue
+                claimed += len(batch)
+                sent, failed, latencies = [], [], []
+                for delivery in batch:
+                    limiters[channel].acquire()
+                    try:
+                        transport.send(delivery)
+                    except Exception as e:
+                        failed.append((delivery, str(e) or e.__class__.__name__))
+                        continue
+                    sent.append(delivery)
+                    latencies.append((datetime.utcnow() - datetime.fromisoformat(delivery['created_date'])).total_seconds())
+                _finish_delivery_batch(conn, sent, failed)
+                stats.record(channel, latencies, len(failed))
+            if not claimed:
+                if drain:
+                    break
+                stop_event.wait(poll_interval)
+    finally:
+        for transport in transports.values():
+            if isinstance(transport, SmtpEmailTransport):
+                transport.close()
+        conn.close()
+
+
+def run_notification_delivery(workers=4, batch_size=200, transports=None, rate_limits=None,
+                              drain=True, poll_interval=1.0, stop_event=None):
+    """Deliver queued notifications with a pool of worker threads.
+
+    Each worker claims batches per channel, respects the shared per-channel rate limit,
+    and retries failures with exponential backoff. With drain=True the pool exits once
+    nothing is due; otherwise it polls until stop_event is set. Returns delivery metrics.
+    """
+    queued = enqueue_notification_deliveries()
+    requeue_stale_deliveries()
+
+    sinks = []
+    if transports is None:
+        transports, sinks = default_delivery_transports()
+    rate_limits = DELIVERY_RATE_LIMITS if rate_limits is None else rate_limits
+    limiters = {ch: RateLimiter(rate_limits.get(ch)) for ch in transports}
+    stats = DeliveryStats()
+    stop_event = stop_event or threading.Event()
+
+    threads = [
+        threading.Thread(
+            target=_delivery_worker,
+            args=(f"worker-{os.getpid()}-{i}", transports, limiters, stats, stop_event, batch_size, drain, poll_interval),
+            daemon=True,
+        )
+        for i in range(workers)
+    ]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        for transport in transports.values():
+            if isinstance(transport, FileSmsSink):
+                transport.close()
+        for sink in sinks:
+            sink.stop()
+    summary = stats.summary()
+    summary['queued'] = queued
+    return summary
+
+
+def get_delivery_queue_stats():
+    """Outbox row counts by channel and status"""
+    return df_from_query("""
+        SELECT channel, status, COUNT(*) AS count
+        FROM notification_outbox
+        GROUP BY channel, status
+        ORDER BY channel, status
+    """)
+
+
+def benchmark_notification_delivery(messages=200000, workers=8, batch_size=500, sms_share=0.3):
+    """Seed synthetic outbox rows and push them through the local sinks with no rate limit"""
+    now = datetime.utcnow().isoformat()
+    n_sms = int(messages * sms_share)
+    rows = [
+        (None, 0, 'sms' if i < n_sms else 'email',
+         f"+9190000{i:05d}" if i < n_sms else f"bench{i}@example.com",
+         f"Benchmark message {i}", 'queued', 0, now, now)
+        for i in range(messages)
+    ]
+    conn = get_conn()
+    conn.executemany(
+        "INSERT INTO notification_outbox (notification_id, user_id, channel, recipient, message, status, attempts, next_attempt_at, created_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+    conn.close()
+    return run_notification_delivery(
+        workers=workers, batch_size=batch_size,
+        rate_limits={ch: None for ch in NOTIFICATION_CHANNELS},
+    )
+
+# ---------------------------
+# Billing Run (auto-renewal)
+# ---------------------------
+def compute_renewal_charges(prices, renewal_counts):
+    """Vectorized GST and loyalty discount for a batch of renewals.
+
+    Returns (tax, discount, total) arrays rounded to paise.
+    """
+    prices = np.asarray(prices, dtype=float)
+    renewal_counts = np.asarray(renewal_counts, dtype=int)
+    tax = np.round(prices * GST_RATE, 2)
+    discount = np.round(np.where(renewal_counts > 0, prices * LOYALTY_DISCOUNT_RATE, 0.0), 2)
+    total = np.round(prices + tax - discount, 2)
+    return tax, discount, total
+
+
+_RENEWAL_DUE_QUERY = """
+    SELECT s.id, s.user_id, s.plan_id, s.end_date, COALESCE(s.renewal_count, 0) AS renewal_count,
+           COALESCE(u.is_autopay_enabled, 0) AS autopay, p.name AS plan_name, p.price, p.validity_days
+    FROM subscriptions s
+    JOIN users u ON u.id = s.user_id
+    JOIN plans p ON p.id = s.plan_id
+    WHERE s.status = 'active' AND s.auto_renew = 1
+      AND s.end_date < ? AND s.id > ? AND s.id <= ?
+    ORDER BY s.id
+    LIMIT ?
+"""
+
+
+def count_subscriptions_due(as_of=None):
+    """Number of auto-renewing subscriptions whose period ends on or before as_of"""
+    as_of = pd.Timestamp(as_of or datetime.utcnow()).normalize()
+    cutoff = (as_of + pd.Timedelta(days=1)).date().isoformat()
+    return exec_query(
+        "SELECT COUNT(*) FROM subscriptions WHERE status = 'active' AND auto_renew = 1 AND end_date < ?",
+        (cutoff,), fetch=True
+    )[0][0]
+
+
+def _renew_chunk(conn, run_id, due, now, checkpoint_id, charge_status=None):
+    """Bill one chunk of due subscriptions; the caller holds the write transaction.
+
+    charge_status holds gateway outcomes ('paid'/'failed') for the chunk's autopay rows;
+    without it autopay renewals are recorded as paid.
+    """
+    renewal_counts = due['renewal_count'].to_numpy() + 1
+    tax, discount, total = compute_renewal_charges(due['price'].to_numpy(), renewal_counts)
+    starts = pd.to_datetime(due['end_date'], format='ISO8601').dt.normalize()
+    ends = starts + pd.to_timedelta(due['validity_days'].fillna(30).astype(int), unit='D')
+
+    # Ids are assigned here so payments can reference the new subscriptions in one executemany
+    first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM subscriptions").fetchone()[0]
+    new_ids = np.arange(first_id, first_id + len(due))
+    now_iso = now.isoformat()
+    start_iso = starts.dt.strftime('%Y-%m-%d').tolist()
+    end_iso = ends.dt.strftime('%Y-%m-%d').tolist()
+    old_ids = due['id'].tolist()
+    user_ids = due['user_id'].tolist()
+    autopay = due['autopay'].to_numpy() == 1
+    # Autopay users are charged now; everyone else is renewed with an invoice to settle
+    charged = np.full(len(due), 'paid', dtype=object) if charge_status is None else np.asarray(charge_status, dtype=object)
+    pay_status = np.where(autopay, charged, 'pending').tolist()
+    pay_method = np.where(autopay, 'autopay', 'invoice').tolist()
+
+    conn.executemany(
+        "UPDATE subscriptions SET status = 'expired' WHERE id = ?",
+        [(sid,) for sid in old_ids]
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (id, user_id, plan_id, start_date, end_date, status, auto_renew, created_date, renewal_count) VALUES (?, ?, ?, ?, ?, 'active', 1, ?, ?)",
+        zip(new_ids.tolist(), user_ids, due['plan_id'].tolist(), start_iso, end_iso,
+            [now_iso] * len(due), renewal_counts.tolist())
+    )
+    conn.executemany(
+        "INSERT INTO payments (subscription_id, user_id, amount, payment_date, status, payment_method, bill_month, bill_year, tax_amount, discount, transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        zip(new_ids.tolist(), user_ids, total.tolist(), [now_iso] * len(due), pay_status, pay_method,
+            starts.dt.month.tolist(), starts.dt.year.tolist(), tax.tolist(), discount.tolist(),
+            [f"REN{sid:010d}" for sid in old_ids])
+    )
+    conn.executemany(
+        "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, 'subscription_renewed', ?)",
+        [(uid, f"Your {plan} plan has been renewed until {end}. " + {
+            'paid': f"₹{amt:,.2f} was charged via autopay.",
+            'failed': f"Your autopay charge of ₹{amt:,.2f} did not go through; we will retry it shortly.",
+            'pending': f"An invoice of ₹{amt:,.2f} is due.",
+        }[status], now_iso)
+         for uid, plan, end, amt, status in zip(user_ids, due['plan_name'].tolist(), end_iso, total.tolist(), pay_status)]
+    )
+    conn.execute(
+        "UPDATE billing_runs SET last_subscription_id = ?, renewed = renewed + ?, billed_amount = billed_amount + ? WHERE id = ?",
+        (int(checkpoint_id), len(due), float(total.sum()), run_id)
+    )
+    return float(total.sum())
+
+
+def _record_unapplied_charges(conn, dropped, amounts, charge_status, prefix, plan_names, now):
+    """Record gateway captures for rows dropped after charging; the caller holds the write transaction.
+
+    A subscription cancelled or changed between the charge and the chunk's transaction
+    has still been charged. Unless a concurrent run already recorded the same
+    transaction id, the capture is posted as a paid payment against the original
+    subscription, so it lands on the ledger as account credit, and the user is told.
+    Only autopay rows with a positive amount went to the gateway; the 'paid' status
+    of the others is just the charge helpers' default. Returns the number recorded.
+    """
+    captured = ((np.asarray(charge_status, dtype=object) == 'paid') & (dropped['autopay'].to_numpy() == 1)
+                & (np.asarray(amounts) > 0))
+    if not captured.any():
+        return 0
+    sub_ids = dropped['id'].to_numpy()[captured].tolist()
+    txn_ids = [f"{prefix}{sid:010d}" for sid in sub_ids]
+    placeholders = ",".join(["?"] * len(txn_ids))
+    recorded = {r[0] for r in conn.execute(
+        f"SELECT transaction_id FROM payments WHERE transaction_id IN ({placeholders})", txn_ids
+    )}
+    rows = [
+        (sid, uid, float(amt), txn, plan)
+        for sid, uid, amt, txn, plan in zip(sub_ids, dropped['user_id'].to_numpy()[captured].tolist(),
+                                            np.asarray(amounts)[captured].tolist(), txn_ids,
+                                            np.asarray(plan_names, dtype=object)[captured].tolist())
+        if txn not in recorded
+    ]
+    now_iso = now.isoformat()
+    conn.executemany(
+        "INSERT INTO payments (subscription_id, user_id, amount, payment_date, status, payment_method, bill_month, bill_year, transaction_id) VALUES (?, ?, ?, ?, 'paid', 'autopay', ?, ?, ?)",
+        [(sid, uid, amt, now_iso, now.month, now.year, txn) for sid, uid, amt, txn, _ in rows]
+    )
+    conn.executemany(
+        "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, 'payment_credit', ?)",
+        [(uid, f"₹{amt:,.2f} was charged for your {plan} plan after the subscription changed. "
+               f"It is held as credit on your account.", now_iso)
+         for _, uid, amt, _, plan in rows]
+    )
+    return len(rows)
+
+
+def run_billing(as_of=None, chunk_size=BILLING_CHUNK_SIZE, gateway_url=None):
+    """Renew every auto-renewing subscription due on or before as_of.
+
+    Each chunk (expiry of the old period, new subscription, payment, notification and
+    checkpoint) commits as one transaction, so a crashed run can be re-run for the same
+    date and resumes after the last committed chunk without billing anyone twice.
+    When a gateway is configured the chunk's autopay charges run concurrently before
+    the transaction opens; their idempotency keys come from the deterministic REN
+    transaction ids, so charges repeated after a crash are not taken twice. Charges
+    captured for subscriptions that stopped being due meanwhile are still recorded.
+    """
+    gateway_url = gateway_url or get_payment_gateway_url()
+    as_of = pd.Timestamp(as_of or datetime.utcnow()).normalize()
+    as_of_iso = as_of.date().isoformat()
+    cutoff = (as_of + pd.Timedelta(days=1)).date().isoformat()
+    now = datetime.utcnow()
+
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    try:
+        run = conn.execute(
+            "SELECT id, last_subscription_id, max_subscription_id FROM billing_runs WHERE as_of = ? AND status = 'running' ORDER BY id DESC LIMIT 1",
+            (as_of_iso,)
+        ).fetchone()
+        if run:
+            run_id, checkpoint, max_sub_id = run[0], run[1], run[2]
+        else:
+            max_sub_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM subscriptions").fetchone()[0]
+            cur = conn.execute(
+                "INSERT INTO billing_runs (as_of, status, started_date, max_subscription_id) VALUES (?, 'running', ?, ?)",
+                (as_of_iso, now.isoformat(), max_sub_id)
+            )
+            run_id, checkpoint = cur.lastrowid, 0
+            conn.commit()
+
+        started = time.perf_counter()
+        renewed, billed, unapplied = 0, 0.0, 0
+        while True:
+            rows = conn.execute(_RENEWAL_DUE_QUERY, (cutoff, checkpoint, max_sub_id, chunk_size)).fetchall()
+            if not rows:
+                conn.execute(
+                    "UPDATE billing_runs SET status = 'completed', finished_date = ? WHERE id = ?",
+                    (datetime.utcnow().isoformat(), run_id)
+                )
+                conn.commit()
+                break
+            due = pd.DataFrame([tuple(r) for r in rows], columns=rows[0].keys())
+            chunk_checkpoint = int(due['id'].max())
+            charge_status = None
+            if gateway_url:
+                charge_status = _charge_renewals(due, gateway_url)
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another writer may have cancelled or renewed some of these meanwhile
+                placeholders = ",".join(["?"] * len(due))
+                still_active = {r[0] for r in conn.execute(
+                    f"SELECT id FROM subscriptions WHERE status = 'active' AND id IN ({placeholders})",
+                    tuple(due['id'].tolist())
+                )}
+                keep = due['id'].isin(still_active).to_numpy()
+                if charge_status is not None:
+                    if not keep.all():
+                        _, _, total = compute_renewal_charges(due['price'].to_numpy(), due['renewal_count'].to_numpy() + 1)
+                        unapplied += _record_unapplied_charges(conn, due[~keep], total[~keep], charge_status[~keep],
+                                                               "REN", due['plan_name'][~keep], now)
+                    charge_status = charge_status[keep]
+                due = due[keep].reset_index(drop=True)
+                if due.empty:
+                    conn.execute("UPDATE billing_runs SET last_subscription_id = ? WHERE id = ?", (chunk_checkpoint, run_id))
+                else:
+                    billed += _renew_chunk(conn, run_id, due, now, chunk_checkpoint, charge_status)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            renewed += len(due)
+            checkpoint = chunk_checkpoint
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+
+    return {
+        'run_id': run_id,
+        'as_of': as_of_iso,
+        'renewed': renewed,
+        'billed_amount': round(billed, 2),
+        'unapplied_charges': unapplied,
+        'elapsed_seconds': round(elapsed, 3),
+        'subscriptions_per_second': round(renewed / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+def _charge_renewals(due, gateway_url):
+    """Charge a chunk's autopay renewals through the gateway; returns 'paid'/'failed' per row"""
+    status = np.full(len(due), 'paid', dtype=object)
+    autopay = due['autopay'].to_numpy() == 1
+    if not autopay.any():
+        return status
+    _, _, total = compute_renewal_charges(due['price'].to_numpy(), due['renewal_count'].to_numpy() + 1)
+    charges = [
+        {'transaction_id': f"REN{sid:010d}", 'user_id': int(uid), 'amount': float(amt)}
+        for sid, uid, amt in zip(due['id'][autopay], due['user_id'][autopay], total[autopay])
+    ]
+    results = charge_payments(charges, gateway_url=gateway_url)
+    status[autopay] = [r['status'] for r in results]
+    return status
+
+# ---------------------------
+# Plan Migration (bulk move of a plan's subscribers)
+# ---------------------------
+def compute_migration_proration(source_prices, target_prices, days_remaining, total_days):
+    """Vectorized prorated price difference for the unused part of each current period.
+
+    Positive amounts are charged and negative amounts credited, as in process_plan_upgrade.
+    """
+    total_days = np.maximum(np.asarray(total_days, dtype=float), 1.0)
+    days_remaining = np.clip(np.asarray(days_remaining, dtype=float), 0.0, total_days)
+    difference = np.asarray(target_prices, dtype=float) - np.asarray(source_prices, dtype=float)
+    return np.round(difference * days_remaining / total_days, 2)
+
+
+_PLAN_MIGRATION_QUERY = """
+    SELECT s.id, s.user_id, s.start_date, s.end_date, COALESCE(s.auto_renew, 0) AS auto_renew,
+           COALESCE(s.renewal_count, 0) AS renewal_count, COALESCE(u.is_autopay_enabled, 0) AS autopay
+    FROM subscriptions s
+    LEFT JOIN users u ON u.id = s.user_id
+    WHERE s.plan_id = ? AND s.status = 'active' AND s.id > ? AND s.id <= ?
+    ORDER BY s.id
+    LIMIT ?
+"""
+
+
+def _migration_amounts(due, source, target, today):
+    """Prorated charge (+) or credit (-) per subscription in a chunk"""
+    starts = pd.to_datetime(due['start_date'], format='ISO8601', errors='coerce').dt.normalize()
+    ends = pd.to_datetime(due['end_date'], format='ISO8601', errors='coerce').dt.normalize()
+    days_remaining = (ends - pd.Timestamp(today)).dt.days.fillna(0).to_numpy()
+    total_days = (ends - starts).dt.days.fillna(1).to_numpy()
+    return compute_migration_proration(source['price'], target['price'], days_remaining, total_days)
+
+
+def _migration_payment_status(due, amounts, charge_status=None):
+    """Payment status per row: autopay charges are paid (or the gateway outcome), other
+    charges are invoiced, credits are recorded as refunds and zero amounts get no payment"""
+    charged = np.full(len(due), 'paid', dtype=object) if charge_status is None else np.asarray(charge_status, dtype=object)
+    autopay = due['autopay'].to_numpy() == 1
+    status = np.where(autopay, charged, 'pending')
+    status = np.where(amounts < 0, 'refunded', status)
+    return np.where(amounts == 0, '', status)
+
+
+def _charge_migrations(due, amounts, gateway_url):
+    """Charge a chunk's autopay proration through the gateway; returns 'paid'/'failed' per row"""
+    status = np.full(len(due), 'paid', dtype=object)
+    charge = (due['autopay'].to_numpy() == 1) & (amounts > 0)
+    if not charge.any():
+        return status
+    charges = [
+        {'transaction_id': f"MIG{sid:010d}", 'user_id': int(uid), 'amount': float(amt)}
+        for sid, uid, amt in zip(due['id'][charge], due['user_id'][charge], amounts[charge])
+    ]
+    results = charge_payments(charges, gateway_url=gateway_url)
+    status[charge] = [r['status'] for r in results]
+    return status
+
+
+def _migrate_chunk(conn, run_id, due, amounts, source, target, today, now, checkpoint_id, charge_status=None):
+    """Move one chunk of subscriptions to the target plan; the caller holds the write transaction"""
+    first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM subscriptions").fetchone()[0]
+    new_ids = np.arange(first_id, first_id + len(due))
+    now_iso = now.isoformat()
+    today_iso = today.isoformat()
+    old_ids = due['id'].tolist()
+    user_ids = due['user_id'].tolist()
+    # Periods that lapsed without renewal close and reopen on today rather than in the past
+    end_dates = due['end_date'].fillna(today_iso).tolist()
+    old_ends = [min(end[:10], today_iso) for end in end_dates]
+    new_ends = [end if end[:10] >= today_iso else today_iso for end in end_dates]
+    pay_status = _migration_payment_status(due, amounts, charge_status)
+    pay_method = np.where(amounts < 0, 'account_credit', np.where(due['autopay'].to_numpy() == 1, 'autopay', 'invoice'))
+    billed = pay_status != ''
+
+    conn.executemany(
+        "UPDATE subscriptions SET status = 'migrated', end_date = ? WHERE id = ?",
+        zip(old_ends, old_ids)
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (id, user_id, plan_id, start_date, end_date, status, auto_renew, created_date, renewal_count) VALUES (?, ?, ?, ?, ?, 'active', ?, ?, ?)",
+        zip(new_ids.tolist(), user_ids, [target['id']] * len(due), [today_iso] * len(due), new_ends,
+            due['auto_renew'].tolist(), [now_iso] * len(due), due['renewal_count'].tolist())
+    )
+    conn.executemany(
+        "INSERT INTO payments (subscription_id, user_id, amount, payment_date, status, payment_method, bill_month, bill_year, transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        zip(new_ids[billed].tolist(), due['user_id'][billed].tolist(), amounts[billed].tolist(),
+            [now_iso] * int(billed.sum()), pay_status[billed].tolist(), pay_method[billed].tolist(),
+            [today.month] * int(billed.sum()), [today.year] * int(billed.sum()),
+            [f"MIG{sid:010d}" for sid in due['id'][billed].tolist()])
+    )
+    conn.executemany(
+        "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, 'plan_migration', ?)",
+        [(uid, f"Your {source['name']} plan has been moved to {target['name']}. " + {
+            'paid': f"₹{amt:,.2f} was charged for the rest of your current period.",
+            'failed': f"Your charge of ₹{amt:,.2f} for the rest of your current period did not go through; we will retry it shortly.",
+            'pending': f"An invoice of ₹{amt:,.2f} for the rest of your current period is due.",
+            'refunded': f"₹{-amt:,.2f} has been credited to your account for the rest of your current period.",
+            '': "There is no change to your current period's charges.",
+        }[status], now_iso)
+         for uid, amt, status in zip(user_ids, amounts.tolist(), pay_status.tolist())]
+    )
+    charged = float(amounts[amounts > 0].sum())
+    credited = float(-amounts[amounts < 0].sum())
+    conn.execute(
+        "UPDATE plan_migration_runs SET last_subscription_id = ?, migrated = migrated + ?, charged_amount = charged_amount + ?, credited_amount = credited_amount + ? WHERE id = ?",
+        (int(checkpoint_id), len(due), charged, credited, run_id)
+    )
+    return charged, credited
+
+
+def migrate_plan_subscribers(source_plan_id, target_plan_id, chunk_size=PLAN_MIGRATION_CHUNK_SIZE,
+                             dry_run=False, gateway_url=None):
+    """Move every active subscription on source_plan_id to target_plan_id.
+
+    The unused part of each current period is prorated as in process_plan_upgrade: the
+    price difference is charged (autopay users now, others by invoice) or credited as a
+    refund. Each chunk (old subscription closed, new one opened, payment, notification
+    and checkpoint) commits as one transaction, so an interrupted run resumes after the
+    last committed chunk when started again. dry_run reads the same chunks and reports
+    the revenue impact without writing anything.
+    """
+    source, target = get_plan(source_plan_id), get_plan(target_plan_id)
+    if not source or not target:
+        raise ValueError("Source and target plans must both exist")
+    if source['id'] == target['id']:
+        raise ValueError("Source and target plans must differ")
+    gateway_url = None if dry_run else gateway_url or get_payment_gateway_url()
+    now = datetime.utcnow()
+    today = now.date()
+
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    try:
+        run = None if dry_run else conn.execute(
+            "SELECT id, last_subscription_id, max_subscription_id FROM plan_migration_runs WHERE source_plan_id = ? AND target_plan_id = ? AND status = 'running' ORDER BY id DESC LIMIT 1",
+            (source['id'], target['id'])
+        ).fetchone()
+        if run:
+            run_id, checkpoint, max_sub_id = run[0], run[1], run[2]
+        else:
+            max_sub_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM subscriptions").fetchone()[0]
+            run_id, checkpoint = None, 0
+            if not dry_run:
+                cur = conn.execute(
+                    "INSERT INTO plan_migration_runs (source_plan_id, target_plan_id, status, started_date, max_subscription_id) VALUES (?, ?, 'running', ?, ?)",
+                    (source['id'], target['id'], now.isoformat(), max_sub_id)
+                )
+                run_id = cur.lastrowid
+                conn.commit()
+
+        started = time.perf_counter()
+        migrated, charges, credits, charged, credited, unapplied = 0, 0, 0, 0.0, 0.0, 0
+        while True:
+            rows = conn.execute(_PLAN_MIGRATION_QUERY, (source['id'], checkpoint, max_sub_id, chunk_size)).fetchall()
+            if not rows:
+                if not dry_run:
+                    conn.execute(
+                        "UPDATE plan_migration_runs SET status = 'completed', finished_date = ? WHERE id = ?",
+                        (datetime.utcnow().isoformat(), run_id)
+                    )
+                    conn.commit()
+                break
+            due = pd.DataFrame([tuple(r) for r in rows], columns=rows[0].keys())
+            chunk_checkpoint = int(due['id'].max())
+            amounts = _migration_amounts(due, source, target, today)
+            if not dry_run:
+                charge_status = _charge_migrations(due, amounts, gateway_url) if gateway_url else None
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Another writer may have cancelled or upgraded some of these meanwhile
+                    placeholders = ",".join(["?"] * len(due))
+                    still_active = {r[0] for r in conn.execute(
+                        f"SELECT id FROM subscriptions WHERE status = 'active' AND plan_id = ? AND id IN ({placeholders})",
+                        (source['id'], *due['id'].tolist())
+                    )}
+                    keep = due['id'].isin(still_active).to_numpy()
+                    if charge_status is not None:
+                        if not keep.all():
+                            unapplied += _record_unapplied_charges(conn, due[~keep], amounts[~keep], charge_status[~keep],
+                                                                   "MIG", [source['name']] * int((~keep).sum()), now)
+                        charge_status = charge_status[keep]
+                    due, amounts = due[keep].reset_index(drop=True), amounts[keep]
+                    if due.empty:
+                        conn.execute("UPDATE plan_migration_runs SET last_subscription_id = ? WHERE id = ?", (chunk_checkpoint, run_id))
+                    else:
+                        _migrate_chunk(conn, run_id, due, amounts, source, target, today, now, chunk_checkpoint, charge_status)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            migrated += len(due)
+            charges += int((amounts > 0).sum())
+            credits += int((amounts < 0).sum())
+            charged += float(amounts[amounts > 0].sum())
+            credited += float(-amounts[amounts < 0].sum())
+            checkpoint = chunk_checkpoint
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+
+    # Recurring revenue moves by the difference in 30-day price per subscriber
+    source_monthly, target_monthly = (float(p['price'] or 0) * 30 / max(int(p['validity_days'] or 30), 1)
+                                      for p in (source, target))
+    return {
+        'run_id': run_id,
+        'dry_run': dry_run,
+        'source_plan': source['name'],
+        'target_plan': target['name'],
+        'subscriptions': migrated,
+        'charges': charges,
+        'charged_amount': round(charged, 2),
+        'credits': credits,
+        'credited_amount': round(credited, 2),
+        'net_prorated_revenue': round(charged - credited, 2),
+        'unapplied_charges': unapplied,
+        'monthly_revenue_change': round(migrated * (target_monthly - source_monthly), 2),
+        'elapsed_seconds': round(elapsed, 3),
+        'subscriptions_per_second': round(migrated / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+# ---------------------------
+# Dunning (failed payment retries)
+# ---------------------------
+def _dunning_retry_at(now, failures):
+    hours = DUNNING_RETRY_HOURS[min(failures, len(DUNNING_RETRY_HOURS)) - 1]
+    return (now + timedelta(hours=hours)).isoformat()
+
+
+def _dunning_notice(failures, amount, next_retry_at=None):
+    """(notification_type, message) for a dunning item after its latest failure"""
+    if failures >= DUNNING_MAX_FAILURES:
+        return 'subscription_suspended', (
+            f"Your subscription has been suspended because a payment of ₹{amount:,.2f} could not be collected "
+            f"after {failures} attempts. Please update your payment method to restore service.")
+    retry_on = next_retry_at[:10]
+    if failures == 1:
+        return 'payment_failed', f"We couldn't collect your payment of ₹{amount:,.2f}. We'll retry automatically on {retry_on}."
+    return 'payment_retry_failed', (
+        f"Your payment of ₹{amount:,.2f} failed again (attempt {failures} of {DUNNING_MAX_FAILURES}). "
+        f"Please check your payment method; we'll retry on {retry_on}.")
+
+
+def enroll_failed_payments(batch_size=5000, now=None):
+    """Add newly failed payments to the dunning queue and tell their owners.
+
+    Progress is tracked with a payment id watermark in meta, so each run only reads new rows.
+    Failures dated more than DUNNING_ENROLL_WINDOW_DAYS ago are passed over.
+    """
+    now = now or datetime.utcnow()
+    now_iso = now.isoformat()
+    first_retry = _dunning_retry_at(now, 1)
+    cutoff = (now - timedelta(days=DUNNING_ENROLL_WINDOW_DAYS)).isoformat()
+    conn = get_conn()
+    try:
+        row = conn.execute("SELECT v FROM meta WHERE k = ?", (DUNNING_WATERMARK,)).fetchone()
+        last_id = int(row[0]) if row else 0
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM payments").fetchone()[0]
+        enrolled = 0
+        while last_id < max_id:
+            upper = min(last_id + batch_size, max_id)
+            rows = conn.execute("""
+                INSERT OR IGNORE INTO dunning_queue
+                    (payment_id, user_id, subscription_id, amount, status, failures, next_retry_at, created_date, updated_date)
+                SELECT id, user_id, subscription_id, amount, 'active', 1, ?, ?, ?
+                FROM payments
+                WHERE id > ? AND id <= ? AND status = 'failed' AND payment_date >= ?
+                RETURNING user_id, amount
+            """, (first_retry, now_iso, now_iso, last_id, upper, cutoff)).fetchall()
+            notices = []
+            for r in rows:
+                notice_type, message = _dunning_notice(1, r['amount'], first_retry)
+                notices.append((r['user_id'], message, notice_type, now_iso))
+            conn.executemany(
+                "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, ?, ?)", notices
+            )
+            conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)", (DUNNING_WATERMARK, str(upper)))
+            conn.commit()
+            enrolled += len(rows)
+            last_id = upper
+        return enrolled
+    finally:
+        conn.close()
+
+
+def claim_dunning_batch(conn, now, batch_size=DUNNING_BATCH_SIZE):
+    """Atomically take the earliest due retries, pushing them a lease ahead so a crash makes them due again"""
+    conn.execute("BEGIN IMMEDIATE")
+    rows = conn.execute("""
+        UPDATE dunning_queue
+        SET next_retry_at = ?
+        WHERE payment_id IN (
+            SELECT payment_id FROM dunning_queue
+            WHERE status = 'active' AND next_retry_at <= ?
+            ORDER BY next_retry_at
+            LIMIT ?
+        )
+        RETURNING payment_id, user_id, subscription_id, amount, failures
+    """, ((now + timedelta(seconds=DUNNING_LEASE_SECONDS)).isoformat(), now.isoformat(), batch_size)).fetchall()
+    conn.commit()
+    return [row_to_dict(r) for r in rows]
+
+
+def _charge_dunning_batch(batch, gateway_url):
+    """Retry a batch of failed payments through the payment gateway"""
+    # One idempotency key per attempt: a retry interrupted by a crash reuses it, the next attempt does not
+    return charge_payments(
+        [{'transaction_id': f"DUN{item['payment_id']:010d}A{item['failures']}", 'user_id': item['user_id'], 'amount': item['amount']}
+         for item in batch],
+        gateway_url=gateway_url,
+    )
+
+
+def _finish_dunning_batch(conn, batch, results, now):
+    """Record retry outcomes: settle recovered payments, reschedule or suspend the rest"""
+    now_iso = now.isoformat()
+    recovered, rescheduled, suspended, notices = [], [], [], []
+    for item, result in zip(batch, results):
+        amount = item['amount']
+        if result['status'] == 'paid':
+            recovered.append((now_iso, item['payment_id']))
+            notices.append((item['user_id'], f"Your outstanding payment of ₹{amount:,.2f} has been collected. Thank you!", 'payment_recovered', now_iso))
+            continue
+        failures = item['failures'] + 1
+        next_retry_at = _dunning_retry_at(now, failures)
+        notice_type, message = _dunning_notice(failures, amount, next_retry_at)
+        if failures >= DUNNING_MAX_FAILURES:
+            suspended.append((failures, result['error'], now_iso, item['payment_id'], item['user_id'], item['subscription_id']))
+        else:
+            rescheduled.append((failures, next_retry_at, result['error'], now_iso, item['payment_id']))
+        notices.append((item['user_id'], message, notice_type, now_iso))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Settling the payment posts it to the ledger and monthly totals through the payments triggers
+        conn.executemany("UPDATE payments SET status = 'paid', payment_date = ? WHERE id = ? AND status = 'failed'", recovered)
+        conn.executemany(
+            "UPDATE dunning_queue SET status = 'recovered', updated_date = ? WHERE payment_id = ?", recovered
+        )
+        conn.executemany(
+            "UPDATE dunning_queue SET failures = ?, next_retry_at = ?, last_error = ?, updated_date = ? WHERE payment_id = ?",
+            rescheduled
+        )
+        conn.executemany(
+            "UPDATE dunning_queue SET status = 'suspended', failures = ?, last_error = ?, updated_date = ? WHERE payment_id = ?",
+            [s[:4] for s in suspended]
+        )
+        # Suspend the subscription the payment was for; payments without one suspend the user's active plans
+        conn.executemany(
+            "UPDATE subscriptions SET status = 'suspended' WHERE id = ? AND status = 'active'",
+            [(s[5],) for s in suspended if s[5]]
+        )
+        conn.executemany(
+            "UPDATE subscriptions SET status = 'suspended' WHERE user_id = ? AND status = 'active'",
+            [(s[4],) for s in suspended if not s[5]]
+        )
+        conn.executemany(
+            "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, ?, ?)", notices
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(recovered), len(rescheduled), len(suspended)
+
+
+def run_dunning(batch_size=DUNNING_BATCH_SIZE, gateway_url=None, now=None):
+    """Enrol new failed payments, then retry every due one in batches until none are due.
+
+    Each batch's charges run concurrently through the payment gateway outside any
+    transaction; the outcomes are written in one short transaction per batch. Without a
+    gateway nothing can actually be collected, so retries stay queued until one is set.
+    """
+    gateway_url = gateway_url or get_payment_gateway_url()
+    now = now or datetime.utcnow()
+    enrolled = enroll_failed_payments(now=now)
+    if not gateway_url:
+        return {
+            'enrolled': enrolled,
+            'retried': 0,
+            'recovered': 0,
+            'rescheduled': 0,
+            'suspended': 0,
+            'due': get_dunning_stats(now)['due'],
+            'skipped': "no payment gateway configured (PAYMENT_GATEWAY_URL)",
+        }
+
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    started = time.perf_counter()
+    retried = recovered = rescheduled = suspended = 0
+    try:
+        while True:
+            batch = claim_dunning_batch(conn, now, batch_size)
+            if not batch:
+                break
+            results = _charge_dunning_batch(batch, gateway_url)
+            ok, again, stopped = _finish_dunning_batch(conn, batch, results, now)
+            retried += len(batch)
+            recovered += ok
+            rescheduled += again
+            suspended += stopped
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+
+    return {
+        'enrolled': enrolled,
+        'retried': retried,
+        'recovered': recovered,
+        'rescheduled': rescheduled,
+        'suspended': suspended,
+        'elapsed_seconds': round(elapsed, 3),
+        'retries_per_second': round(retried / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def get_dunning_stats(now=None):
+    """Dunning queue size by status, plus how many active items are due now"""
+    now = (now or datetime.utcnow()).isoformat()
+    stats = {status: count for status, count in exec_query(
+        "SELECT status, COUNT(*) FROM dunning_queue GROUP BY status", fetch=True
+    )}
+    stats['due'] = exec_query(
+        "SELECT COUNT(*) FROM dunning_queue WHERE status = 'active' AND next_retry_at <= ?", (now,), fetch=True
+    )[0][0]
+    return stats
+
+# ---------------------------
+# Statements
+# ---------------------------
+_STATEMENT_USERS_QUERY = """
+    SELECT id, name, email, address, city, state FROM users
+    WHERE id > ? ORDER BY id LIMIT ?
+"""
+
+_STATEMENT_PAYMENTS_QUERY = """
+    SELECT p.user_id, p.id, p.payment_date, p.amount, p.status, p.payment_method,
+           p.transaction_id, p.tax_amount, p.discount, pl.name AS plan_name
+    FROM payments p
+    LEFT JOIN subscriptions s ON p.subscription_id = s.id
+    LEFT JOIN plans pl ON s.plan_id = pl.id
+    WHERE p.user_id > ? AND p.user_id <= ? AND p.payment_date >= ? AND p.payment_date < ?
+    ORDER BY p.user_id, p.payment_date, p.id
+"""
+
+
+def statement_period_bounds(period):
+    """'YYYY-MM' -> (first day, first day of next month) as ISO dates"""
+    start = pd.Period(period, freq='M')
+    return start.start_time.date().isoformat(), (start + 1).start_time.date().isoformat()
+
+
+def build_statement(user, period, payments):
+    """Statement data for one user and month: one line per payment plus GST/discount totals"""
+    lines = []
+    totals = {'base': 0.0, 'discount': 0.0, 'tax': 0.0, 'paid': 0.0, 'refunded': 0.0, 'outstanding': 0.0}
+    for p in payments:
+        amount = p['amount'] or 0.0
+        tax = p['tax_amount'] or 0.0
+        discount = p['discount'] or 0.0
+        base = amount - tax + discount if p['status'] != 'refunded' else amount
+        lines.append({
+            'date': (p['payment_date'] or '')[:10],
+            'plan': p['plan_name'] or '-',
+            'transaction_id': p['transaction_id'] or '-',
+            'method': p['payment_method'] or '-',
+            'status': p['status'],
+            'base': base, 'discount': discount, 'tax': tax, 'total': amount,
+        })
+        if p['status'] == 'paid':
+            totals['base'] += base
+            totals['discount'] += discount
+            totals['tax'] += tax
+            totals['paid'] += amount
+        elif p['status'] == 'refunded':
+            totals['refunded'] += -amount
+        else:
+            totals['outstanding'] += amount
+    address = ", ".join(x for x in (user.get('address'), user.get('city'), user.get('state')) if x)
+    return {
+        'user_id': user['id'], 'name': user.get('name') or '', 'email': user.get('email') or '',
+        'address': address, 'period': period,
+        'period_label': pd.Period(period, freq='M').strftime('%B %Y'),
+        'lines': lines, 'totals': totals,
+    }
+
+
+def render_statement_text(stmt):
+    """Plain-text statement; amounts in INR"""
+    t = stmt['totals']
+    rule = "-" * 104
+    out = [
+        "BROADBAND PORTAL - MONTHLY STATEMENT",
+        f"Statement period: {stmt['period_label']} ({stmt['period']})",
+        f"Customer: {stmt['name']} (ID {stmt['user_id']})",
+        f"Email: {stmt['email']}",
+    ]
+    if stmt['address']:
+        out.append(f"Address: {stmt['address']}")
+    out += [
+        rule,
+        f"{'Date':<11}{'Plan':<20}{'Transaction':<18}{'Status':<10}{'Base':>11}{'Discount':>11}{'GST':>11}{'Total':>12}",
+        rule,
+    ]
+    for l in stmt['lines']:
+        out.append(
+            f"{l['date']:<11}{l['plan'][:19]:<20}{l['transaction_id'][:17]:<18}{l['status'][:9]:<10}"
+            f"{l['base']:>11,.2f}{l['discount']:>11,.2f}{l['tax']:>11,.2f}{l['total']:>12,.2f}"
+        )
+    half_gst = t['tax'] / 2
+    out += [
+        rule,
+        f"{'Charges (before tax)':<40}{t['base']:>14,.2f}",
+        f"{'Loyalty discount':<40}{-t['discount']:>14,.2f}",
+        f"{f'CGST @ {GST_RATE * 50:g}%':<40}{half_gst:>14,.2f}",
+        f"{f'SGST @ {GST_RATE * 50:g}%':<40}{half_gst:>14,.2f}",
+        f"{'Total paid':<40}{t['paid']:>14,.2f}",
+    ]
+    if t['refunded']:
+        out.append(f"{'Refunded':<40}{-t['refunded']:>14,.2f}")
+    if t['outstanding']:
+        out.append(f"{'Failed / pending (not collected)':<40}{t['outstanding']:>14,.2f}")
+    out += [rule, "All amounts in INR."]
+    return "\n".join(out) + "\n"
+
+
+def render_statement_html(stmt):
+    """Self-contained HTML statement"""
+    e = html.escape
+    t = stmt['totals']
+    rows = "".join(
+        f"<tr><td>{e(l['date'])}</td><td>{e(l['plan'])}</td><td>{e(l['transaction_id'])}</td><td>{e(l['method'])}</td>"
+        f"<td>{e(l['status'])}</td><td class='n'>₹{l['base']:,.2f}</td><td class='n'>₹{l['discount']:,.2f}</td>"
+        f"<td class='n'>₹{l['tax']:,.2f}</td><td class='n'>₹{l['total']:,.2f}</td></tr>"
+        for l in stmt['lines']
+    )
+    summary = [
+        ("Charges (before tax)", t['base']),
+        ("Loyalty discount", -t['discount']),
+        (f"CGST @ {GST_RATE * 50:g}%", t['tax'] / 2),
+        (f"SGST @ {GST_RATE * 50:g}%", t['tax'] / 2),
+        ("Total paid", t['paid']),
+    ]
+    if t['refunded']:
+        summary.append(("Refunded", -t['refunded']))
+    if t['outstanding']:
+        summary.append(("Failed / pending (not collected)", t['outstanding']))
+    summary_rows = "".join(f"<tr><th>{e(k)}</th><td class='n'>₹{v:,.2f}</td></tr>" for k, v in summary)
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        f"<title>Statement {e(stmt['period'])} - {e(stmt['name'])}</title>"
+        "<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;margin:1em 0}"
+        "td,th{border:1px solid #ddd;padding:4px 8px;text-align:left}.n{text-align:right}</style></head><body>"
+        f"<h2>Broadband Portal &mdash; Monthly Statement</h2><p>Statement period: <b>{e(stmt['period_label'])}</b><br>"
+        f"Customer: {e(stmt['name'])} (ID {stmt['user_id']})<br>Email: {e(stmt['email'])}"
+        + (f"<br>Address: {e(stmt['address'])}" if stmt['address'] else "") +
+        "</p><table><tr><th>Date</th><th>Plan</th><th>Transaction</th><th>Method</th><th>Status</th>"
+        f"<th>Base</th><th>Discount</th><th>GST</th><th>Total</th></tr>{rows}</table>"
+        f"<table>{summary_rows}</table></body></html>"
+    )
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def render_statement_pdf(stmt, lines_per_page=60):
+    """Minimal PDF 1.4 of the plain-text statement, set in Courier on A4 pages"""
+    text_lines = render_statement_text(stmt).encode('latin-1', 'replace').decode('latin-1').splitlines()
+    pages = [text_lines[i:i + lines_per_page] for i in range(0, len(text_lines), lines_per_page)] or [[]]
+    # Object numbers: 1 catalog, 2 page tree, 3 font, then a (content, page) pair per page
+    page_ids = [5 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+    ]
+    for i, page in enumerate(pages):
+        stream = "BT /F1 7.5 Tf 10 TL 28 806 Td " + " ".join(f"({_pdf_escape(l)}) Tj T*" for l in page) + " ET"
+        stream = stream.encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {page_ids[i] - 1} 0 R >>".encode()
+        )
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+STATEMENT_RENDERERS = {
+    'txt': lambda stmt: render_statement_text(stmt).encode('utf-8'),
+    'html': lambda stmt: render_statement_html(stmt).encode('utf-8'),
+    'pdf': render_statement_pdf,
+}
+
+
+def statement_path(content_hash, fmt, store_dir=STATEMENT_DIR):
+    return os.path.join(store_dir, content_hash[:2], f"{content_hash}.{fmt}")
+
+
+def store_statement(content, fmt, store_dir=STATEMENT_DIR):
+    """Write content to the content-addressed store (sha256); identical statements are stored once"""
+    content_hash = hashlib.sha256(content).hexdigest()
+    path = statement_path(content_hash, fmt, store_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as fh:
+            fh.write(content)
+        os.replace(tmp, path)
+    return content_hash
+
+
+def _render_statement_batch(batch, period, formats, store_dir):
+    """Process-pool task: render and store statements for [(user, payments), ...]"""
+    stored = []
+    for user, payments in batch:
+        stmt = build_statement(user, period, payments)
+        for fmt in formats:
+            content = STATEMENT_RENDERERS[fmt](stmt)
+            stored.append((user['id'], fmt, store_statement(content, fmt, store_dir), len(content)))
+    return stored
+
+
+def generate_user_statement(user_id, period, fmt='pdf', store_dir=STATEMENT_DIR):
+    """One user's statement for a month (for downloads); None without payments.
+
+    Closed months come from the store when run_statements or an earlier download has
+    recorded them, and are stored on first render; the current month is always rendered.
+    """
+    closed = period < datetime.utcnow().strftime('%Y-%m')
+    if closed:
+        stored = exec_query("SELECT content_hash FROM statements WHERE user_id = ? AND period = ? AND format = ?",
+                            (user_id, period, fmt), fetch=True)
+        path = stored and statement_path(stored[0]['content_hash'], fmt, store_dir)
+        if path and os.path.exists(path):
+            with open(path, 'rb') as fh:
+                return fh.read()
+    start, end = statement_period_bounds(period)
+    user = exec_query("SELECT id, name, email, address, city, state FROM users WHERE id = ?", (user_id,), fetch=True)
+    payments = exec_query(_STATEMENT_PAYMENTS_QUERY, (user_id - 1, user_id, start, end), fetch=True)
+    if not user or not payments:
+        return None
+    content = STATEMENT_RENDERERS[fmt](build_statement(row_to_dict(user[0]), period, [row_to_dict(p) for p in payments]))
+    if closed:
+        conn = get_conn()
+        try:
+            _record_statements(conn, period, [(user_id, fmt, store_statement(content, fmt, store_dir), len(content))])
+        finally:
+            conn.close()
+    return content
+
+
+def _record_statements(conn, period, stored):
+    now = datetime.utcnow().isoformat()
+    conn.executemany("""
+        INSERT INTO statements (user_id, period, format, content_hash, size_bytes, created_date)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, period, format) DO UPDATE SET
+            content_hash = excluded.content_hash, size_bytes = excluded.size_bytes, created_date = excluded.created_date
+    """, [(uid, period, fmt, h, size, now) for uid, fmt, h, size in stored])
+    conn.commit()
+
+
+def run_statements(period=None, workers=None, formats=STATEMENT_FORMATS, chunk_users=STATEMENT_CHUNK_USERS,
+                   store_dir=STATEMENT_DIR):
+    """Generate every user's statement for a month (default: last month) in a process pool.
+
+    Users are read in id-ordered chunks and each chunk's payments come from one range
+    query, so memory stays bounded by the number of chunks in flight. Re-running a month
+    rewrites its index rows; unchanged statements hash to files that already exist.
+    """
+    period = period or (pd.Period(datetime.utcnow(), freq='M') - 1).strftime('%Y-%m')
+    start, end = statement_period_bounds(period)
+    workers = workers or os.cpu_count() or 1
+    users = statements = total_bytes = 0
+    started = time.perf_counter()
+
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+
+            def _collect(done):
+                nonlocal statements, total_bytes
+                for future in done:
+                    stored = future.result()
+                    _record_statements(conn, period, stored)
+                    statements += len(stored)
+                    total_bytes += sum(s[3] for s in stored)
+
+            last_id = 0
+            while True:
+                chunk = conn.execute(_STATEMENT_USERS_QUERY, (last_id, chunk_users)).fetchall()
+                if not chunk:
+                    break
+                upper = chunk[-1]['id']
+                by_user = {}
+                for p in conn.execute(_STATEMENT_PAYMENTS_QUERY, (last_id, upper, start, end)):
+                    by_user.setdefault(p['user_id'], []).append(row_to_dict(p))
+                batch = [(row_to_dict(u), by_user[u['id']]) for u in chunk if u['id'] in by_user]
+                last_id = upper
+                if not batch:
+                    continue
+                users += len(batch)
+                pending.add(pool.submit(_render_statement_batch, batch, period, tuple(formats), store_dir))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done)
+            _collect(pending)
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'period': period,
+        'users': users,
+        'statements': statements,
+        'megabytes': round(total_bytes / 1e6, 1),
+        'elapsed_seconds': round(elapsed, 3),
+        'statements_per_second': round(statements / elapsed, 1) if elapsed > 0 else 0.0,
+        'projected_minutes_per_million_users': round(elapsed / users * 1e6 / 60, 1) if users else 0.0,
+    }
+
+
+def benchmark_statements(users=100000, payments_per_user=2, workers=None, formats=STATEMENT_FORMATS,
+                         store_dir=STATEMENT_DIR):
+    """Seed synthetic users with payments in one month and generate their statements"""
+    period = "2031-01"
+    conn = get_conn()
+    first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+    first_sub = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM subscriptions").fetchone()[0]
+    plan_id = conn.execute("SELECT MIN(id) FROM plans").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO users (id, username, password_hash, role, name, email, city, state) VALUES (?, ?, '', 'user', ?, ?, 'Pune', 'Maharashtra')",
+        [(first_id + i, f"stmt_bench_{first_id + i}", f"Bench User {i}", f"bench{i}@example.com") for i in range(users)]
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (id, user_id, plan_id, start_date, end_date, status) VALUES (?, ?, ?, '2031-01-01', '2031-01-31', 'active')",
+        [(first_sub + i, first_id + i, plan_id) for i in range(users)]
+    )
+    conn.executemany(
+        "INSERT INTO payments (subscription_id, user_id, amount, payment_date, status, payment_method, bill_month, bill_year, tax_amount, discount, transaction_id) VALUES (?, ?, ?, ?, ?, 'upi', 1, 2031, ?, ?, ?)",
+        [(first_sub + i, first_id + i, 589.82, f"2031-01-{1 + k * 7:02d}T00:00:00", 'paid' if (i + k) % 17 else 'failed',
+          89.82, 0.0, f"BENCH{i:07d}{k}") for i in range(users) for k in range(payments_per_user)]
+    )
+    conn.commit()
+    conn.close()
+    return run_statements(period, workers=workers, formats=formats, store_dir=store_dir)
+
+# ---------------------------
+# Payment Reconciliation
+# ---------------------------
+_RECONCILE_PAYMENTS_QUERY = """
+    SELECT id, user_id, subscription_id, substr(payment_date, 1, 10) AS day, amount, status
+    FROM payments
+    WHERE user_id > ? AND user_id <= ?
+    ORDER BY user_id, payment_date, id
+"""
+
+_RECONCILE_SUBSCRIPTIONS_QUERY = """
+    SELECT id, user_id, substr(start_date, 1, 10) AS start_day, substr(end_date, 1, 10) AS end_day
+    FROM subscriptions
+    WHERE user_id > ? AND user_id <= ?
+    ORDER BY user_id, start_date, id
+"""
+
+
+def _reconcile_user(payments, subscriptions, grace_days):
+    """Merge one user's date-ordered payments against their start-ordered subscriptions.
+
+    Returns (links, exceptions): links are (subscription_id, payment_id) for orphans with
+    exactly one covering subscription; exceptions are (payment_id, user_id, kind,
+    subscription_id, candidate_ids, detail).
+    """
+    grace = timedelta(days=grace_days)
+    subs = [(s['id'], (datetime.fromisoformat(s['start_day']) - grace).date().isoformat(), s['end_day'])
+            for s in subscriptions if s['start_day'] and s['end_day']]
+    periods = {sid: (lo, hi) for sid, lo, hi in subs}
+    links, exceptions = [], []
+    window, nxt = [], 0
+    for p in payments:
+        day = p['day']
+        if day is None:
+            exceptions.append((p['id'], p['user_id'], 'missing_date', p['subscription_id'], '', "payment has no payment_date"))
+            continue
+        # Subscriptions enter the window once they have started (less the grace period)
+        # and leave it once they have ended, since later payments cannot fall inside them
+        while nxt < len(subs) and subs[nxt][1] <= day:
+            window.append(subs[nxt])
+            nxt += 1
+        window = [s for s in window if s[2] >= day]
+        candidates = [s[0] for s in window]
+        sid = p['subscription_id']
+        if not sid:
+            if len(candidates) == 1:
+                links.append((candidates[0], p['id']))
+            else:
+                kind = 'orphan_ambiguous' if candidates else 'orphan_no_match'
+                exceptions.append((p['id'], p['user_id'], kind, None, ",".join(map(str, candidates)),
+                                   f"{len(candidates)} subscriptions cover {day}"))
+        elif sid not in periods:
+            exceptions.append((p['id'], p['user_id'], 'foreign_subscription', sid, ",".join(map(str, candidates)),
+                               f"subscription {sid} does not belong to user {p['user_id']}"))
+        elif not periods[sid][0] <= day <= periods[sid][1]:
+            exceptions.append((p['id'], p['user_id'], 'outside_period', sid, ",".join(map(str, candidates)),
+                               f"{day} is outside subscription {sid} ({periods[sid][0]} .. {periods[sid][1]})"))
+    return links, exceptions
+
+
+def _grouped_by_user(cursor):
+    """Yield (user_id, rows) from a cursor ordered by user_id, one user at a time"""
+    for user_id, rows in itertools.groupby(cursor, key=lambda r: r['user_id']):
+        yield user_id, [row_to_dict(r) for r in rows]
+
+
+def run_reconciliation(chunk_rows=RECONCILE_CHUNK_ROWS, grace_days=RECONCILE_GRACE_DAYS, progress=None):
+    """Link orphaned payments to the subscription covering their date and record exceptions.
+
+    Payments and subscriptions are read as two user-ordered streams over ranges of about
+    chunk_rows payments and merge-joined one user at a time, so memory is bounded by one
+    range's results. Each range commits its links and exceptions with a checkpoint; an
+    interrupted run resumes from it. progress(scanned, total) is called after every range.
+    """
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    try:
+        run = conn.execute(
+            "SELECT id, last_user_id, payments_scanned FROM reconciliation_runs WHERE status = 'running' ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if run:
+            run_id, last_user, scanned = run
+        else:
+            cur = conn.execute(
+                "INSERT INTO reconciliation_runs (status, started_date) VALUES ('running', ?)",
+                (datetime.utcnow().isoformat(),)
+            )
+            run_id, last_user, scanned = cur.lastrowid, 0, 0
+            conn.commit()
+        total = conn.execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+        max_user = conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM payments").fetchone()[0]
+
+        started = time.perf_counter()
+        processed = 0
+        while last_user < max_user:
+            row = conn.execute(
+                "SELECT user_id FROM payments WHERE user_id > ? ORDER BY user_id LIMIT 1 OFFSET ?",
+                (last_user, chunk_rows - 1)
+            ).fetchone()
+            upper = row[0] if row else max_user
+
+            links, exceptions, chunk_scanned = [], [], 0
+            subscriptions = _grouped_by_user(conn.execute(_RECONCILE_SUBSCRIPTIONS_QUERY, (last_user, upper)))
+            sub_user, user_subs = next(subscriptions, (None, []))
+            for user_id, payments in _grouped_by_user(conn.execute(_RECONCILE_PAYMENTS_QUERY, (last_user, upper))):
+                while sub_user is not None and sub_user < user_id:
+                    sub_user, user_subs = next(subscriptions, (None, []))
+                user_links, user_exceptions = _reconcile_user(payments, user_subs if sub_user == user_id else [], grace_days)
+                links += user_links
+                exceptions += user_exceptions
+                chunk_scanned += len(payments)
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Only fill in subscription_id if nothing else has set it since the read
+                cur = conn.executemany(
+                    "UPDATE payments SET subscription_id = ? WHERE id = ? AND COALESCE(subscription_id, 0) = 0", links
+                )
+                conn.executemany(
+                    "INSERT INTO reconciliation_exceptions (run_id, payment_id, user_id, kind, subscription_id, candidate_ids, detail) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(run_id, *e) for e in exceptions]
+                )
+                conn.execute(
+                    "UPDATE reconciliation_runs SET last_user_id = ?, payments_scanned = payments_scanned + ?, linked = linked + ?, exceptions = exceptions + ? WHERE id = ?",
+                    (upper, chunk_scanned, cur.rowcount, len(exceptions), run_id)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            processed += chunk_scanned
+            scanned += chunk_scanned
+            last_user = upper
+            if progress:
+                progress(scanned, total)
+
+        conn.execute(
+            "UPDATE reconciliation_runs SET status = 'completed', finished_date = ? WHERE id = ?",
+            (datetime.utcnow().isoformat(), run_id)
+        )
+        conn.commit()
+        elapsed = time.perf_counter() - started
+        totals = conn.execute(
+            "SELECT payments_scanned, linked, exceptions FROM reconciliation_runs WHERE id = ?", (run_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+    return {
+        'run_id': run_id,
+        'payments_scanned': totals[0],
+        'linked': totals[1],
+        'exceptions': totals[2],
+        'elapsed_seconds': round(elapsed, 3),
+        'payments_per_second': round(processed / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def get_reconciliation_exceptions(run_id=None, limit=None):
+    """Exceptions of a reconciliation run (default: the latest) as a DataFrame"""
+    if run_id is None:
+        row = exec_query("SELECT MAX(id) FROM reconciliation_runs", fetch=True)
+        run_id = row[0][0] if row else None
+    query = "SELECT payment_id, user_id, kind, subscription_id, candidate_ids, detail FROM reconciliation_exceptions WHERE run_id = ? ORDER BY id"
+    params = (run_id,)
+    if limit:
+        query += " LIMIT ?"
+        params += (limit,)
+    return df_from_query(query, params)
+
+
+def write_reconciliation_report(path, run_id=None):
+    """Stream a run's exceptions to CSV without loading them all; returns the row count"""
+    conn = get_conn()
+    try:
+        if run_id is None:
+            run_id = conn.execute("SELECT MAX(id) FROM reconciliation_runs").fetchone()[0]
+        cur = conn.execute(
+            "SELECT payment_id, user_id, kind, subscription_id, candidate_ids, detail FROM reconciliation_exceptions WHERE run_id = ? ORDER BY id",
+            (run_id,)
+        )
+        count = 0
+        with open(path, 'w', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow([d[0] for d in cur.description])
+            while True:
+                rows = cur.fetchmany(5000)
+                if not rows:
+                    return count
+                writer.writerows(tuple(r) for r in rows)
+                count += len(rows)
+    finally:
+        conn.close()
+
+# ---------------------------
+# Payment Gateway
+# ---------------------------
+def get_payment_gateway_url():
+    """Gateway endpoint from PAYMENT_GATEWAY_URL; None means charges are simulated locally"""
+    return os.environ.get('PAYMENT_GATEWAY_URL') or None
+
+
+def idempotency_key_for(transaction_id):
+    """Stable idempotency key for a transaction: retries of the same charge reuse it"""
+    return hashlib.sha256(f"trailblazer:{transaction_id}".encode()).hexdigest()[:32]
+
+
+async def _read_http_message(reader):
+    """Read one HTTP/1.1 message; returns (start_line, headers, body)"""
+    start_line = await reader.readline()
+    if not start_line:
+        raise EOFError("connection closed")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+    return start_line.decode('latin-1').strip(), headers, body
+
+
+class HttpPaymentGateway:
+    """JSON-over-HTTP(S) gateway client on asyncio streams, reusing keep-alive connections.
+
+    charge() returns (http_status, response_json).
+    """
+    def __init__(self, base_url, pool_size=GATEWAY_CONCURRENCY):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Payment gateway URL must be http:// or https://, got {base_url!r}")
+        self.host = parts.hostname
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.path = parts.path.rstrip('/') + "/charges"
+        self.pool_size = pool_size
+        self._idle = []
+
+    async def _connect(self):
+        if self._idle:
+            return self._idle.pop()
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def charge(self, charge, idempotency_key):
+        body = json.dumps({
+            'amount': round(float(charge['amount']), 2),
+            'currency': 'INR',
+            'user_id': charge.get('user_id'),
+            'transaction_id': charge['transaction_id'],
+        }).encode()
+        reader, writer = await self._connect()
+        try:
+            writer.write(
+                f"POST {self.path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\nIdempotency-Key: {idempotency_key}\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status_line, headers, payload = await _read_http_message(reader)
+        except BaseException:
+            # Includes cancellation by a timeout: the stream is in an unknown state
+            writer.close()
+            raise
+        if headers.get('connection', '').lower() == 'close' or len(self._idle) >= self.pool_size:
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+        return int(status_line.split()[1]), json.loads(payload or b"{}")
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+async def charge_with_retry(gateway, charge, timeout=GATEWAY_TIMEOUT_SECONDS, max_retries=GATEWAY_MAX_RETRIES):
+    """Charge once, retrying timeouts, connection errors and 5xx with the same idempotency key"""
+    key = idempotency_key_for(charge['transaction_id'])
+    started = time.perf_counter()
+    error = None
+    for attempt in range(1, max_retries + 2):
+        try:
+            code, body = await asyncio.wait_for(gateway.charge(charge, key), timeout)
+        except (asyncio.TimeoutError, OSError, EOFError, ValueError) as e:
+            error = f"{e.__class__.__name__}: {e}" if str(e) else e.__class__.__name__
+        else:
+            if code < 500:
+                approved = code == 200 and body.get('status') == 'succeeded'
+                return {
+                    'transaction_id': charge['transaction_id'],
+                    'status': 'paid' if approved else 'failed',
+                    'reference': body.get('reference'),
+                    'error': None if approved else body.get('status') or f"HTTP {code}",
+                    'attempts': attempt,
+                    'latency_seconds': time.perf_counter() - started,
+                }
+            error = f"HTTP {code}"
+        if attempt <= max_retries:
+            await asyncio.sleep(GATEWAY_RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)) * (0.5 + random.random()))
+    return {
+        'transaction_id': charge['transaction_id'],
+        'status': 'failed',
+        'reference': None,
+        'error': error,
+        'attempts': max_retries + 1,
+        'latency_seconds': time.perf_counter() - started,
+    }
+
+
+async def charge_many(gateway, charges, concurrency=GATEWAY_CONCURRENCY, timeout=GATEWAY_TIMEOUT_SECONDS,
+                      max_retries=GATEWAY_MAX_RETRIES):
+    """Run many charges concurrently with at most `concurrency` in flight; results keep input order"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(charge):
+        async with semaphore:
+            return await charge_with_retry(gateway, charge, timeout, max_retries)
+
+    return await asyncio.gather(*(_one(c) for c in charges))
+
+
+def charge_payments(charges, gateway_url=None, concurrency=GATEWAY_CONCURRENCY,
+                    timeout=GATEWAY_TIMEOUT_SECONDS, max_retries=GATEWAY_MAX_RETRIES):
+    """Synchronous entry point: charge [{'transaction_id', 'user_id', 'amount'}, ...] via the gateway"""
+    gateway_url = gateway_url or get_payment_gateway_url()
+
+    async def _run():
+        gateway = HttpPaymentGateway(gateway_url, pool_size=concurrency)
+        try:
+            return await charge_many(gateway, charges, concurrency, timeout, max_retries)
+        finally:
+            await gateway.close()
+
+    return asyncio.run(_run())
+
+
+class MockGatewayServer:
+    """Local payment gateway for offline testing and benchmarks.
+
+    Every request waits latency_ms (+/- jitter_ms, with an occasional 5x tail). A
+    failure_rate share of requests answer 503: half before charging, half after, to
+    exercise idempotent retries. decline_rate of new charges are declined. Requests
+    with an idempotency key already seen replay the stored response.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=50.0, jitter_ms=20.0,
+                 failure_rate=0.0, decline_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.charges = 0
+        self._responses = {}
+        self._inflight = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def _latency(self):
+        ms = max(0.0, self.rng.gauss(self.latency_ms, self.jitter_ms))
+        if self.rng.random() < 0.01:
+            ms *= 5
+        return ms / 1000.0
+
+    async def _process(self, key):
+        await asyncio.sleep(self._latency())
+        roll = self.rng.random()
+        if roll < self.failure_rate / 2:
+            return 503, {'error': 'gateway temporarily unavailable'}
+        self.charges += 1
+        approved = self.rng.random() >= self.decline_rate
+        result = (200, {'status': 'succeeded' if approved else 'declined', 'reference': f"gw_{uuid.uuid4().hex[:12]}"})
+        self._responses[key] = result
+        if roll < self.failure_rate:
+            return 503, {'error': 'gateway timeout after capture'}
+        return result
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                _, headers, _ = await _read_http_message(reader)
+                self.requests += 1
+                key = headers.get('idempotency-key') or uuid.uuid4().hex
+                if key in self._responses:
+                    await asyncio.sleep(self._latency())
+                    code, payload = self._responses[key]
+                elif key in self._inflight:
+                    code, payload = await asyncio.shield(self._inflight[key])
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    self._inflight[key] = future
+                    try:
+                        code, payload = await self._process(key)
+                        future.set_result((code, payload))
+                    finally:
+                        del self._inflight[key]
+                body = json.dumps(payload).encode()
+                reason = "OK" if code == 200 else "Service Unavailable"
+                writer.write(
+                    f"HTTP/1.1 {code} {reason}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (EOFError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        """Serve from a background thread; returns self once the port is bound"""
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def _run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start_server())
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._shutdown())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    async def _shutdown(self):
+        self._server.close()
+        pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def serve_forever(self):
+        async def _serve():
+            await self._start_server()
+            print(f"Mock payment gateway listening on {self.url}")
+            async with self._server:
+                await self._server.serve_forever()
+        asyncio.run(_serve())
+
+
+def benchmark_payment_gateway(charges=5000, concurrency=GATEWAY_CONCURRENCY, latency_ms=50.0, jitter_ms=20.0,
+                              failure_rate=0.05, decline_rate=0.02, timeout=GATEWAY_TIMEOUT_SECONDS):
+    """Charge synthetic transactions against a local MockGatewayServer and report throughput and tail latency"""
+    server = MockGatewayServer(latency_ms=latency_ms, jitter_ms=jitter_ms,
+                               failure_rate=failure_rate, decline_rate=decline_rate, seed=42).start()
+    try:
+        requests = [{'transaction_id': f"BENCH{i:08d}", 'user_id': i, 'amount': 499.0} for i in range(charges)]
+        started = time.perf_counter()
+        results = charge_payments(requests, gateway_url=server.url, concurrency=concurrency, timeout=timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+    latency = np.array([r['latency_seconds'] for r in results]) * 1000
+    return {
+        'charges': charges,
+        'paid': sum(r['status'] == 'paid' for r in results),
+        'failed': sum(r['status'] == 'failed' for r in results),
+        'retries': sum(r['attempts'] - 1 for r in results),
+        'gateway_requests': server.requests,
+        'gateway_unique_charges': server.charges,
+        'elapsed_seconds': round(elapsed, 3),
+        'charges_per_second': round(charges / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_p50_ms': round(float(np.percentile(latency, 50)), 1),
+        'latency_p95_ms': round(float(np.percentile(latency, 95)), 1),
+        'latency_p99_ms': round(float(np.percentile(latency, 99)), 1),
+    }
+
+# ---------------------------
+# Usage Ingestion
+# ---------------------------
+_USAGE_UPSERT_SQL = """
+    INSERT INTO usage (user_id, date, data_used_gb, peak_hour_usage, off_peak_usage, upload_usage, average_speed, session_seconds)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, date) DO UPDATE SET
+        data_used_gb = COALESCE(data_used_gb, 0) + excluded.data_used_gb,
+        peak_hour_usage = COALESCE(peak_hour_usage, 0) + excluded.peak_hour_usage,
+        off_peak_usage = COALESCE(off_peak_usage, 0) + excluded.off_peak_usage,
+        upload_usage = COALESCE(upload_usage, 0) + excluded.upload_usage,
+        average_speed = CASE WHEN COALESCE(session_seconds, 0) + excluded.session_seconds > 0
+            THEN (COALESCE(data_used_gb, 0) + excluded.data_used_gb) * 8000 / (COALESCE(session_seconds, 0) + excluded.session_seconds)
+            ELSE average_speed END,
+        session_seconds = COALESCE(session_seconds, 0) + excluded.session_seconds
+"""
+
+
+def _to_timestamps(values):
+    """Epoch seconds and/or ISO strings -> datetime64 (naive UTC)"""
+    epoch = pd.to_numeric(values, errors='coerce')
+    stamps = pd.to_datetime(epoch, unit='s')
+    iso = epoch.isna() & values.notna()
+    if iso.any():
+        stamps[iso] = pd.to_datetime(values[iso], format='ISO8601', utc=True).dt.tz_localize(None)
+    return stamps
+
+
+def aggregate_usage_records(records):
+    """Aggregate accounting records into one usage row per user and day.
+
+    records is a DataFrame or list of dicts with user_id, start, end (epoch seconds or
+    ISO timestamps), bytes_down and bytes_up. A session is counted on the day and hour
+    it started; hours in USAGE_PEAK_HOURS count as peak. Volumes are in GB (10^9 bytes).
+    Each row also carries 'hours', its 24 hourly GB totals, for usage_hourly.
+    """
+    df = records if isinstance(records, pd.DataFrame) else pd.DataFrame.from_records(records)
+    if df.empty:
+        return pd.DataFrame(columns=['user_id', 'date', 'data_used_gb', 'peak_hour_usage', 'off_peak_usage', 'upload_usage', 'session_seconds', 'hours'])
+    start = _to_timestamps(df['start'])
+    end = _to_timestamps(df['end'])
+    down = pd.to_numeric(df['bytes_down'], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    up = pd.to_numeric(df['bytes_up'], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    total_gb = (down + up) / 1e9
+    hour = start.dt.hour.to_numpy()
+    peak = (hour >= USAGE_PEAK_HOURS[0]) & (hour < USAGE_PEAK_HOURS[1])
+    daily = pd.DataFrame({
+        'user_id': pd.to_numeric(df['user_id'], errors='coerce'),
+        'date': start.dt.strftime('%Y-%m-%d'),
+        'data_used_gb': total_gb,
+        'peak_hour_usage': np.where(peak, total_gb, 0.0),
+        'off_peak_usage': np.where(peak, 0.0, total_gb),
+        'upload_usage': up / 1e9,
+        'session_seconds': (end - start).dt.total_seconds().clip(lower=0).to_numpy(),
+        'hour': hour,
+    }).dropna(subset=['user_id', 'date'])
+    daily['user_id'] = daily['user_id'].astype(np.int64)
+    grouped = daily.groupby(['user_id', 'date'], sort=False)
+    hours = np.zeros((grouped.ngroups, 24))
+    np.add.at(hours, (grouped.ngroup().to_numpy(), daily['hour'].to_numpy()), daily['data_used_gb'].to_numpy())
+    daily = grouped.sum().drop(columns='hour').reset_index()
+    daily['hours'] = list(hours)
+    return daily
+
+
+def upsert_daily_usage(conn, daily):
+    """Add aggregated daily rows onto usage in one executemany; the caller commits"""
+    seconds = daily['session_seconds'].to_numpy()
+    speed = np.divide(daily['data_used_gb'].to_numpy() * 8000, seconds,
+                      out=np.zeros(len(daily)), where=seconds > 0)
+    conn.executemany(_USAGE_UPSERT_SQL, zip(
+        daily['user_id'].tolist(), daily['date'].tolist(), daily['data_used_gb'].tolist(),
+        daily['peak_hour_usage'].tolist(), daily['off_peak_usage'].tolist(), daily['upload_usage'].tolist(),
+        speed.tolist(), seconds.tolist(),
+    ))
+    return len(daily)
+
+
+def merge_duplicate_usage_days():
+    """Fold duplicate (user_id, date) usage rows into one and build the unique index.
+
+    Volumes and session time are summed into the lowest id; average speed is recomputed
+    from the summed session time, or averaged when none was recorded. Returns the number
+    of rows merged away.
+    """
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            CREATE TEMP TABLE usage_merged AS
+            SELECT MIN(id) AS id, user_id, date, SUM(data_used_gb) AS data_used_gb,
+                   SUM(peak_hour_usage) AS peak_hour_usage, SUM(off_peak_usage) AS off_peak_usage,
+                   SUM(upload_usage) AS upload_usage, AVG(average_speed) AS average_speed,
+                   SUM(session_seconds) AS session_seconds
+            FROM usage GROUP BY user_id, date HAVING COUNT(*) > 1
+        """)
+        conn.execute("""
+            UPDATE usage SET
+                data_used_gb = m.data_used_gb,
+                peak_hour_usage = m.peak_hour_usage,
+                off_peak_usage = m.off_peak_usage,
+                upload_usage = m.upload_usage,
+                average_speed = CASE WHEN m.session_seconds > 0
+                    THEN m.data_used_gb * 8000 / m.session_seconds ELSE m.average_speed END,
+                session_seconds = m.session_seconds
+            FROM temp.usage_merged m
+            WHERE usage.id = m.id
+        """)
+        merged = conn.execute("""
+            DELETE FROM usage
+            WHERE (user_id, date) IN (SELECT user_id, date FROM temp.usage_merged)
+              AND id NOT IN (SELECT id FROM temp.usage_merged)
+        """).rowcount
+        conn.execute("DROP TABLE temp.usage_merged")
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_usage_user_date ON usage (user_id, date)')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if merged:
+        print(f"Merged {merged} duplicate usage rows into their user's daily row")
+    return merged
+
+
+def get_ingest_conn():
+    """Connection for bulk usage writes: WAL so dashboards keep reading while batches commit"""
+    conn = get_conn()
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.create_function("usage_hours_add", 2, _add_hour_blobs, deterministic=True)
+    return conn
+
+
+def ingest_usage_records(records, conn=None):
+    """Aggregate and upsert one batch of accounting records in a single transaction"""
+    own = conn is None
+    conn = conn or get_ingest_conn()
+    try:
+        daily = aggregate_usage_records(records)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = upsert_daily_usage(conn, daily)
+            upsert_hourly_usage(conn, daily)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return {'records': len(records), 'rows': rows}
+    finally:
+        if own:
+            conn.close()
+
+
+def _read_record_lines(fh, batch_size):
+    """Yield lists of records from a JSON-lines stream"""
+    batch = []
+    for line in fh:
+        line = line.strip()
+        if line:
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def ingest_usage_files(paths, batch_size=USAGE_INGEST_BATCH):
+    """Ingest JSON-lines accounting records from files ('-' is stdin, .gz is decompressed) or open text streams"""
+    conn = get_ingest_conn()
+    records = rows = 0
+    started = time.perf_counter()
+    try:
+        for path in paths:
+            if not isinstance(path, str):
+                fh = path
+            elif path == '-':
+                fh = sys.stdin
+            else:
+                fh = gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+            try:
+                for batch in _read_record_lines(fh, batch_size):
+                    result = ingest_usage_records(batch, conn)
+                    records += result['records']
+                    rows += result['rows']
+            finally:
+                if isinstance(path, str) and path != '-':
+                    fh.close()
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - started
+    return {
+        'records': records,
+        'usage_rows_upserted': rows,
+        'elapsed_seconds': round(elapsed, 3),
+        'records_per_second': round(records / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+class _UsageIngestHandler(http.server.BaseHTTPRequestHandler):
+    """POST /usage with a JSON array or JSON lines of accounting records"""
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/usage':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            # The body cannot be framed, so the connection cannot be reused either
+            self.close_connection = True
+            self._reply(400, {'error': f"invalid Content-Length: {self.headers.get('Content-Length')}"})
+            return
+        body = self.rfile.read(length)
+        try:
+            text = body.decode('utf-8').strip()
+            if text.startswith('['):
+                records = json.loads(text)
+            else:
+                records = [json.loads(line) for line in text.splitlines() if line.strip()]
+            result = ingest_usage_records(records)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': f"{e.__class__.__name__}: {e}"})
+            return
+        except sqlite3.Error as e:
+            # Usually "database is locked" under concurrent writers; nothing was committed
+            self._reply(503, {'error': f"{e.__class__.__name__}: {e}", 'retry': True})
+            return
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_usage_ingest(host='127.0.0.1', port=8098):
+    """Run the usage ingestion endpoint until interrupted"""
+    server = http.server.ThreadingHTTPServer((host, port), _UsageIngestHandler)
+    server.daemon_threads = True
+    print(f"Usage ingestion listening on http://{host}:{server.server_address[1]}/usage")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def synthetic_usage_records(count, users=10000, days=30, seed=0):
+    """Random accounting records spread over the last `days` days, as a DataFrame"""
+    rng = np.random.default_rng(seed)
+    start = int(datetime.utcnow().timestamp()) - rng.integers(0, days * 86400, count)
+    duration = rng.integers(60, 4 * 3600, count)
+    down = (rng.lognormal(19, 1.2, count)).astype(np.int64)
+    return pd.DataFrame({
+        'user_id': rng.integers(1, users + 1, count),
+        'start': start,
+        'end': start + duration,
+        'bytes_down': down,
+        'bytes_up': (down * rng.uniform(0.05, 0.3, count)).astype(np.int64),
+    })
+
+
+def benchmark_usage_ingest(records=500000, users=10000, batch_size=USAGE_INGEST_BATCH):
+    """Time JSON-lines parsing, aggregation and upserts of synthetic records"""
+    lines = synthetic_usage_records(records, users).to_json(orient='records', lines=True)
+    result = ingest_usage_files([io.StringIO(lines)], batch_size)
+    result['users'] = users
+    return result
+
+# ---------------------------
+# Hourly Usage
+# ---------------------------
+# usage_hourly keeps 24 little-endian float32 GB values per user and day (hour 0-23 UTC,
+# by session start), filled by the ingestion pipeline alongside the daily usage rows.
+_HOURLY_DTYPE = np.dtype('<f4')
+WEEKDAY_LABELS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+_USAGE_HOURLY_UPSERT_SQL = """
+    INSERT INTO usage_hourly (user_id, date, hours) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, date) DO UPDATE SET hours = usage_hours_add(hours, excluded.hours)
+"""
+
+
+def _add_hour_blobs(a, b):
+    """SQL function usage_hours_add: element-wise sum of two hourly BLOBs"""
+    if a is None:
+        return b
+    return (np.frombuffer(a, dtype=_HOURLY_DTYPE) + np.frombuffer(b, dtype=_HOURLY_DTYPE)).tobytes()
+
+
+def upsert_hourly_usage(conn, daily):
+    """Add the 'hours' arrays of aggregated daily rows onto usage_hourly; the caller commits"""
+    if 'hours' not in daily or daily.empty:
+        return 0
+    hours = np.ascontiguousarray(np.stack(daily['hours'].to_numpy()), dtype=_HOURLY_DTYPE)
+    conn.executemany(_USAGE_HOURLY_UPSERT_SQL, zip(
+        daily['user_id'].tolist(), daily['date'].tolist(), [row.tobytes() for row in hours],
+    ))
+    return len(daily)
+
+
+def _weekdays(dates):
+    """Monday=0 weekday numbers for an array of YYYY-MM-DD strings"""
+    days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+    return (days + 3) % 7  # 1970-01-01 was a Thursday
+
+
+def load_hourly_usage(user_id=None, city=None, start=None, end=None):
+    """(dates, hours) for a user's or a city's days in [start, end]; hours is an (n, 24) float32 array"""
+    query = "SELECT h.date, h.hours FROM usage_hourly h"
+    clauses, params = [], []
+    if city is not None:
+        query += " JOIN users u ON u.id = h.user_id"
+        clauses.append("u.city = ?")
+        params.append(city)
+    if user_id is not None:
+        clauses.append("h.user_id = ?")
+        params.append(user_id)
+    if start:
+        clauses.append("h.date >= ?")
+        params.append(str(start)[:10])
+    if end:
+        clauses.append("h.date <= ?")
+        params.append(str(end)[:10])
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    conn = get_conn()
+    conn.row_factory = None  # plain tuples: a city-month is hundreds of thousands of rows
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+    dates = np.array([r[0] for r in rows], dtype=object)
+    hours = np.frombuffer(b"".join([r[1] for r in rows]), dtype=_HOURLY_DTYPE).reshape(-1, 24)
+    return dates, hours
+
+
+def usage_heatmap(dates, hours):
+    """7x24 average GB per weekday and hour (weekdays with no data are NaN)"""
+    # Weekdays are worked out once per distinct date, then summed with a one-hot product
+    codes, distinct = pd.factorize(dates)
+    weekday = _weekdays(distinct.astype(str))[codes] if len(dates) else np.zeros(0, dtype=np.int64)
+    onehot = np.zeros((7, len(weekday)), dtype=_HOURLY_DTYPE)
+    onehot[weekday, np.arange(len(weekday))] = 1
+    total = (onehot @ hours).astype(np.float64)
+    counts = np.bincount(weekday, minlength=7).astype(np.float64)
+    return pd.DataFrame(total / np.where(counts > 0, counts, np.nan)[:, None],
+                        index=list(WEEKDAY_LABELS), columns=range(24))
+
+
+def get_usage_heatmap(user_id=None, city=None, start=None, end=None):
+    """Weekday x hour heatmap for a user or a city over a date range"""
+    return usage_heatmap(*load_hourly_usage(user_id=user_id, city=city, start=start, end=end))
+
+
+def get_hourly_peak_split(user_id, start=None, end=None):
+    """Daily peak/off-peak GB from the hourly buckets (USAGE_PEAK_HOURS), or an empty frame"""
+    dates, hours = load_hourly_usage(user_id=user_id, start=start, end=end)
+    peak = hours[:, USAGE_PEAK_HOURS[0]:USAGE_PEAK_HOURS[1]].sum(axis=1, dtype=np.float64)
+    return pd.DataFrame({
+        'date': dates,
+        'peak_hour_usage': peak,
+        'off_peak_usage': hours.sum(axis=1, dtype=np.float64) - peak,
+    })
+
+
+def benchmark_usage_heatmap(users=20000, days=30, city="Benchmark City"):
+    """Seed hourly usage for `users` users in one city and time the city-wide heatmap"""
+    rng = np.random.default_rng(0)
+    conn = get_ingest_conn()
+    first_uid = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO users (id, username, role, name, city) VALUES (?, ?, 'user', ?, ?)",
+        ((uid, f"heatmap{uid}", f"Heatmap User {uid}", city) for uid in range(first_uid, first_uid + users)),
+    )
+    dates = (np.datetime64(utcnow_naive().date()) - np.arange(days, 0, -1)).astype(str).tolist()
+    shape = np.concatenate([np.full(8, 0.02), np.full(10, 0.08), np.full(5, 0.2), [0.05]])
+    for start in range(first_uid, first_uid + users, 2000):
+        block = range(start, min(start + 2000, first_uid + users))
+        hours = (shape * rng.gamma(2.0, 0.5, (len(block) * days, 24))).astype(_HOURLY_DTYPE)
+        conn.executemany(
+            "INSERT OR REPLACE INTO usage_hourly (user_id, date, hours) VALUES (?, ?, ?)",
+            zip(np.repeat(list(block), days).tolist(), dates * len(block), [row.tobytes() for row in hours]),
+        )
+        conn.commit()
+    conn.close()
+
+    started = time.perf_counter()
+    heat = get_usage_heatmap(city=city, start=dates[0], end=dates[-1])
+    elapsed = time.perf_counter() - started
+    return {
+        'users': users,
+        'user_days': users * days,
+        'heatmap_seconds': round(elapsed, 3),
+        'busiest_hour': int(heat.mean().idxmax()),
+    }
+
+# ---------------------------
+# Usage File Import
+# ---------------------------
+USAGE_IMPORT_COLUMNS = ('user_id', 'date', 'data_used_gb', 'peak_hour_usage', 'off_peak_usage', 'upload_usage', 'average_speed')
+
+_USAGE_IMPORT_SQL = """
+    INSERT INTO usage (user_id, date, data_used_gb, peak_hour_usage, off_peak_usage, upload_usage, average_speed)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, date) DO NOTHING
+"""
+
+
+def _iter_line_chunks(path, offset, chunk_bytes, use_mmap=False):
+    """Yield (data, end_offset) blocks of whole lines from offset onward.
+
+    Offsets are positions in the uncompressed stream; gzip input is read sequentially
+    (resuming decompresses and skips up to the offset), plain files can be memory-mapped.
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as fh:
+            fh.seek(offset)
+            carry = b""
+            while True:
+                block = fh.read(chunk_bytes)
+                if not block:
+                    if carry:
+                        yield carry, offset + len(carry)
+                    return
+                block = carry + block
+                cut = block.rfind(b"\n") + 1
+                if cut == 0:
+                    carry = block
+                    continue
+                offset += cut
+                yield block[:cut], offset
+                carry = block[cut:]
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if use_mmap and size:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                while offset < size:
+                    end = min(offset + chunk_bytes, size)
+                    if end < size:
+                        cut = mm.rfind(b"\n", offset, end)
+                        end = cut + 1 if cut >= offset else (mm.find(b"\n", end) + 1 or size)
+                    yield mm[offset:end], end
+                    offset = end
+            return
+        fh.seek(offset)
+        while offset < size:
+            block = fh.read(chunk_bytes)
+            cut = block.rfind(b"\n") + 1
+            if cut == 0 or offset + len(block) >= size:
+                if offset + len(block) < size:
+                    block += fh.readline()
+                cut = len(block)
+            offset += cut
+            fh.seek(offset)
+            yield block[:cut], offset
+
+
+def coerce_usage_frame(df):
+    """Vectorized validation of imported usage rows; returns (clean rows, rejected count)"""
+    out = pd.DataFrame({'user_id': pd.to_numeric(df['user_id'], errors='coerce')})
+    dates = pd.to_datetime(df['date'], errors='coerce', format='ISO8601')
+    out['date'] = dates.to_numpy(dtype='datetime64[D]').astype(str)
+    for col in USAGE_IMPORT_COLUMNS[2:]:
+        out[col] = pd.to_numeric(df[col], errors='coerce') if col in df else np.nan
+    valid = (
+        out['user_id'].notna() & (out['user_id'] > 0) & (out['user_id'] % 1 == 0)
+        & dates.notna() & out['data_used_gb'].notna() & (out['data_used_gb'] >= 0)
+    )
+    out = out[valid]
+    out['user_id'] = out['user_id'].astype(np.int64)
+    # Last occurrence wins within the file; rows already in the database are kept as they are
+    out = out.drop_duplicates(['user_id', 'date'], keep='last')
+    return out, int((~valid).sum())
+
+
+def import_usage_file(path, chunk_mb=32, use_mmap=False, restart=False, offset=None, progress=None):
+    """Import a CSV (or .csv.gz) usage export with a header row naming USAGE_IMPORT_COLUMNS.
+
+    The file is parsed in chunk_mb blocks of whole lines, so memory stays flat for any file
+    size. Each block is inserted in one transaction together with its end offset in meta,
+    so an interrupted import resumes after the last committed block (restart=True starts
+    over; offset overrides the checkpoint). Existing (user_id, date) rows are left alone.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    checkpoint_key = f"usage_import_offset:{path}"
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as fh:
+        header_line = fh.readline()
+    header = [h.strip().strip('"') for h in header_line.decode('utf-8-sig').strip().split(',')]
+    missing = {'user_id', 'date', 'data_used_gb'} - set(header)
+    if missing:
+        raise ValueError(f"{path} is missing columns: {', '.join(sorted(missing))}")
+
+    saved = json.loads(meta_get(checkpoint_key) or "null")
+    if offset is None:
+        offset = len(header_line)
+        if saved and not restart and saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime:
+            offset = max(offset, saved['offset'])
+
+    conn = get_ingest_conn()
+    started = time.perf_counter()
+    start_offset = offset
+    rows_read = inserted = rejected = 0
+    try:
+        for data, end_offset in _iter_line_chunks(path, offset, int(chunk_mb * 1024 * 1024), use_mmap):
+            frame = pd.read_csv(io.BytesIO(data), header=None, names=header, skip_blank_lines=True,
+                                on_bad_lines='skip', low_memory=False)
+            clean, bad = coerce_usage_frame(frame)
+            values = clean[list(USAGE_IMPORT_COLUMNS)].astype(object).where(clean.notna(), None)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # rowcount, unlike total_changes, leaves out the quota rows the usage triggers write
+                cur = conn.executemany(_USAGE_IMPORT_SQL, values.itertuples(index=False, name=None))
+                inserted += cur.rowcount
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)",
+                    (checkpoint_key, json.dumps({'offset': end_offset, 'size': stat.st_size, 'mtime': stat.st_mtime}))
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            rows_read += len(frame)
+            rejected += bad
+            offset = end_offset
+            if progress:
+                progress(offset, stat.st_size)
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'file': path,
+        'start_offset': start_offset,
+        'end_offset': offset,
+        'rows_read': rows_read,
+        'rows_inserted': inserted,
+        'rows_rejected': rejected,
+        'duplicates_skipped': rows_read - rejected - inserted,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(rows_read / elapsed, 1) if elapsed > 0 else 0.0,
+        'megabytes_per_second': round((offset - start_offset) / 1e6 / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def write_synthetic_usage_csv(path, rows, users=10000, days=365, seed=0):
+    """Write a usage export of `rows` rows in 1M-row pieces (for import benchmarks)"""
+    rng = np.random.default_rng(seed)
+    first_day = np.datetime64(datetime.utcnow().date()) - days
+    with open(path, 'w') as fh:
+        fh.write(",".join(USAGE_IMPORT_COLUMNS) + "\n")
+        for done in range(0, rows, 1_000_000):
+            n = min(1_000_000, rows - done)
+            total = rng.uniform(1, 10, n).round(3)
+            peak = (total * rng.uniform(0.5, 0.8, n)).round(3)
+            pd.DataFrame({
+                'user_id': rng.integers(1, users + 1, n),
+                'date': (first_day + rng.integers(0, days, n)).astype(str),
+                'data_used_gb': total,
+                'peak_hour_usage': peak,
+                'off_peak_usage': (total - peak).round(3),
+                'upload_usage': (total * rng.uniform(0.1, 0.3, n)).round(3),
+                'average_speed': rng.uniform(20, 100, n).round(2),
+            }).to_csv(fh, header=False, index=False)
+
+
+def benchmark_usage_import(rows=2_000_000, chunk_mb=32, use_mmap=True):
+    """Generate a synthetic CSV export, import it and report throughput and peak memory"""
+    import tempfile
+    import resource
+    path = os.path.join(tempfile.mkdtemp(prefix="usage_import_"), "usage.csv")
+    write_synthetic_usage_csv(path, rows)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        result = import_usage_file(path, chunk_mb=chunk_mb, use_mmap=use_mmap, restart=True)
+    finally:
+        os.remove(path)
+    result['file_megabytes'] = round(result['end_offset'] / 1e6, 1)
+    result['peak_rss_megabytes'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    result['rss_growth_megabytes'] = round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1)
+    return result
+
+# ---------------------------
+# Packed Usage Storage
+# ---------------------------
+# A closed month of a user's daily usage is stored as one float32 BLOB of shape
+# (len(USAGE_PACKED_FIELDS), 31), field-major, little-endian, NaN for days with no data.
+USAGE_PACKED_FIELDS = ('data_used_gb', 'peak_hour_usage', 'off_peak_usage', 'upload_usage', 'average_speed')
+_PACKED_DTYPE = np.dtype('<f4')
+_PACKED_SHAPE = (len(USAGE_PACKED_FIELDS), 31)
+
+
+def decode_usage_month(blob):
+    """Zero-copy (read-only) view of a packed month"""
+    return np.frombuffer(blob, dtype=_PACKED_DTYPE).reshape(_PACKED_SHAPE)
+
+
+def encode_usage_month(values):
+    """Pack a (fields, 31) array into BLOB bytes"""
+    return np.ascontiguousarray(values, dtype=_PACKED_DTYPE).tobytes()
+
+
+def read_packed_usage(user_id, days=30, conn=None):
+    """The newest `days` packed days of a user, newest first, in get_usage_for_user's layout"""
+    blocks, dates = [], []
+    found = 0
+    own_conn = conn is None
+    conn = conn or get_conn()
+    try:
+        for month, blob in conn.execute(
+            "SELECT month, data FROM usage_packed WHERE user_id = ? ORDER BY month DESC", (user_id,)
+        ):
+            values = decode_usage_month(blob)
+            present = np.flatnonzero(~np.isnan(values[0]))[::-1]
+            blocks.append(values[:, present])
+            dates.append(np.datetime64(month, 'D') + present)
+            found += len(present)
+            if found >= days:
+                break
+    finally:
+        if own_conn:
+            conn.close()
+    if not found:
+        return pd.DataFrame(columns=['date', *USAGE_PACKED_FIELDS])
+    values = np.concatenate(blocks, axis=1)[:, :days]
+    frame = {'date': np.concatenate(dates)[:days].astype(str)}
+    frame.update(zip(USAGE_PACKED_FIELDS, values.astype(np.float64)))
+    return pd.DataFrame(frame)
+
+
+def get_total_usage_gb():
+    """Total data used across daily rows and packed months"""
+    return exec_query(
+        "SELECT COALESCE((SELECT SUM(data_used_gb) FROM usage), 0) + COALESCE((SELECT SUM(total_gb) FROM usage_packed), 0)",
+        fetch=True,
+    )[0][0]
+
+
+def pack_usage(before=None, chunk_users=2000, vacuum=False):
+    """Move daily usage rows of closed months into usage_packed.
+
+    Months before `before` (default: the current month) are packed one user range at a
+    time; each range is a single transaction that writes the BLOBs and deletes the rows.
+    Rows written later for an already packed month are folded in on the next run, taking
+    precedence over the packed day. session_seconds is not kept (average_speed is). Rows
+    whose date cannot be parsed are left in usage and counted as rows_skipped.
+    """
+    cutoff = pd.Timestamp(before or utcnow_naive()).strftime('%Y-%m-01')
+    started = time.perf_counter()
+    bytes_before = os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0
+    conn = get_ingest_conn()
+    users = [r[0] for r in conn.execute("SELECT DISTINCT user_id FROM usage WHERE date < ? ORDER BY user_id", (cutoff,))]
+    rows_packed = rows_skipped = months_written = 0
+    try:
+        for i in range(0, len(users), chunk_users):
+            lo, hi = users[i], users[min(i + chunk_users, len(users)) - 1]
+            df = pd.read_sql_query(
+                f"SELECT id, user_id, date, {', '.join(USAGE_PACKED_FIELDS)} FROM usage"
+                " WHERE user_id BETWEEN ? AND ? AND date < ? ORDER BY user_id, date",
+                conn, params=(lo, hi, cutoff),
+            )
+            dates = pd.to_datetime(df['date'], errors='coerce')
+            # Unparseable dates cannot be placed in a month; they stay in usage untouched
+            skipped = df['id'][dates.isna()].tolist()
+            df = df[dates.notna()]
+            dates = dates[dates.notna()]
+            df['month'] = dates.dt.strftime('%Y-%m').to_numpy()
+            day = dates.dt.day.to_numpy() - 1
+            # Days without a total cannot be told apart from missing days, so count them as 0 GB
+            values = np.array(df[list(USAGE_PACKED_FIELDS)], dtype=np.float64)
+            values[:, 0] = np.nan_to_num(values[:, 0])
+
+            keys = df[['user_id', 'month']].drop_duplicates()
+            existing = {
+                (uid, month): blob for uid, month, blob in conn.execute(
+                    "SELECT user_id, month, data FROM usage_packed WHERE user_id BETWEEN ? AND ? AND month < ?",
+                    (lo, hi, cutoff[:7]),
+                )
+            }
+            group = df.groupby(['user_id', 'month'], sort=False).ngroup().to_numpy()
+            packed = np.full((len(keys), *_PACKED_SHAPE), np.nan, dtype=_PACKED_DTYPE)
+            for j, key in enumerate(keys.itertuples(index=False, name=None)):
+                if key in existing:
+                    packed[j] = decode_usage_month(existing[key])
+            packed[group, :, day] = values
+
+            payload = [
+                (int(uid), month, int(np.count_nonzero(~np.isnan(p[0]))), float(np.nansum(p[0])), encode_usage_month(p))
+                for (uid, month), p in zip(keys.itertuples(index=False, name=None), packed)
+            ]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO usage_packed (user_id, month, days_present, total_gb, data) VALUES (?, ?, ?, ?, ?)",
+                    payload,
+                )
+                conn.execute(
+                    "DELETE FROM usage WHERE user_id BETWEEN ? AND ? AND date < ?"
+                    " AND id NOT IN (SELECT value FROM json_each(?))",
+                    (lo, hi, cutoff, json.dumps(skipped)),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            rows_packed += len(df)
+            rows_skipped += len(skipped)
+            months_written += len(payload)
+        if vacuum:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return {
+        'cutoff': cutoff,
+        'users': len(users),
+        'rows_packed': rows_packed,
+        'rows_skipped': rows_skipped,
+        'months_written': months_written,
+        'db_megabytes_before': round(bytes_before / 1e6, 2),
+        'db_megabytes_after': round(os.path.getsize(DB_PATH) / 1e6, 2),
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def benchmark_usage_packing(users=2000, days=365, sample_users=200):
+    """Seed a year of daily usage and compare size and window reads before and after pack_usage"""
+    rng = np.random.default_rng(0)
+    first_uid = (exec_query("SELECT COALESCE(MAX(user_id), 0) FROM usage", fetch=True)[0][0] or 0) + 1
+    uids = np.arange(first_uid, first_uid + users)
+    day0 = np.datetime64(utcnow_naive().strftime('%Y-%m-01')) - days
+    conn = get_ingest_conn()
+    for start in range(0, users, 1000):
+        block = uids[start:start + 1000]
+        n = len(block) * days
+        total = rng.uniform(1, 10, n)
+        peak = total * rng.uniform(0.5, 0.8, n)
+        conn.executemany(
+            "INSERT OR IGNORE INTO usage (user_id, date, data_used_gb, peak_hour_usage, off_peak_usage, upload_usage, average_speed)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            zip(np.repeat(block, days).tolist(), np.tile((day0 + np.arange(days)).astype(str), len(block)).tolist(),
+                total.tolist(), peak.tolist(), (total - peak).tolist(), (total * rng.uniform(0.1, 0.3, n)).tolist(),
+                rng.uniform(20, 100, n).tolist()),
+        )
+        conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.close()
+
+    sample = rng.choice(uids, size=min(sample_users, users), replace=False).tolist()
+
+    def window_reads():
+        timings = {}
+        for window in (30, 60, 90):
+            started = time.perf_counter()
+            for uid in sample:
+                get_usage_for_user(uid, days=window)
+            timings[window] = (time.perf_counter() - started) / len(sample) * 1000
+        return timings
+
+    rows_ms = window_reads()
+    result = pack_usage(vacuum=True)
+    packed_ms = window_reads()
+    result['size_reduction'] = round(result['db_megabytes_before'] / max(result['db_megabytes_after'], 1e-9), 1)
+    for window in (30, 60, 90):
+        result[f'read_{window}d_rows_ms'] = round(rows_ms[window], 3)
+        result[f'read_{window}d_packed_ms'] = round(packed_ms[window], 3)
+    return result
+
+# ---------------------------
+# Data Quotas
+# ---------------------------
+class QuotaEngine:
+    """In-memory copy of quota_usage for answering quota checks without a query.
+
+    Rows are pulled incrementally by version (triggers bump it on every change), at most
+    once per QUOTA_REFRESH_SECONDS, so a check is a dict lookup between refreshes.
+    """
+
+    def __init__(self, refresh_seconds=QUOTA_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._by_user = {}  # user_id -> {subscription_id: (period_start, period_end, limit_gb, used_gb)}
+        self._current = {}  # user_id -> entry of the active subscription with the latest period_start
+        self._version = 0
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Apply quota_usage rows changed since the last refresh; returns how many"""
+        with self._lock:
+            conn = get_conn()
+            try:
+                rows = conn.execute(
+                    "SELECT subscription_id, user_id, period_start, period_end, limit_gb, used_gb, active, version"
+                    " FROM quota_usage WHERE version > ? ORDER BY version",
+                    (self._version,),
+                ).fetchall()
+            finally:
+                conn.close()
+            touched = set()
+            for sub_id, user_id, start, end, limit_gb, used_gb, active, version in rows:
+                quotas = self._by_user.setdefault(user_id, {})
+                if active:
+                    quotas[sub_id] = (start, end, limit_gb, used_gb, sub_id)
+                else:
+                    quotas.pop(sub_id, None)
+                touched.add(user_id)
+            for user_id in touched:
+                quotas = self._by_user[user_id]
+                if quotas:
+                    # Latest period wins, then the newest subscription; limit_gb and dates may be NULL
+                    self._current[user_id] = max(quotas.values(), key=lambda e: (e[0] or '', e[4]))
+                else:
+                    del self._by_user[user_id]
+                    self._current.pop(user_id, None)
+            # Only move past the batch once all of it has been applied
+            if rows:
+                self._version = rows[-1][-1]
+            self._next_refresh = time.monotonic() + self.refresh_seconds
+            return len(rows)
+
+    def _entry(self, user_id):
+        if time.monotonic() >= self._next_refresh:
+            self.refresh()
+        return self._current.get(user_id)
+
+    def is_over_quota(self, user_id):
+        """True once the user's current period usage has reached a capped plan's limit"""
+        entry = self._entry(user_id)
+        return entry is not None and entry[2] is not None and entry[3] >= entry[2]
+
+    def status(self, user_id):
+        """Period-to-date usage of the user's active subscription, or None"""
+        entry = self._entry(user_id)
+        if entry is None:
+            return None
+        start, end, limit_gb, used_gb, sub_id = entry
+        return {
+            'subscription_id': sub_id,
+            'period_start': start,
+            'period_end': end,
+            'limit_gb': limit_gb,
+            'used_gb': used_gb,
+            'used_pct': used_gb / limit_gb * 100 if limit_gb else None,
+            'over_quota': limit_gb is not None and used_gb >= limit_gb,
+        }
+
+
+QUOTA_ENGINE = QuotaEngine()
+
+
+def get_quota_status(user_id):
+    """Period-to-date quota usage for a user from the shared QuotaEngine"""
+    return QUOTA_ENGINE.status(user_id)
+
+
+def is_over_quota(user_id):
+    return QUOTA_ENGINE.is_over_quota(user_id)
+
+
+def _packed_period_usage(conn, quotas):
+    """GB in usage_packed falling inside each (subscription_id, user_id, start, end) period"""
+    totals = {}
+    for sub_id, user_id, start, end in quotas:
+        for month, blob in conn.execute(
+            "SELECT month, data FROM usage_packed WHERE user_id = ? AND month BETWEEN ? AND ?",
+            (user_id, start[:7], end[:7]),
+        ):
+            day = np.datetime64(month, 'D') + np.arange(31)
+            inside = (day >= np.datetime64(start)) & (day <= np.datetime64(end))
+            totals[sub_id] = totals.get(sub_id, 0.0) + float(np.nansum(decode_usage_month(blob)[0][inside]))
+    return totals
+
+
+def refresh_quota_triggers():
+    """Replace the quota subscription and threshold triggers with the current definitions"""
+    conn = get_conn()
+    try:
+        for name in ("trg_subscriptions_quota_insert", "trg_subscriptions_quota_update",
+                     "trg_quota_events_insert", "trg_quota_events_update"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        _create_quota_subscription_triggers(conn)
+        _create_quota_event_triggers(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def rebuild_quota_usage():
+    """Recompute quota_usage from subscriptions, usage and usage_packed.
+
+    Rows whose stored usage drifted are corrected (which also emits any threshold events
+    they missed in periods that are still open). Returns a summary with the number of corrections and the largest drift.
+    """
+    started = time.perf_counter()
+    conn = get_ingest_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            INSERT INTO quota_usage (subscription_id, user_id, period_start, period_end, limit_gb, used_gb, active, version)
+            SELECT s.id, s.user_id, substr(s.start_date, 1, 10), substr(s.end_date, 1, 10),
+                   CASE WHEN COALESCE(p.is_unlimited, 0) THEN NULL ELSE p.data_limit_gb END, 0, 1,
+                   (SELECT COALESCE(MAX(version), 0) + 1 FROM quota_usage)
+            FROM subscriptions s LEFT JOIN plans p ON p.id = s.plan_id
+            WHERE s.status = 'active' AND s.start_date IS NOT NULL AND s.end_date IS NOT NULL
+            ON CONFLICT(subscription_id) DO NOTHING
+        """)
+        conn.execute("""
+            UPDATE quota_usage SET active = 0, version = (SELECT MAX(version) + 1 FROM quota_usage)
+            WHERE active AND subscription_id NOT IN (SELECT id FROM subscriptions WHERE status = 'active')
+        """)
+        quotas = conn.execute("""
+            SELECT q.subscription_id, q.user_id, q.period_start, q.period_end, q.used_gb,
+                   (SELECT COALESCE(SUM(u.data_used_gb), 0) FROM usage u
+                    WHERE u.user_id = q.user_id AND u.date BETWEEN q.period_start AND q.period_end)
+            FROM quota_usage q WHERE q.active
+        """).fetchall()
+        packed = _packed_period_usage(conn, [q[:4] for q in quotas])
+        corrections = []
+        max_drift = 0.0
+        for sub_id, _, _, _, stored, from_rows in quotas:
+            actual = from_rows + packed.get(sub_id, 0.0)
+            drift = abs(actual - stored)
+            if drift > 1e-3:  # packed months are float32
+                corrections.append((actual, sub_id))
+                max_drift = max(max_drift, drift)
+        conn.executemany(
+            "UPDATE quota_usage SET used_gb = ?, version = (SELECT MAX(version) + 1 FROM quota_usage) WHERE subscription_id = ?",
+            corrections,
+        )
+        conn.commit()
+        events = conn.execute("SELECT COUNT(*) FROM quota_events").fetchone()[0]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {
+        'active_quotas': len(quotas),
+        'corrected': len(corrections),
+        'max_drift_gb': round(max_drift, 3),
+        'threshold_events': events,
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def benchmark_quota_checks(checks=1_000_000):
+    """Time QuotaEngine lookups for the users that have an active quota"""
+    engine = QuotaEngine(refresh_seconds=3600)
+    started = time.perf_counter()
+    engine.refresh()
+    load_seconds = time.perf_counter() - started
+    users = list(engine._current) or [0]
+    sample = [users[i % len(users)] for i in range(checks)]
+    started = time.perf_counter()
+    over = sum(map(engine.is_over_quota, sample))
+    elapsed = time.perf_counter() - started
+    return {
+        'users': len(engine._current),
+        'load_seconds': round(load_seconds, 3),
+        'checks': checks,
+        'over_quota_hits': over,
+        'microseconds_per_check': round(elapsed / checks * 1e6, 3),
+    }
+
+# ---------------------------
+# Support Tickets
+# ---------------------------
+def ticket_status_class(status):
+    """Python twin of _ticket_status_class_sql"""
+    status = (status or '').strip().lower()
+    for cls, statuses in TICKET_STATUS_CLASSES.items():
+        if status in statuses:
+            return cls
+    return 'ongoing'
+
+
+def get_ticket_counts():
+    """Ticket counts by status, status class and category, from support_ticket_counts"""
+    counts = {'status': {}, 'class': {cls: 0 for cls in TICKET_STATUS_CLASSES}, 'category': {}}
+    for dimension, value, count in exec_query(
+        "SELECT dimension, value, count FROM support_ticket_counts WHERE count > 0", fetch=True
+    ):
+        counts[dimension][value] = count
+        if dimension == 'status':
+            counts['class'][ticket_status_class(value)] += count
+    return counts
+
+
+def get_tickets_page(status_class, before=None, limit=TICKET_PAGE_SIZE):
+    """One page of tickets in a status class, newest first, seeking on (sort_key, id).
+
+    sort_key is created_date with NULL as '', so undated tickets come last and stay
+    reachable. Pass (sort_key, id) of the last row of the previous page as before to get
+    the next page.
+    """
+    query = """
+        SELECT st.id, st.subject, st.category, st.status, st.priority, st.created_date, st.resolved_date,
+               u.name AS user_name, u.email AS user_email, COALESCE(st.created_date, '') AS sort_key
+        FROM support_tickets st
+        JOIN users u ON st.user_id = u.id
+        WHERE st.status_class = ?
+    """
+    params = [status_class]
+    if before is not None:
+        query += " AND COALESCE(st.created_date, '') <= ? AND (COALESCE(st.created_date, ''), st.id) < (?, ?)"
+        params.extend((before[0], before[0], before[1]))
+    query += " ORDER BY COALESCE(st.created_date, '') DESC, st.id DESC LIMIT ?"
+    params.append(limit)
+    return df_from_query(query, tuple(params))
+
+
+def rebuild_ticket_counts():
+    """Backfill status_class and recompute support_ticket_counts from support_tickets"""
+    conn = get_conn()
+    try:
+        conn.execute(f"""
+            UPDATE support_tickets SET status_class = {_ticket_status_class_sql("status")}
+            WHERE status_class IS NOT {_ticket_status_class_sql("status")}
+        """)
+        conn.execute("DELETE FROM support_ticket_counts")
+        conn.execute("""
+            INSERT INTO support_ticket_counts (dimension, value, count)
+            SELECT 'status', LOWER(TRIM(COALESCE(status, ''))), COUNT(*) FROM support_tickets GROUP BY 2
+            UNION ALL
+            SELECT 'category', COALESCE(category, ''), COUNT(*) FROM support_tickets GROUP BY 2
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+# ---------------------------
+# Support SLA Metrics
+# ---------------------------
+# Resolution times are kept as histograms over quarter-octave hour buckets (bucket k covers
+# [SLA_BUCKET_EDGES[k-1], SLA_BUCKET_EDGES[k]) hours), so percentiles come from a few
+# hundred rollup rows instead of the ticket history.
+SLA_BUCKET_EDGES = np.round(0.25 * 2 ** (np.arange(49) / 4), 4)  # 15 minutes .. 1024 hours, then one overflow bucket
+SLA_DIMENSIONS = {'all': "'all'", 'category': "st.category", 'priority': "st.priority", 'city': "u.city"}
+BACKLOG_AGE_BUCKETS = ((0, '< 1 day'), (1, '1-3 days'), (3, '3-7 days'), (7, '1-2 weeks'), (14, '2-4 weeks'), (28, '4+ weeks'))
+
+
+def _sla_bucket(hours):
+    return np.searchsorted(SLA_BUCKET_EDGES, hours, side='right')
+
+
+def refresh_ticket_sla(full=False, chunk_rows=50000):
+    """Fold tickets resolved since the watermark into ticket_sla_rollup and re-count the backlog.
+
+    Resolved tickets are read in (resolved_date, id) order from idx_tickets_resolved, one
+    chunk per transaction, with the watermark stored in meta alongside. full=True starts
+    over (needed if resolved tickets are reopened or edited).
+    """
+    started = time.perf_counter()
+    conn = get_conn()
+    try:
+        if full:
+            conn.execute("DELETE FROM ticket_sla_rollup")
+            conn.execute("DELETE FROM meta WHERE k = 'ticket_sla_watermark'")
+            conn.commit()
+        mark = json.loads(meta_get('ticket_sla_watermark') or '["", 0]')
+        folded = 0
+        while True:
+            chunk = pd.read_sql_query(f"""
+                SELECT st.id, st.created_date, st.resolved_date,
+                       {', '.join(f'{expr} AS "{dim}"' for dim, expr in SLA_DIMENSIONS.items())}
+                FROM support_tickets st LEFT JOIN users u ON u.id = st.user_id
+                WHERE st.resolved_date IS NOT NULL AND (st.resolved_date, st.id) > (?, ?)
+                ORDER BY st.resolved_date, st.id
+                LIMIT ?
+            """, conn, params=(mark[0], mark[1], chunk_rows))
+            if chunk.empty:
+                break
+            hours = (pd.to_datetime(chunk['resolved_date'], errors='coerce', format='ISO8601')
+                     - pd.to_datetime(chunk['created_date'], errors='coerce', format='ISO8601')).dt.total_seconds() / 3600
+            valid = hours.notna() & (hours >= 0)
+            bucket = _sla_bucket(hours[valid].to_numpy())
+            parts = [
+                pd.DataFrame({'dimension': dim, 'value': chunk.loc[valid, dim].fillna('unknown').astype(str).to_numpy(),
+                              'bucket': bucket})
+                for dim in SLA_DIMENSIONS
+            ]
+            counts = pd.concat(parts).groupby(['dimension', 'value', 'bucket']).size().reset_index(name='count')
+            last = chunk.iloc[-1]
+            mark = [last['resolved_date'], int(last['id'])]
+            conn.executemany("""
+                INSERT INTO ticket_sla_rollup (dimension, value, bucket, count) VALUES (?, ?, ?, ?)
+                ON CONFLICT(dimension, value, bucket) DO UPDATE SET count = count + excluded.count
+            """, counts.itertuples(index=False, name=None))
+            conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('ticket_sla_watermark', ?)", (json.dumps(mark),))
+            conn.commit()
+            folded += len(chunk)
+
+        # Backlog: one covering-index range count per age bucket over the open tickets only
+        now = utcnow_naive()
+        conn.execute("DELETE FROM ticket_sla_rollup WHERE dimension = 'backlog'")
+        edges = [d for d, _ in BACKLOG_AGE_BUCKETS[1:]]
+        bounds = [None] + [(now - timedelta(days=d)).isoformat() for d in edges] + [None]
+        for i in range(len(BACKLOG_AGE_BUCKETS)):
+            newer, older = bounds[i], bounds[i + 1]
+            query = "SELECT COUNT(*) FROM support_tickets WHERE status_class = 'ongoing'"
+            params = []
+            if newer:
+                query += " AND created_date < ?"
+                params.append(newer)
+            if older:
+                query += " AND created_date >= ?"
+                params.append(older)
+            conn.execute(
+                "INSERT INTO ticket_sla_rollup (dimension, value, bucket, count) VALUES ('backlog', 'open', ?, ?)",
+                (i, conn.execute(query, params).fetchone()[0]),
+            )
+        conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('ticket_sla_refreshed', ?)", (now.isoformat(),))
+        conn.commit()
+    finally:
+        conn.close()
+    return {'tickets_folded': folded, 'watermark': mark[0], 'elapsed_seconds': round(time.perf_counter() - started, 3)}
+
+
+def _histogram_percentile(buckets, counts, q):
+    """Percentile from bucket counts, interpolating linearly inside the bucket"""
+    order = np.argsort(buckets)
+    buckets, counts = np.asarray(buckets)[order], np.asarray(counts, dtype=np.float64)[order]
+    cumulative = np.cumsum(counts)
+    target = q / 100 * cumulative[-1]
+    i = int(np.searchsorted(cumulative, target))
+    i = min(i, len(buckets) - 1)
+    b = buckets[i]
+    lo = SLA_BUCKET_EDGES[b - 1] if b > 0 else 0.0
+    hi = SLA_BUCKET_EDGES[b] if b < len(SLA_BUCKET_EDGES) else SLA_BUCKET_EDGES[-1]
+    before = cumulative[i] - counts[i]
+    return lo + (hi - lo) * ((target - before) / counts[i] if counts[i] else 0)
+
+
+def get_sla_percentiles(dimension='all'):
+    """Resolved-ticket count and p50/p90/p99 resolution hours per value of a dimension"""
+    rollup = df_from_query(
+        "SELECT value, bucket, count FROM ticket_sla_rollup WHERE dimension = ? AND count > 0", (dimension,)
+    )
+    rows = []
+    for value, group in rollup.groupby('value'):
+        row = {dimension: value, 'resolved': int(group['count'].sum())}
+        for q in (50, 90, 99):
+            row[f'p{q}_hours'] = round(_histogram_percentile(group['bucket'], group['count'], q), 1)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=[dimension, 'resolved', 'p50_hours', 'p90_hours', 'p99_hours'])
+
+
+def get_backlog_ages():
+    """Open tickets per age bucket as of the last refresh"""
+    rows = dict(exec_query(
+        "SELECT bucket, count FROM ticket_sla_rollup WHERE dimension = 'backlog'", fetch=True
+    ))
+    return pd.DataFrame({'age': [label for _, label in BACKLOG_AGE_BUCKETS],
+                         'open_tickets': [rows.get(i, 0) for i in range(len(BACKLOG_AGE_BUCKETS))]})
+
+# ---------------------------
+# Ticket Assignment
+# ---------------------------
+def claim_next_ticket(agent, conn=None, now=None, lease_seconds=TICKET_LEASE_SECONDS):
+    """Atomically lease the next-best open ticket to an agent, or return None.
+
+    Order is priority, then SLA deadline, then ticket id. Leases that ran out are
+    returned to the queue first, so a crashed agent's ticket is picked up again.
+    """
+    own = conn is None
+    conn = conn or get_ingest_conn()
+    now = now or utcnow_naive()
+    now_iso = now.isoformat()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE ticket_queue SET agent = NULL, lease_until = NULL WHERE lease_until IS NOT NULL AND lease_until < ?",
+                (now_iso,),
+            )
+            row = conn.execute("""
+                UPDATE ticket_queue
+                SET agent = ?, lease_until = ?, claims = claims + 1
+                WHERE ticket_id = (
+                    SELECT ticket_id FROM ticket_queue INDEXED BY idx_ticket_queue_next
+                    WHERE lease_until IS NULL
+                    ORDER BY priority_rank, sla_deadline, ticket_id
+                    LIMIT 1
+                )
+                RETURNING ticket_id, priority_rank, sla_deadline, lease_until, claims
+            """, (agent, (now + timedelta(seconds=lease_seconds)).isoformat())).fetchone()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return row_to_dict(row) if row else None
+    finally:
+        if own:
+            conn.close()
+
+
+def renew_ticket_lease(ticket_id, agent, lease_seconds=TICKET_LEASE_SECONDS):
+    """Extend an agent's lease on a ticket; False if the agent no longer holds it"""
+    now = utcnow_naive()
+    conn = get_conn()
+    try:
+        updated = conn.execute(
+            "UPDATE ticket_queue SET lease_until = ? WHERE ticket_id = ? AND agent = ? AND lease_until >= ?",
+            ((now + timedelta(seconds=lease_seconds)).isoformat(), ticket_id, agent, now.isoformat()),
+        ).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return updated == 1
+
+
+def release_ticket(ticket_id, agent):
+    """Hand a claimed ticket back to the queue"""
+    conn = get_conn()
+    try:
+        updated = conn.execute(
+            "UPDATE ticket_queue SET agent = NULL, lease_until = NULL WHERE ticket_id = ? AND agent = ?",
+            (ticket_id, agent),
+        ).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return updated == 1
+
+
+def complete_ticket(ticket_id, agent, status='resolved', conn=None):
+    """Set the final status of a ticket the agent still holds; the queue row goes with it.
+
+    Returns (ok, msg) like the admin actions.
+    """
+    own = conn is None
+    conn = conn or get_conn()
+    now_iso = utcnow_naive().isoformat()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            held = conn.execute(
+                "SELECT 1 FROM ticket_queue WHERE ticket_id = ? AND agent = ? AND lease_until >= ?",
+                (ticket_id, agent, now_iso),
+            ).fetchone()
+            if not held:
+                conn.rollback()
+                return False, "Ticket is not leased to you (the lease may have expired)"
+            conn.execute(
+                "UPDATE support_tickets SET status = ?, resolved_date = CASE WHEN ? = 'resolved' THEN ? ELSE resolved_date END WHERE id = ?",
+                (status, ticket_status_class(status), now_iso[:19], ticket_id),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return True, f"Ticket #{ticket_id} marked {status}"
+    finally:
+        if own:
+            conn.close()
+
+
+def get_ticket_queue_stats(now=None):
+    """Queued, claimed and past-SLA counts for the assignment queue"""
+    now_iso = (now or utcnow_naive()).isoformat()
+    row = exec_query("""
+        SELECT COUNT(*),
+               COALESCE(SUM(lease_until IS NOT NULL AND lease_until >= ?), 0),
+               COALESCE(SUM(sla_deadline < ?), 0)
+        FROM ticket_queue
+    """, (now_iso, now_iso), fetch=True)[0]
+    return {'queued': row[0] - row[1], 'claimed': row[1], 'past_sla': row[2]}
+
+
+def rebuild_ticket_queue():
+    """Queue every open ticket that is not queued yet (tickets predating the queue triggers)"""
+    conn = get_conn()
+    try:
+        open_ids = [r[0] for r in conn.execute(
+            "SELECT id FROM support_tickets WHERE status_class = 'ongoing' AND id NOT IN (SELECT ticket_id FROM ticket_queue)"
+        )]
+        # Re-setting priority fires trg_tickets_queue_update, which queues the row
+        conn.executemany("UPDATE support_tickets SET priority = priority WHERE id = ?", ((i,) for i in open_ids))
+        conn.commit()
+    finally:
+        conn.close()
+    return len(open_ids)
+
+
+def benchmark_ticket_queue(tickets=200000, agents=32, seconds=10.0):
+    """Seed open tickets and let `agents` threads claim and resolve them for `seconds`.
+
+    Reports claims per second and checks that no ticket was handed to two agents.
+    """
+    rng = np.random.default_rng(0)
+    conn = get_ingest_conn()
+    user_id = conn.execute("SELECT COALESCE(MIN(id), 1) FROM users").fetchone()[0]
+    start = utcnow_naive() - timedelta(days=7)
+    offsets = rng.integers(0, 7 * 86400, tickets)
+    priorities = rng.choice(TICKET_PRIORITIES, tickets)
+    conn.executemany(
+        "INSERT INTO support_tickets (user_id, subject, description, category, status, priority, created_date) VALUES (?, ?, ?, ?, 'open', ?, ?)",
+        ((user_id, f"Benchmark ticket {i}", "Generated for the assignment benchmark", 'technical', str(priorities[i]),
+          (start + timedelta(seconds=int(offsets[i]))).isoformat(timespec='seconds')) for i in range(tickets)),
+    )
+    conn.commit()
+    conn.close()
+
+    claimed = {}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + seconds
+    errors = []
 
-def admin_send_message(message, target="all"):
+    def agent_loop(name):
+        agent_conn = get_ingest_conn()
+        try:
+            while time.perf_counter() < stop_at:
+                ticket = claim_next_ticket(name, conn=agent_conn)
+                if ticket is None:
+                    break
+                with lock:
+                    claimed.setdefault(ticket['ticket_id'], []).append(name)
+                ok, msg = complete_ticket(ticket['ticket_id'], name, conn=agent_conn)
+                if not ok:
+                    errors.append(msg)
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            agent_conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=agent_loop, args=(f"agent{i}",)) for i in range(agents)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'open_tickets': tickets,
+        'agents': agents,
+        'claims': len(claimed),
+        'double_assigned': sum(len(v) > 1 for v in claimed.values()),
+        'errors': len(errors),
+        'claims_per_second': round(len(claimed) / elapsed, 1),
+        'elapsed_seconds': round(elapsed, 3),
+    }
+
+
+# ---------------------------
+# Plan Index
+# ---------------------------
+class PlanIndex:
+    """In-memory index of the plan catalog for the All Plans filters and the comparison picker.
+
+    Range fields (price, speed, data limit, price per GB) are kept as sorted NumPy arrays,
+    so a range is two binary searches. plan_type and is_unlimited are bitmaps (boolean
+    masks) and names are a sorted array for prefix lookups. Filters combine as masks over
+    the catalog in price order. The index rebuilds when the plan catalog version moves,
+    checked at most once per refresh_seconds (None: a static index of what load() was given).
     """
-    Send a custom message from admin to users.
-    target: "all", "active", "inactive"
+    RANGE_FIELDS = ('price', 'speed_mbps', 'data_limit_gb', 'price_per_gb')
+
+    def __init__(self, refresh_seconds=PLAN_INDEX_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._version = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.load([])
+
+    def load(self, plans):
+        """Build the arrays for a list of plan dicts (in the order results should come back)"""
+        plans = list(plans)
+        n = len(plans)
+        values = {
+            field: np.array([p.get(field) or 0 for p in plans], dtype=np.float64)
+            for field in ('price', 'speed_mbps', 'data_limit_gb')
+        }
+        unlimited = np.array([bool(p.get('is_unlimited')) for p in plans], dtype=bool)
+        # Price per GB only exists for capped plans; NaN keeps unlimited ones out of its ranges
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values['price_per_gb'] = np.where(~unlimited & (values['data_limit_gb'] > 0),
+                                              values['price'] / values['data_limit_gb'], np.nan)
+        order = {field: np.argsort(v, kind='stable') for field, v in values.items()}
+        types = np.array([(p.get('plan_type') or 'basic').lower() for p in plans], dtype=object)
+        names = np.array([str(p.get('name') or '').lower() for p in plans], dtype=object)
+        name_order = np.argsort(names, kind='stable') if n else np.array([], dtype=np.int64)
+        # Swap in every array at once so concurrent readers never see a half-built index
+        self._state = {
+            'plans': plans,
+            'values': values,
+            'order': order,
+            'sorted': {field: values[field][order[field]] for field in values},
+            'types': {t: types == t for t in set(types.tolist())},
+            'unlimited': unlimited,
+            'name_order': name_order,
+            'names_sorted': names[name_order].astype(str),
+            'by_name': {p.get('name'): i for i, p in enumerate(plans)},
+        }
+
+    def _current(self):
+        if self.refresh_seconds is not None and time.monotonic() >= self._next_check:
+            with self._lock:
+                version = plan_catalog_version()
+                if version != self._version:
+                    self.load(get_all_plans())
+                    self._version = version
+                self._next_check = time.monotonic() + self.refresh_seconds
+        return self._state
+
+    def mask(self, plan_type=None, is_unlimited=None, name_prefix=None, **ranges):
+        """Boolean mask over the catalog; ranges are field=(low, high), inclusive, None for open"""
+        state = self._current()
+        mask = np.ones(len(state['plans']), dtype=bool)
+        for field, (low, high) in ranges.items():
+            sorted_values = state['sorted'][field]
+            start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+            stop = (len(sorted_values) - np.isnan(sorted_values).sum() if high is None
+                    else np.searchsorted(sorted_values, high, side='right'))
+            hits = np.zeros_like(mask)
+            hits[state['order'][field][start:stop]] = True
+            mask &= hits
+        if plan_type is not None:
+            mask &= state['types'].get(plan_type.lower(), np.zeros_like(mask))
+        if is_unlimited is not None:
+            mask &= state['unlimited'] if is_unlimited else ~state['unlimited']
+        if name_prefix:
+            prefix = name_prefix.lower()
+            names = state['names_sorted']
+            start = np.searchsorted(names, prefix, side='left')
+            stop = np.searchsorted(names, prefix + '\U0010ffff', side='left')
+            hits = np.zeros_like(mask)
+            hits[state['name_order'][start:stop]] = True
+            mask &= hits
+        return mask
+
+    def filter(self, **criteria):
+        """Plans matching every criterion of mask(), in catalog (price) order"""
+        plans = self._current()['plans']
+        return [plans[i] for i in np.flatnonzero(self.mask(**criteria))]
+
+    def get(self, name):
+        """The plan with this exact name, or None"""
+        state = self._current()
+        i = state['by_name'].get(name)
+        return None if i is None else state['plans'][i]
+
+    def names(self, prefix=''):
+        """Plan names starting with prefix (case-insensitive), in price order"""
+        return [p['name'] for p in self.filter(name_prefix=prefix)]
+
+
+PLAN_INDEX = PlanIndex()
+
+
+def benchmark_plan_index(plans=5000, queries=2000):
+    """Compare PlanIndex filters with list comprehensions over a synthetic catalog (no database writes)"""
+    rng = np.random.default_rng(0)
+    catalog = sorted(({
+        'id': i, 'name': f"City {i % 300} {t.title()} {s}", 'price': float(rng.integers(3, 60) * 50),
+        'speed_mbps': int(s), 'data_limit_gb': float(rng.choice([100, 250, 500, 1000])),
+        'plan_type': t, 'is_unlimited': int(rng.random() < 0.2),
+    } for i, (s, t) in enumerate(zip(rng.choice([50, 100, 200, 500, 1000], plans),
+                                      rng.choice(['basic', 'standard', 'premium', 'elite'], plans)))),
+        key=lambda p: p['price'])
+    index = PlanIndex(refresh_seconds=None)
+    started = time.perf_counter()
+    index.load(catalog)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    lows = (rng.integers(1, 20, queries) * 50).tolist()
+    started = time.perf_counter()
+    for low in lows:
+        index.mask(price=(low, low + 500), speed_mbps=(101, 500), plan_type='premium')
+    mask_us = (time.perf_counter() - started) / queries * 1e6
+    started = time.perf_counter()
+    for low in lows:
+        index.filter(price=(low, low + 500), speed_mbps=(101, 500), plan_type='premium')
+    filter_us = (time.perf_counter() - started) / queries * 1e6
+    started = time.perf_counter()
+    for low in lows:
+        matched = [p for p in catalog if low <= p['price'] <= low + 500]
+        matched = [p for p in matched if 101 <= p['speed_mbps'] <= 500]
+        matched = [p for p in matched if p['plan_type'] == 'premium']
+    list_us = (time.perf_counter() - started) / queries * 1e6
+    started = time.perf_counter()
+    for i in rng.integers(0, plans, queries):
+        index.get(catalog[i]['name'])
+    get_us = (time.perf_counter() - started) / queries * 1e6
+    return {'plans': plans, 'build_ms': round(build_ms, 2), 'mask_us': round(mask_us, 1),
+            'filter_us': round(filter_us, 1), 'list_comprehension_us': round(list_us, 1),
+            'name_lookup_us': round(get_us, 2)}
+
+
+# ---------------------------
+# Search
+# ---------------------------
+SEARCH_ICONS = {'ticket': '🎫', 'user': '👤', 'plan': '📦'}
+_SEARCH_TITLES = {
+    'ticket': "'#' || t.id || ' ' || COALESCE(t.subject, '') || ' (' || COALESCE(t.status, '') || ')'",
+    'user': "COALESCE(t.name, t.username) || ' (@' || COALESCE(t.username, '') || ')'",
+    'plan': "printf('%s, ₹%.0f', t.name, t.price)",
+}
+
+
+def _fts_query(text):
+    """Free text to an FTS5 query: every word must match, each as a prefix.
+
+    Words are reduced to their letters and digits, so quotes and operators typed by a user
+    cannot break the query; an email or dotted name becomes a phrase ("a b com"*).
     """
-    now = utcnow_naive().isoformat()
+    terms = []
+    for word in text.split():
+        tokens = re.findall(r"\w+", word)
+        if tokens:
+            terms.append('"' + " ".join(tokens) + '"*')
+    return " ".join(terms)
 
-    if target == "all":
-        user_rows = exec_query("SELECT id FROM users WHERE role = 'user'", fetch=True)
-    elif target == "active":
-        user_rows = exec_query("""
-            SELECT DISTINCT u.id 
-            FROM users u
-            JOIN subscriptions s ON u.id = s.user_id
-            WHERE u.role = 'user' AND s.status = 'active'
-        """, fetch=True)
-    elif target == "inactive":
-        user_rows = exec_query("""
-            SELECT id FROM users
-            WHERE role = 'user' AND id NOT IN (
-                SELECT user_id FROM subscriptions WHERE status = 'active'
-            )
-        """, fetch=True)
-    else:
-        return False, "Invalid target"
 
-    for row in user_rows:
-        exec_query(
-            "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, ?, ?, ?)",
-            (row[0], message, "admin_broadcast", now)
+def search_index(query, kinds=None, limit=SEARCH_RESULT_LIMIT, markers=("**", "**"), conn=None):
+    """Ranked full-text search over tickets, users and plans.
+
+    Returns dicts (kind, id, title, snippet, score), best first. score is bm25 with the
+    SEARCH_INDEXES column weights (lower is better). Each kind contributes at most `limit`
+    hits before the merge, so one index cannot starve the others of the top slots.
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+    own = conn is None
+    conn = conn or get_conn()
+    results = []
+    try:
+        for kind in kinds or SEARCH_INDEXES:
+            fts, table, weights = SEARCH_INDEXES[kind]
+            # FTS5 sorts on rank itself, so snippets and titles are built for the top rows only
+            rows = conn.execute(f"""
+                SELECT t.id, {_SEARCH_TITLES[kind]}, f.snippet, f.score
+                FROM (
+                    SELECT rowid, snippet({fts}, -1, ?, ?, '…', 12) AS snippet, rank AS score
+                    FROM {fts}
+                    WHERE {fts} MATCH ? AND rank MATCH ?
+                    ORDER BY rank
+                    LIMIT ?
+                ) f JOIN {table} t ON t.id = f.rowid
+                ORDER BY f.score
+            """, (markers[0], markers[1], match, f"bm25({', '.join(str(w) for w in weights.values())})", limit)).fetchall()
+            results.extend({'kind': kind, 'id': r[0], 'title': r[1], 'snippet': r[2], 'score': r[3]} for r in rows)
+    finally:
+        if own:
+            conn.close()
+    results.sort(key=lambda r: r['score'])
+    return results[:limit]
+
+
+def rebuild_search_index(optimize=False):
+    """Re-read every indexed row from the base tables; optimize merges index segments after bulk loads"""
+    conn = get_conn()
+    counts = {}
+    try:
+        for kind, (fts, table, _weights) in SEARCH_INDEXES.items():
+            conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+            if optimize:
+                conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('optimize')")
+            counts[kind] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    return counts
+
+
+def benchmark_search(rows=1000000, queries=200):
+    """Seed `rows` closed tickets of random words, then time prefix and full-word searches"""
+    rng = np.random.default_rng(0)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vocab = ["".join(rng.choice(letters, n)) for n in rng.integers(5, 10, 5000)]
+    conn = get_ingest_conn()
+    user_id = conn.execute("SELECT COALESCE(MIN(id), 1) FROM users").fetchone()[0]
+    started = time.perf_counter()
+    for lo in range(0, rows, 50000):
+        n = min(50000, rows - lo)
+        words = rng.integers(0, len(vocab), (n, 24))
+        conn.executemany(
+            "INSERT INTO support_tickets (user_id, subject, description, category, status, priority, created_date) VALUES (?, ?, ?, 'technical', 'closed', 'low', ?)",
+            ((user_id, " ".join(vocab[w] for w in ws[:4]), " ".join(vocab[w] for w in ws[4:]), '2024-01-01T00:00:00') for ws in words),
         )
-    return True, f"Message sent to {len(user_rows)} users."
+        conn.commit()
+    load_seconds = time.perf_counter() - started
+    conn.close()
+
+    timings = {'prefix': [], 'word': [], 'two_words': []}
+    hits = []
+    conn = get_conn()
+    try:
+        for _ in range(queries):
+            a, b = (vocab[i] for i in rng.integers(0, len(vocab), 2))
+            for name, q in (('prefix', a[:4]), ('word', a), ('two_words', f"{a} {b[:3]}")):
+                t0 = time.perf_counter()
+                hits.append(len(search_index(q, conn=conn)))
+                timings[name].append((time.perf_counter() - t0) * 1000)
+    finally:
+        conn.close()
+    result = {'rows': rows, 'load_seconds': round(load_seconds, 1), 'mean_hits': round(float(np.mean(hits)), 1)}
+    for name, ms in timings.items():
+        result[f'{name}_p50_ms'] = round(float(np.percentile(ms, 50)), 2)
+        result[f'{name}_p95_ms'] = round(float(np.percentile(ms, 95)), 2)
+    return result
+
+
+# ---------------------------
+# Bulk User Import / Export
+# ---------------------------
+_USERNAME_PATTERN = r"[A-Za-z0-9_.@+-]{3,64}"
+_USER_IMPORT_FIELDS = ('username', 'password_hash', 'role', 'name', 'email', 'city', 'state', 'phone', 'address', 'signup_date')
+# Rows are staged in a temp table and inserted with one INSERT ... SELECT per chunk. Row-by-row
+# inserts would make the FTS5 sync trigger flush its pending terms at every statement (~13x slower)
+_USER_IMPORT_SQL = f"""
+    INSERT INTO users ({', '.join(_USER_IMPORT_FIELDS)})
+    SELECT {', '.join(_USER_IMPORT_FIELDS)} FROM user_import_rows i
+    WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.username = i.username)
+    ORDER BY i.row
+"""
+
+
+def _hash_password_batch(passwords):
+    return [hash_password(p) for p in passwords]
+
+
+def coerce_user_frame(df, default_role='user'):
+    """Vectorized validation of an imported users chunk; returns (clean rows, {index: error})"""
+    out = pd.DataFrame(index=df.index)
+    for col in USER_IMPORT_COLUMNS:
+        out[col] = df[col].astype(str).str.strip() if col in df else ''
+    out['role'] = out['role'].str.lower().replace('', default_role)
+    out['signup_date'] = out['signup_date'].where(out['signup_date'] != '', utcnow_naive().isoformat())
+    checks = (
+        (~out['username'].str.fullmatch(_USERNAME_PATTERN), "invalid username (3-64 letters, digits or _.@+-)"),
+        (out['password'] == '', "missing password"),
+        ((out['email'] != '') & ~out['email'].str.contains('@', regex=False), "invalid email"),
+        (~out['role'].isin(('user', 'admin')), "role must be user or admin"),
+        (out['username'].duplicated(), "duplicate username in file"),
+    )
+    errors = {}
+    # Later checks overwrite earlier ones, so go in reverse to report the first failure per row
+    for failed, message in reversed(checks):
+        errors.update(dict.fromkeys(out.index[failed.to_numpy()], message))
+    return out.drop(index=list(errors)), errors
+
+
+def import_users_csv(source, chunk_rows=USER_IMPORT_CHUNK_ROWS, workers=None, error_report=None, default_role='user'):
+    """Onboard users from a CSV with a header naming USER_IMPORT_COLUMNS (username and password required).
+
+    The file is read chunk_rows at a time. Each chunk is validated in vectorized form, checked
+    against existing usernames with one join on a temp table, hashed in a process pool and
+    inserted in one transaction. Rejected rows go to error_report (a path or file object) as
+    line, username, error; line numbers count the header as line 1.
+    """
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    rows_read = inserted = 0
+    report_fh = open(error_report, 'w', newline='') if isinstance(error_report, str) else error_report
+    report = csv.writer(report_fh) if report_fh is not None else None
+    if report:
+        report.writerow(['line', 'username', 'error'])
+    errors_total = 0
+
+    def _report(frame, errors):
+        nonlocal errors_total
+        errors_total += len(errors)
+        if report:
+            report.writerows((i + 2, frame.at[i, 'username'] if 'username' in frame else '', msg) for i, msg in sorted(errors.items()))
+
+    conn = get_ingest_conn()
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS user_import_rows (row INTEGER PRIMARY KEY, {', '.join(_USER_IMPORT_FIELDS)})")
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for frame in pd.read_csv(source, chunksize=chunk_rows, dtype=str, keep_default_na=False, skipinitialspace=True):
+                rows_read += len(frame)
+                if 'username' not in frame or 'password' not in frame:
+                    raise ValueError("CSV must have username and password columns")
+                clean, errors = coerce_user_frame(frame, default_role=default_role)
+
+                # Hash before taking the write lock; rows that turn out to be taken are rare
+                passwords = clean['password'].tolist()
+                step = max(1, math.ceil(len(passwords) / workers))
+                clean['password_hash'] = list(itertools.chain.from_iterable(
+                    pool.map(_hash_password_batch, [passwords[i:i + step] for i in range(0, len(passwords), step)])
+                ))
+                # The username check and the insert share one transaction, so a user created
+                # meanwhile in the app cannot slip in between them
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("DELETE FROM user_import_rows")
+                    conn.executemany(
+                        f"INSERT INTO user_import_rows VALUES ({', '.join('?' * (len(_USER_IMPORT_FIELDS) + 1))})",
+                        zip(clean.index.tolist(), *(clean[col].tolist() for col in _USER_IMPORT_FIELDS)),
+                    )
+                    taken = [r[0] for r in conn.execute(
+                        "SELECT i.row FROM user_import_rows i JOIN users u ON u.username = i.username")]
+                    errors.update(dict.fromkeys(taken, "username already exists"))
+                    conn.execute(_USER_IMPORT_SQL)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                inserted += len(clean) - len(taken)
+                _report(frame, errors)
+    finally:
+        conn.close()
+        if isinstance(error_report, str):
+            report_fh.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'rows_read': rows_read,
+        'users_created': inserted,
+        'rows_rejected': errors_total,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(rows_read / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def iter_users_csv(chunk_rows=USER_IMPORT_CHUNK_ROWS, columns=USER_EXPORT_COLUMNS):
+    """Yield the users table as CSV text, header first, one id-ordered chunk at a time"""
+    conn = get_conn()
+    conn.row_factory = None
+    try:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT {', '.join(columns)} FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_rows)
+            ).fetchall()
+            if not rows:
+                break
+            writer.writerows(rows)
+            last_id = rows[-1][0]
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+    finally:
+        conn.close()
+
+
+def export_users_csv(path, chunk_rows=USER_IMPORT_CHUNK_ROWS):
+    """Stream the users table to a CSV (or .csv.gz) file; returns rows written"""
+    rows = -1
+    with (gzip.open(path, 'wt', newline='') if path.endswith('.gz') else open(path, 'w', newline='')) as fh:
+        for text in iter_users_csv(chunk_rows=chunk_rows):
+            fh.write(text)
+            rows += text.count('\n')
+    return max(rows, 0)
+
+
+def benchmark_user_import(rows=200000, workers=None):
+    """Import `rows` synthetic users (1% invalid, 1% duplicates) and export them back"""
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix="user_import_")
+    path, errors = os.path.join(tmp, "users.csv"), os.path.join(tmp, "errors.csv")
+    tag = uuid.uuid4().hex[:6]
+    names = [f"bulk_{tag}_{i}" for i in range(rows)]
+    for i in range(0, rows, 100):
+        names[i] = names[i - 1] if i else "x"  # duplicates, and one too-short username
+    pd.DataFrame({
+        'username': names,
+        'password': [f"pw{i:08d}" for i in range(rows)],
+        'name': [f"Bulk User {i}" for i in range(rows)],
+        'email': [f"{n}@example.com" for n in names],
+        'city': np.random.default_rng(0).choice(['Mumbai', 'Delhi', 'Bengaluru', 'Chennai', 'Pune'], rows),
+    }).to_csv(path, index=False)
+    try:
+        result = import_users_csv(path, workers=workers, error_report=errors)
+        started = time.perf_counter()
+        result['rows_exported'] = export_users_csv(os.path.join(tmp, "export.csv.gz"))
+        result['export_seconds'] = round(time.perf_counter() - started, 3)
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+    return result
+
+
+# ---------------------------
+# Notification Retention
+# ---------------------------
+def get_db_space_stats(conn):
+    """Page-level size of the database file: total bytes and bytes sitting on the freelist"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {'size_bytes': page_size * page_count, 'free_bytes': page_size * freelist}
+
+
+def _purge_in_batches(conn, delete_sql, params, batch_size, archive_fh=None, pause_seconds=0.0):
+    """Run a DELETE ... LIMIT ? RETURNING * repeatedly, one short write transaction per batch"""
+    deleted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(delete_sql, (*params, batch_size)).fetchall()
+            if archive_fh is not None:
+                for r in rows:
+                    archive_fh.write(json.dumps(row_to_dict(r)) + "\n")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+
+def run_notification_retention(retention_days=None, batch_size=RETENTION_BATCH_SIZE, archive=False,
+                               vacuum=False, pause_seconds=0.0, default_days=NOTIFICATION_RETENTION_DEFAULT_DAYS):
+    """Delete notifications older than their type's TTL, plus old sent/dead outbox rows.
+
+    Types missing from retention_days expire after default_days (None keeps them).
+    Deletes run in bounded batches so other writers are never locked out for long.
+    With archive=True the deleted rows are written to a gzip JSON-lines file first.
+    Space is returned to the freelist; pass vacuum=True to shrink the file as well.
+    """
+    retention_days = dict(NOTIFICATION_RETENTION_DAYS if retention_days is None else retention_days)
+    now = datetime.utcnow()
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 30000")
+    # Unlisted types are purged one type at a time too, so every delete seeks the type index
+    for (notification_type,) in conn.execute("SELECT DISTINCT notification_type FROM notifications"):
+        retention_days.setdefault(notification_type, default_days)
+    archive_path, archive_fh = None, None
+    try:
+        before = get_db_space_stats(conn)
+        if archive:
+            os.makedirs(NOTIFICATION_ARCHIVE_DIR, exist_ok=True)
+            archive_path = os.path.join(NOTIFICATION_ARCHIVE_DIR, f"notifications-{now.strftime('%Y%m%dT%H%M%S')}.jsonl.gz")
+            archive_fh = gzip.open(archive_path, 'at', encoding='utf-8')
+
+        deleted_by_type = {}
+        for notification_type, days in retention_days.items():
+            if days is None:
+                continue
+            cutoff = (now - timedelta(days=days)).isoformat()
+            deleted_by_type[notification_type] = _purge_in_batches(conn, """
+                DELETE FROM notifications WHERE id IN (
+                    SELECT id FROM notifications
+                    WHERE notification_type IS ? AND created_date < ?
+                    LIMIT ?
+                ) RETURNING *
+            """, (notification_type, cutoff), batch_size, archive_fh, pause_seconds)
+
+        outbox_cutoff = (now - timedelta(days=DELIVERY_RETENTION_DAYS)).isoformat()
+        outbox_deleted = _purge_in_batches(conn, """
+            DELETE FROM notification_outbox WHERE id IN (
+                SELECT id FROM notification_outbox
+                WHERE status IN ('sent', 'dead') AND created_date < ?
+                LIMIT ?
+            ) RETURNING id
+        """, (outbox_cutoff,), batch_size, None, pause_seconds)
+
+        if archive_fh is not None:
+            archive_fh.close()
+            archive_fh = None
+        if vacuum:
+            conn.execute("VACUUM")
+        after = get_db_space_stats(conn)
+    finally:
+        if archive_fh is not None:
+            archive_fh.close()
+        conn.close()
+
+    return {
+        'deleted_by_type': deleted_by_type,
+        'notifications_deleted': sum(deleted_by_type.values()),
+        'outbox_rows_deleted': outbox_deleted,
+        'archive_path': archive_path,
+        'db_size_before_bytes': before['size_bytes'],
+        'db_size_after_bytes': after['size_bytes'],
+        'reclaimed_bytes': (before['size_bytes'] - after['size_bytes']) + (after['free_bytes'] - before['free_bytes']),
+        'vacuumed': vacuum,
+    }
 
 # ---------------------------
 # UI Components (Enhanced)
@@ -1877,8 +7177,8 @@ def render_plan_card(
                 key=f"{sec}_sub_{plan['id']}_{current_user_id}",
                 use_container_width=True
             ):
-                subscribe_user_to_plan(current_user_id, plan['id'])
-                create_payment(None, current_user_id, plan['price'])
+                subscription_id = subscribe_user_to_plan(current_user_id, plan['id'])
+                create_payment(subscription_id, current_user_id, plan['price'])
                 st.success(f"Successfully subscribed to {plan['name']}!")
                 st.rerun()
         with col2:
@@ -1957,12 +7257,15 @@ def render_usage_analytics(user_id):
     fig.update_layout(showlegend=False)
     st.plotly_chart(fig, use_container_width=True)
     
-    # Peak vs Off-peak usage (if available)
-    if 'peak_hour_usage' in usage_df.columns and 'off_peak_usage' in usage_df.columns:
+    # Peak vs Off-peak usage: measured from hourly buckets when the user has them,
+    # otherwise the daily split
+    hourly_split = get_hourly_peak_split(user_id, start=usage_df['date'].min().date())
+    if not hourly_split.empty or ('peak_hour_usage' in usage_df.columns and 'off_peak_usage' in usage_df.columns):
         st.subheader("Peak vs Off-Peak Usage")
         
-        peak_avg = usage_df['peak_hour_usage'].mean()
-        off_peak_avg = usage_df['off_peak_usage'].mean()
+        split_df = hourly_split if not hourly_split.empty else usage_df
+        peak_avg = split_df['peak_hour_usage'].mean()
+        off_peak_avg = split_df['off_peak_usage'].mean()
         
         col1, col2 = st.columns(2)
         with col1:
@@ -1980,6 +7283,13 @@ def render_usage_analytics(user_id):
                     title="Peak vs Off-Peak Usage Comparison",
                     color='Type')
         st.plotly_chart(fig, use_container_width=True)
+    
+    if not hourly_split.empty:
+        heat = get_usage_heatmap(user_id=user_id, start=usage_df['date'].min().date())
+        fig = px.imshow(heat, aspect='auto', color_continuous_scale='Blues',
+                        labels={'x': 'Hour of Day (UTC)', 'y': 'Weekday', 'color': 'Avg GB'},
+                        title="When You Use Your Connection")
+        st.plotly_chart(fig, use_container_width=True)
 
 def render_plan_comparison():
     """Render plan comparison functionality"""
@@ -1990,18 +7300,16 @@ def render_plan_comparison():
         st.session_state['comparison_plans'] = []
     
     # Plan search and add functionality
-    all_plans = get_all_plans()
-    
     col1, col2 = st.columns([3, 1])
     with col1:
         selected_plan_name = st.selectbox(
             "Search and add plans to compare:",
-            options=["Select a plan..."] + [p['name'] for p in all_plans],
+            options=["Select a plan..."] + PLAN_INDEX.names(),
             key="plan_search_select"
         )
     with col2:
         if st.button("Add Plan", disabled=(selected_plan_name == "Select a plan...")):
-            selected_plan = next((p for p in all_plans if p['name'] == selected_plan_name), None)
+            selected_plan = PLAN_INDEX.get(selected_plan_name)
             if selected_plan and selected_plan not in st.session_state['comparison_plans']:
                 st.session_state['comparison_plans'].append(selected_plan)
                 st.success(f"Added {selected_plan['name']} to comparison!")
@@ -2013,22 +7321,28 @@ def render_plan_comparison():
     if st.session_state['comparison_plans']:
         st.markdown("### Comparison Table")
         
-        # Create comparison dataframe
-        comparison_data = []
-        for plan in st.session_state['comparison_plans']:
-            comparison_data.append({
-                'Plan Name': plan['name'],
-                'Price (₹)': plan['price'],
-                'Speed (Mbps)': plan['speed_mbps'],
-                'Upload (Mbps)': 100,
-                'Data Limit': 'Unlimited' if plan.get('is_unlimited') else f"{plan['data_limit_gb']} GB",
-                'Validity': f"{plan['validity_days']} days",
-                'Type': plan.get('plan_type', 'basic').title(),
-                'Price/GB': f"₹{plan['price']/plan['data_limit_gb']:.2f}" if not plan.get('is_unlimited') else 'N/A'
-            })
-        
-        comparison_df = pd.DataFrame(comparison_data)
+        user = st.session_state.get('user')
+        monthly_gb = projected_monthly_usage_gb(user['id']) if user and user.get('role') == 'user' else None
+        metrics = get_plan_comparison([p['id'] for p in st.session_state['comparison_plans']], monthly_gb=monthly_gb)
+        comparison_df = pd.DataFrame({
+            'Plan Name': metrics['name'],
+            'Price (₹)': metrics['price'],
+            'Speed (Mbps)': metrics['speed_mbps'].astype(int),
+            'Upload (Mbps)': metrics['upload_mbps'].astype(int),
+            'Data Limit': np.where(metrics['is_unlimited'], 'Unlimited', metrics['data_limit_gb'].map('{:g} GB'.format)),
+            'Validity': metrics['validity_days'].map('{} days'.format),
+            'Type': metrics['plan_type'].str.title(),
+            'Price/GB': metrics['price_per_gb'].map(lambda v: 'N/A' if pd.isna(v) else f"₹{v:.2f}"),
+            'Mbps per ₹': metrics['mbps_per_rupee'].round(3),
+        })
+        if monthly_gb is not None:
+            comparison_df['Covers Your Usage'] = np.where(metrics['covers_usage'], '✅', '❌')
+            comparison_df['Cost for Your Usage (₹/30 days)'] = metrics['cost_for_usage'].round(0)
+        comparison_df['Better Option'] = metrics['dominated_by'].replace('', '—')
         st.dataframe(comparison_df, use_container_width=True)
+        if monthly_gb is not None:
+            st.caption(f"Based on your projected usage of {monthly_gb:.0f} GB per 30 days; capped plans "
+                       "are costed with enough packs to cover it.")
         
         # Clear comparison button
         col1, col2 = st.columns([1, 4])
@@ -2051,80 +7365,71 @@ def render_billing_history(user_id):
     """Render comprehensive billing history"""
     st.subheader("Billing History")
     
-    # Get payment history with enhanced details
-    payment_query = """
-    SELECT 
-        p.amount, p.payment_date, p.status, p.bill_month, p.bill_year,
-        s.start_date, s.end_date,
-        pl.name as plan_name
-    """
-    
-    if column_exists('payments', 'payment_method'):
-        payment_query += ", p.payment_method"
-    if column_exists('payments', 'transaction_id'):
-        payment_query += ", p.transaction_id"
-    if column_exists('payments', 'tax_amount'):
-        payment_query += ", p.tax_amount, p.discount"
-    
-    payment_query += """
-    FROM payments p
-    LEFT JOIN subscriptions s ON p.subscription_id = s.id
-    LEFT JOIN plans pl ON s.plan_id = pl.id
-    WHERE p.user_id = ?
-    ORDER BY p.payment_date DESC
-    LIMIT 50
-    """
-    
-    payments_df = df_from_query(payment_query, (user_id,))
+    cursors = st.session_state.setdefault('billing_history_cursors', {}).setdefault(user_id, [None])
+    payments_df = get_billing_history(user_id, before=cursors[-1])
     
-    if payments_df.empty:
+    if payments_df.empty and len(cursors) == 1:
         st.info("No billing history found.")
         return
     
-    # Payment statistics
-    total_paid = payments_df[payments_df['status'] == 'paid']['amount'].sum()
-    failed_payments = len(payments_df[payments_df['status'] == 'failed'])
-    avg_monthly = payments_df[payments_df['status'] == 'paid']['amount'].mean()
+    # Payment statistics (lifetime, from the account ledger)
+    summary = get_billing_summary(user_id)
     
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Total Paid", f"₹{total_paid:,.0f}")
+        refunded = summary['total_refunded']
+        st.metric("Total Paid", f"₹{summary['total_paid']:,.0f}",
+                  delta=f"-₹{refunded:,.0f} refunded" if refunded else None, delta_color="off")
     with col2:
-        st.metric("Failed Payments", failed_payments)
+        st.metric("Failed Payments", summary['failed_count'])
     with col3:
-        st.metric("Average Payment", f"₹{avg_monthly:,.0f}")
+        st.metric("Average Payment", f"₹{summary['average_payment']:,.0f}")
     
-    # Payment history table
+    # Payment history table, one keyset page at a time
     st.markdown("### Payment Records")
     
     # Format dates and amounts for display
     display_df = payments_df.copy()
-    display_df['payment_date'] = pd.to_datetime(display_df['payment_date']).dt.strftime('%Y-%m-%d')
+    display_df['payment_date'] = display_df['payment_date'].str[:10]
     display_df['amount'] = display_df['amount'].apply(lambda x: f"₹{x:,.0f}")
     
-    # Select columns to display
-    display_columns = ['payment_date', 'plan_name', 'amount', 'status']
-    if 'payment_method' in display_df.columns:
-        display_columns.append('payment_method')
-    if 'transaction_id' in display_df.columns:
-        display_columns.append('transaction_id')
-    
+    display_columns = ['payment_date', 'plan_name', 'amount', 'status', 'payment_method', 'transaction_id']
     st.dataframe(display_df[display_columns], use_container_width=True)
     
-    # Payment trends chart
-    if len(payments_df) > 3:
+    nav1, nav2, nav3 = st.columns([1, 2, 1])
+    with nav1:
+        if len(cursors) > 1 and st.button("Newer", key="billing_newer"):
+            cursors.pop()
+            st.rerun()
+    with nav2:
+        st.caption(f"Page {len(cursors)}")
+    with nav3:
+        if len(payments_df) == BILLING_HISTORY_PAGE_SIZE and st.button("Older", key="billing_older"):
+            last = payments_df.iloc[-1]
+            cursors.append((last['sort_key'], int(last['id'])))
+            st.rerun()
+    
+    monthly_trends = get_monthly_payment_totals(user_id)
+    
+    # Downloadable statements, rendered on demand for the selected month
+    if not monthly_trends.empty:
+        st.markdown("### Statements")
+        scol1, scol2 = st.columns([2, 1])
+        with scol1:
+            period = st.selectbox("Statement month", monthly_trends['month'].iloc[::-1].tolist(), key="statement_period")
+        with scol2:
+            fmt = st.radio("Format", list(STATEMENT_RENDERERS), horizontal=True, key="statement_format")
+        content = generate_user_statement(user_id, period, fmt)
+        if content:
+            mime = {'txt': 'text/plain', 'html': 'text/html', 'pdf': 'application/pdf'}[fmt]
+            st.download_button(f"Download {period} statement", content, file_name=f"statement-{period}.{fmt}", mime=mime)
+    
+    # Payment trends chart from the per-month aggregate
+    if len(monthly_trends) > 1:
         st.markdown("### Payment Trends")
-        
-        # Monthly payment trends
-        payments_df['payment_date'] = pd.to_datetime(payments_df['payment_date'])
-        payments_df['month_year'] = payments_df['payment_date'].dt.to_period('M')
-        
-        monthly_trends = payments_df[payments_df['status'] == 'paid'].groupby('month_year')['amount'].sum().reset_index()
-        monthly_trends['month_year'] = monthly_trends['month_year'].astype(str)
-        
-        fig = px.line(monthly_trends, x='month_year', y='amount',
+        fig = px.line(monthly_trends, x='month', y='total_paid',
                      title="Monthly Payment Trends",
-                     labels={'amount': 'Amount (₹)', 'month_year': 'Month'})
+                     labels={'total_paid': 'Amount (₹)', 'month': 'Month'})
         st.plotly_chart(fig, use_container_width=True)
 
 # ---------------------------
@@ -2168,7 +7473,7 @@ def process_plan_upgrade(user_id, plan_id):
         prorated_amount = (price_difference * days_remaining) / total_days
         
         # Process payment for prorated amount (simplified)
-        payment_success = process_payment(user_id, prorated_amount)
+        payment_success = process_payment(user_id, prorated_amount, subscription_id=current_sub['id'])
         if not payment_success:
             return False, "Payment failed. Please try again."
             
@@ -2329,7 +7634,7 @@ def process_subscription_cancellation(user_id):
             
             # Process refund
             if refund_amount > 0:
-                process_refund(user_id, refund_amount)
+                process_refund(user_id, refund_amount, subscription_id=current_sub['id'])
         
         # Update subscription record
         exec_query(
@@ -2359,38 +7664,45 @@ def process_subscription_cancellation(user_id):
 
 
 # Helper functions for payment processing (simplified implementations)
-def process_payment(user_id, amount):
+def process_payment(user_id, amount, subscription_id=None):
     """
     Process payment for a user (simplified implementation)
     
     Args:
         user_id (int): User ID
         amount (float): Payment amount
+        subscription_id (int, optional): Subscription the payment is for
         
     Returns:
         bool: True if payment successful, False otherwise
     """
-    # In a real implementation, this would integrate with a payment gateway
-    # For this demo, we'll just simulate a successful payment
+    # Charges go through the payment gateway when PAYMENT_GATEWAY_URL is set;
+    # otherwise the payment is simulated as successful
     try:
+        transaction_id = f"TXN{uuid.uuid4().hex[:8].upper()}"
+        status = 'paid'
+        if get_payment_gateway_url():
+            result = charge_payments([{'transaction_id': transaction_id, 'user_id': user_id, 'amount': amount}])[0]
+            status = result['status']
         # Create a payment record
         exec_query(
-            "INSERT INTO payments (user_id, amount, payment_date, status, payment_method, bill_month, bill_year, transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, amount, datetime.utcnow().isoformat(), 'paid', 'credit_card', datetime.utcnow().month, datetime.utcnow().year, f"TXN{uuid.uuid4().hex[:8].upper()}")
+            "INSERT INTO payments (subscription_id, user_id, amount, payment_date, status, payment_method, bill_month, bill_year, transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (subscription_id, user_id, amount, datetime.utcnow().isoformat(), status, 'credit_card', datetime.utcnow().month, datetime.utcnow().year, transaction_id)
         )
-        return True
+        return status == 'paid'
     except Exception as e:
         print(f"Payment processing failed: {str(e)}")
         return False
 
 
-def process_refund(user_id, amount):
+def process_refund(user_id, amount, subscription_id=None):
     """
     Process refund for a user (simplified implementation)
     
     Args:
         user_id (int): User ID
         amount (float): Refund amount
+        subscription_id (int, optional): Subscription being refunded
         
     Returns:
         bool: True if refund successful, False otherwise
@@ -2400,8 +7712,8 @@ def process_refund(user_id, amount):
     try:
         # Create a refund record (negative payment)
         exec_query(
-            "INSERT INTO payments (user_id, amount, payment_date, status, payment_method, bill_month, bill_year, transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, -amount, datetime.utcnow().isoformat(), 'refunded', 'credit_card', datetime.utcnow().month, datetime.utcnow().year, f"REFUND{uuid.uuid4().hex[:8].upper()}")
+            "INSERT INTO payments (subscription_id, user_id, amount, payment_date, status, payment_method, bill_month, bill_year, transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (subscription_id, user_id, -amount, datetime.utcnow().isoformat(), 'refunded', 'credit_card', datetime.utcnow().month, datetime.utcnow().year, f"REFUND{uuid.uuid4().hex[:8].upper()}")
         )
         return True
     except Exception as e:
@@ -2414,17 +7726,40 @@ def user_dashboard(user):
     st.markdown(f"Welcome back, **{user['name']}**!")
     
     # Add notifications in sidebar
-    st.sidebar.subheader("Notifications")
-    unread_notifications = get_user_notifications(user['id'], limit=5, unread_only=True)
-    if unread_notifications:
+    unread_count = get_unread_notification_count(user['id'])
+    st.sidebar.subheader(f"Notifications ({unread_count})" if unread_count else "Notifications")
+    if unread_count:
+        unread_notifications = get_user_notifications(user['id'], limit=5, unread_only=True)
         for notification in unread_notifications:
-            with st.sidebar.expander(f"New: {notification['notification_type'].replace('_', ' ').title()}"):
+            with st.sidebar.expander(f"New: {(notification.get('notification_type') or 'notification').replace('_', ' ').title()}"):
                 st.write(notification['message'])
                 if st.button("Mark as read", key=f"mark_read_{notification['id']}"):
                     mark_notification_read(notification['id'])
                     st.rerun()
+        if unread_notifications and st.sidebar.button("Mark all as read", key="mark_all_read"):
+            mark_all_read(user['id'], up_to_id=max(n['id'] for n in unread_notifications))
+            st.rerun()
     else:
         st.sidebar.write("No new notifications")
+
+    with st.sidebar.expander("Notification History"):
+        cursors = st.session_state.setdefault('notification_history_cursors', [None])
+        history = get_notification_history(user['id'], before_id=cursors[-1], limit=10)
+        for notification in history:
+            st.caption(f"{(notification.get('created_date') or '')[:10]} · "
+                       f"{(notification.get('notification_type') or 'notification').replace('_', ' ').title()}")
+            st.write(notification['message'])
+        if not history:
+            st.write("No notifications")
+        nav1, nav2 = st.columns(2)
+        with nav1:
+            if len(cursors) > 1 and st.button("Newer", key="notif_newer"):
+                cursors.pop()
+                st.rerun()
+        with nav2:
+            if len(history) == 10 and st.button("Older", key="notif_older"):
+                cursors.append(history[-1]['id'])
+                st.rerun()
     
     # Check for expiry reminders first
     reminders = check_expiry_reminders(user['id'])
@@ -2770,8 +8105,15 @@ def user_dashboard(user):
                     usage_ratio = monthly_usage / current_plan['data_limit_gb'] * 100
                     
                     st.markdown("#### Plan Utilization")
+                    quota = get_quota_status(user['id'])
+                    if quota and quota['limit_gb']:
+                        st.progress(min(quota['used_pct'] / 100, 1.0))
+                        st.write(f"{quota['used_gb']:.1f} of {quota['limit_gb']:.0f} GB used this billing period "
+                                 f"({quota['period_start']} to {quota['period_end']})")
+                        if quota['over_quota']:
+                            st.error("You have reached your data limit for this billing period.")
                     st.progress(min(usage_ratio / 100, 1.0))
-                    st.write(f"You're using {usage_ratio:.1f}% of your plan limit")
+                    st.write(f"At your recent pace you would use {usage_ratio:.1f}% of your plan limit in a month")
                     
                     if usage_ratio > 80:
                         st.warning("Consider upgrading to a higher limit plan!")
@@ -2787,38 +8129,20 @@ def user_dashboard(user):
         # Plan filters
         col1, col2, col3 = st.columns(3)
         with col1:
-            price_filter = st.selectbox("Filter by Price", 
-                                       ["All", "Under ₹500", "₹500-₹1000", "Above ₹1000"])
+            price_filter = st.selectbox("Filter by Price", ["All"] + list(PLAN_PRICE_FILTERS))
         with col2:
-            speed_filter = st.selectbox("Filter by Speed", 
-                                       ["All", "Up to 100 Mbps", "100-500 Mbps", "500+ Mbps"])
+            speed_filter = st.selectbox("Filter by Speed", ["All"] + list(PLAN_SPEED_FILTERS))
         with col3:
             type_filter = st.selectbox("Filter by Type",
                                       ["All", "Basic", "Standard", "Premium", "Elite"])
         
-        # Get and filter plans
-        all_plans = get_all_plans()
-        filtered_plans = all_plans.copy()
-        
-        # Apply filters
+        # Filter plans through the in-memory plan index
+        ranges = {}
         if price_filter != "All":
-            if price_filter == "Under ₹500":
-                filtered_plans = [p for p in filtered_plans if p['price'] < 500]
-            elif price_filter == "₹500-₹1000":
-                filtered_plans = [p for p in filtered_plans if 500 <= p['price'] <= 1000]
-            else:
-                filtered_plans = [p for p in filtered_plans if p['price'] > 1000]
-        
+            ranges['price'] = PLAN_PRICE_FILTERS[price_filter]
         if speed_filter != "All":
-            if speed_filter == "Up to 100 Mbps":
-                filtered_plans = [p for p in filtered_plans if p['speed_mbps'] <= 100]
-            elif speed_filter == "100-500 Mbps":
-                filtered_plans = [p for p in filtered_plans if 100 < p['speed_mbps'] <= 500]
-            else:
-                filtered_plans = [p for p in filtered_plans if p['speed_mbps'] > 500]
-        
-        if type_filter != "All":
-            filtered_plans = [p for p in filtered_plans if p.get('plan_type', 'basic').lower() == type_filter.lower()]
+            ranges['speed_mbps'] = PLAN_SPEED_FILTERS[speed_filter]
+        filtered_plans = PLAN_INDEX.filter(plan_type=None if type_filter == "All" else type_filter, **ranges)
         
         # Display filtered plans
         if filtered_plans:
@@ -2881,19 +8205,26 @@ def admin_dashboard(user):
         render_metric_card("Active Subscriptions", active_subs)
     
     with col3:
-        monthly_revenue_query = "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status = 'paid'"
-        if column_exists('payments', 'payment_date'):
-            monthly_revenue_query += " AND payment_date >= date('now', '-30 days')"
-        monthly_revenue = exec_query(monthly_revenue_query, fetch=True)[0][0]
+        # Net of refunds; a range scan over the covering (created_date, amount) ledger index
+        monthly_revenue = exec_query(
+            "SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE created_date >= date('now', '-30 days')",
+            fetch=True,
+        )[0][0]
         render_metric_card("Monthly Revenue", f"₹{monthly_revenue:,.0f}")
     
     with col4:
-        if column_exists('support_tickets', 'status'):
-            support_tickets = exec_query("SELECT COUNT(*) FROM support_tickets WHERE status IN ('open', 'in_progress')", fetch=True)[0][0]
-        else:
-            support_tickets = 0
+        support_tickets = get_ticket_counts()['class']['ongoing']
         render_metric_card("Open Tickets", support_tickets)
 
+    # Search across tickets, users and plans
+    query = st.text_input("🔍 Search tickets, users and plans", placeholder="Name, username, email, city, ticket subject or plan")
+    if query.strip():
+        started = time.perf_counter()
+        results = search_index(query)
+        st.caption(f"{len(results)} results in {(time.perf_counter() - started) * 1000:.1f} ms")
+        for r in results:
+            st.markdown(f"{SEARCH_ICONS[r['kind']]} **{r['title']}**  \n{r['snippet']}")
+
     # Main dashboard tabs
     tabs = st.tabs(["📊 Analytics", "🤖 ML Model", "📋 Plans Management", "👥 User Management", "🎫 Support", "⚙️ Settings"])
     
@@ -3059,6 +8390,37 @@ def render_analytics_dashboard():
             st.info("No plan statistics available")
     except Exception as e:
         st.error(f"Error rendering plan performance: {str(e)}")
+    
+    # Hourly usage by city
+    st.subheader("🕒 Usage by Hour and City")
+    
+    try:
+        cities = [r[0] for r in exec_query(
+            "SELECT DISTINCT city FROM users WHERE role = 'user' AND city IS NOT NULL ORDER BY city", fetch=True)]
+        if cities:
+            col1, col2 = st.columns(2)
+            with col1:
+                heat_city = st.selectbox("City", cities, key="heatmap_city")
+            with col2:
+                heat_days = st.selectbox("Period", [30, 90], format_func=lambda d: f"Last {d} days", key="heatmap_days")
+            heat = get_usage_heatmap(city=heat_city, start=(utcnow_naive() - timedelta(days=heat_days)).date())
+            if heat.notna().any().any():
+                fig = px.imshow(heat, aspect='auto', color_continuous_scale='Blues',
+                                labels={'x': 'Hour of Day (UTC)', 'y': 'Weekday', 'color': 'Avg GB per user-day'},
+                                title=f"Weekday x Hour Usage in {heat_city}")
+                st.plotly_chart(fig, use_container_width=True)
+            else:
+                st.info("No hourly usage recorded for this city yet.")
+    except Exception as e:
+        st.error(f"Error rendering hourly usage: {str(e)}")
+
+    # Most saved comparisons
+    st.subheader("⚖️ Popular Plan Comparisons")
+    popular = get_popular_comparisons()
+    if popular.empty:
+        st.info("No saved plan comparisons yet.")
+    else:
+        st.dataframe(popular.drop(columns=['set_hash']), use_container_width=True)
 
 def render_ml_model_management():
     st.header("🤖 Machine Learning Model Management")
@@ -3179,13 +8541,24 @@ def render_enhanced_plans_management():
     uploaded_file = st.file_uploader("Choose CSV file", type="csv", key="bulk_plans_upload")
     if uploaded_file is not None:
         try:
-            csv_content = uploaded_file.read().decode('utf-8')
-            preview_df = pd.read_csv(io.StringIO(csv_content))
-            st.subheader("📋 Preview Uploaded Data")
-            st.dataframe(preview_df, use_container_width=True)
-            ok, msg = bulk_create_plans_from_csv(csv_content)
-            (st.success if ok else st.error)(msg)
-            if ok: st.rerun()
+            diff = diff_plan_catalog(pd.read_csv(io.BytesIO(uploaded_file.getvalue())))
+            st.subheader("📋 Preview Changes")
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("New Plans", len(diff['insert']))
+            col2.metric("Changed Plans", len(diff['update']))
+            col3.metric("Unchanged", diff['unchanged'])
+            col4.metric("Rejected Rows", len(diff['errors']))
+            new_tab, changed_tab, rejected_tab = st.tabs(["New", "Changed", "Rejected"])
+            with new_tab:
+                st.dataframe(diff['insert'].head(500), use_container_width=True)
+            with changed_tab:
+                st.dataframe(diff['update'].head(500), use_container_width=True)
+            with rejected_tab:
+                st.dataframe(diff['errors'], use_container_width=True)
+            if (len(diff['insert']) or len(diff['update'])) and st.button("Apply Changes", key="bulk_plans_apply"):
+                result = apply_plan_catalog(diff)
+                st.success(f"Created {result['created']} plans and updated {result['updated']}.")
+                st.rerun()
         except Exception as e:
             st.error(f"CSV error: {e}")
 
@@ -3220,15 +8593,73 @@ def render_user_management():
         (st.success if ok else st.error)(msg)
         if ok: st.rerun()
 
+    st.subheader("📥 Bulk Import / 📤 Export Users")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.caption("CSV with a header row: " + ", ".join(USER_IMPORT_COLUMNS) + " (username and password required)")
+        users_file = st.file_uploader("Choose CSV file", type="csv", key="bulk_users_upload")
+        if users_file is not None and st.button("Import Users"):
+            report = io.StringIO()
+            with st.spinner("Importing users..."):
+                result = import_users_csv(io.BytesIO(users_file.getvalue()), error_report=report)
+            st.success(f"Created {result['users_created']} of {result['rows_read']} users "
+                       f"in {result['elapsed_seconds']:.1f} s.")
+            if result['rows_rejected']:
+                st.warning(f"{result['rows_rejected']} rows were rejected.")
+                st.download_button("Download error report", report.getvalue(), file_name="user_import_errors.csv")
+    with col2:
+        st.caption("All users, without password hashes")
+        if st.button("Prepare Export"):
+            st.download_button("Download users.csv", "".join(iter_users_csv()), file_name="users.csv")
+
     st.subheader("✏️ Edit / 🗑️ Delete User")
-    users_df = df_from_query("SELECT id, username, name, email, role, city, state FROM users ORDER BY id DESC")
+    f1, f2, f3, f4 = st.columns(4)
+    with f1:
+        role_filter = st.selectbox("Role", ["All", "user", "admin"], key="user_grid_role")
+        sort = st.selectbox("Sort by", list(USER_GRID_SORTS), key="user_grid_sort")
+    with f2:
+        city_filter = st.text_input("City", key="user_grid_city").strip()
+        page_size = st.selectbox("Rows per page", USER_PAGE_SIZES, key="user_grid_size")
+    with f3:
+        state_filter = st.text_input("State", key="user_grid_state").strip()
+        active_filter = st.selectbox("Subscription", ["Any", "Active", "No active subscription"], key="user_grid_active")
+    with f4:
+        signup_range = st.date_input("Signed up between", value=(), key="user_grid_signup")
+    filters = {
+        'role': None if role_filter == "All" else role_filter,
+        'city': city_filter or None,
+        'state': state_filter or None,
+        'active': {"Any": None, "Active": True}.get(active_filter, False),
+        'signup_from': signup_range[0] if len(signup_range) > 0 else None,
+        'signup_to': signup_range[1] if len(signup_range) > 1 else None,
+    }
+    # Cursors of the pages seen so far; a new filter, sort or page size starts over at page 1
+    grid = st.session_state.setdefault('user_grid', {'view': None, 'cursors': [None]})
+    view = (tuple(filters.items()), sort, page_size)
+    if grid['view'] != view:
+        grid.update(view=view, cursors=[None])
+    users_df = get_users_page(filters, sort=sort, after=grid['cursors'][-1], limit=page_size)
+
     if users_df.empty:
         st.info("No users found.")
     else:
-        st.dataframe(users_df, use_container_width=True)
+        st.dataframe(users_df.drop(columns=['sort_key']), use_container_width=True)
+    nav1, nav2, nav3 = st.columns([1, 2, 1])
+    with nav1:
+        if len(grid['cursors']) > 1 and st.button("Previous", key="user_grid_prev"):
+            grid['cursors'].pop()
+            st.rerun()
+    with nav2:
+        st.caption(f"Page {len(grid['cursors'])}")
+    with nav3:
+        if len(users_df) == page_size and st.button("Next", key="user_grid_next"):
+            grid['cursors'].append((users_df['sort_key'].tolist()[-1], int(users_df['id'].iloc[-1])))
+            st.rerun()
+
+    if not users_df.empty:
         sel_name = st.selectbox("Select user by username", options=users_df['username'].tolist(), key="user_edit_sel")
         uid = int(users_df.loc[users_df['username']==sel_name, 'id'].iloc[0])
-        current = df_from_query("SELECT * FROM users WHERE id = ?", (uid,)).iloc[0].to_dict()
+        current = row_to_dict(exec_query("SELECT id, username, name, email, role, city, state FROM users WHERE id = ?", (uid,), fetch=True)[0])
         with st.form("edit_user_form"):
             c1, c2, c3 = st.columns(3)
             with c1:
@@ -3353,83 +8784,102 @@ def render_support_management():
         st.info("Support ticket system not available - run database migration to enable")
         return
 
-    # --------- Quick Stats ---------
-    ticket_stats = df_from_query("""
-        SELECT LOWER(status) AS status, COUNT(*) AS count
-        FROM support_tickets
-        GROUP BY LOWER(status)
-    """)
-    if not ticket_stats.empty:
-        cols = st.columns(min(4, len(ticket_stats)))
-        for i, (_, row) in enumerate(ticket_stats.iterrows()):
+    # --------- Quick Stats (trigger-maintained counters, no ticket scan) ---------
+    counts = get_ticket_counts()
+    if counts['status']:
+        cols = st.columns(min(4, len(counts['status'])))
+        for i, (status, count) in enumerate(sorted(counts['status'].items(), key=lambda kv: -kv[1])):
             with cols[i % len(cols)]:
-                st.metric(f"{row['status'].title()} Tickets", row['count'])
+                st.metric(f"{(status or 'unknown').title()} Tickets", count)
 
     # --------- Category Breakdown ---------
-    category_stats = df_from_query("""
-        SELECT category, COUNT(*) AS count
-        FROM support_tickets
-        GROUP BY category
-        ORDER BY count DESC
-    """)
-    if not category_stats.empty:
+    if counts['category']:
+        category_stats = pd.DataFrame(
+            sorted(counts['category'].items(), key=lambda kv: -kv[1]), columns=['category', 'count']
+        )
         st.subheader("Tickets by Category")
         fig = px.bar(category_stats, x='category', y='count', title="Support Tickets by Category")
         st.plotly_chart(fig, use_container_width=True)
 
+    # --------- Resolution Times (SLA) ---------
+    st.subheader("⏱️ Resolution Times")
+    refreshed = meta_get('ticket_sla_refreshed')
+    if not refreshed or utcnow_naive() - datetime.fromisoformat(refreshed) > timedelta(minutes=SLA_REFRESH_MINUTES):
+        refresh_ticket_sla()
+        refreshed = meta_get('ticket_sla_refreshed')
+    sla_dimension = st.selectbox("Break down by", ['all', 'category', 'priority', 'city'],
+                                 format_func=lambda d: "Overall" if d == 'all' else d.title(), key="sla_dimension")
+    sla_df = get_sla_percentiles(sla_dimension)
+    if sla_df.empty:
+        st.info("No resolved tickets yet.")
+    else:
+        st.dataframe(sla_df, use_container_width=True)
+    backlog_df = get_backlog_ages()
+    fig = px.bar(backlog_df, x='age', y='open_tickets', title="Open Ticket Backlog by Age")
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(f"Metrics as of {refreshed[:16].replace('T', ' ')} UTC")
+
+    # --------- Assignment Queue ---------
+    st.subheader("🎯 Assignment Queue")
+    queue = get_ticket_queue_stats()
+    st.caption(f"{queue['queued']} tickets waiting, {queue['claimed']} being worked on, "
+               f"{queue['past_sla']} past their SLA deadline.")
+    agent = (st.session_state.get('user') or {}).get('username', 'admin')
+    held = st.session_state.get('claimed_ticket')
+    if held:
+        ticket = exec_query("SELECT id, subject, description, category, priority, created_date FROM support_tickets WHERE id = ?",
+                            (held['ticket_id'],), fetch=True)
+        if ticket:
+            ticket = row_to_dict(ticket[0])
+            st.markdown(f"**#{ticket['id']} {ticket['subject']}** ({ticket['category']}, {ticket['priority']} priority)")
+            st.write(ticket['description'])
+            st.caption(f"Opened {ticket['created_date']}; SLA deadline {held['sla_deadline']}; "
+                       f"your lease runs until {held['lease_until'][:19]}")
+        col1, col2, col3 = st.columns(3)
+        for col, label, status in ((col1, "Resolve", 'resolved'), (col2, "Close", 'closed')):
+            with col:
+                if st.button(label, key=f"ticket_{status}"):
+                    ok, msg = complete_ticket(held['ticket_id'], agent, status=status)
+                    (st.success if ok else st.error)(msg)
+                    st.session_state.pop('claimed_ticket', None)
+                    st.rerun()
+        with col3:
+            if st.button("Release", key="ticket_release"):
+                release_ticket(held['ticket_id'], agent)
+                st.session_state.pop('claimed_ticket', None)
+                st.rerun()
+    elif st.button("Take Next Ticket", disabled=queue['queued'] == 0):
+        st.session_state['claimed_ticket'] = claim_next_ticket(agent)
+        st.rerun()
+
     # --------- Tabs: Resolved / Not Resolved / Ongoing ---------
     st.subheader("Browse Tickets by Status")
-    tab_resolved, tab_not_resolved, tab_ongoing = st.tabs(["Resolved", "Not Resolved", "Ongoing"])
-
-    # You can tweak these buckets to match your real statuses
-    resolved_statuses = tuple(s.lower() for s in ("resolved", "solved", "completed"))
-    not_resolved_statuses = tuple(s.lower() for s in ("closed", "rejected", "cancelled", "won't fix", "invalid"))
-    ongoing_statuses = tuple(s.lower() for s in ("open", "in_progress", "in progress", "pending", "assigned", "acknowledged"))
-
-    def list_tickets(where_sql: str, params: tuple):
-        q = f"""
-            SELECT 
-                st.id,
-                st.subject,
-                st.category,
-                st.status,
-                st.priority,
-                st.created_date,
-                st.resolved_date,
-                u.name AS user_name,
-                u.email AS user_email
-            FROM support_tickets st
-            JOIN users u ON st.user_id = u.id
-            {where_sql}
-            ORDER BY st.created_date DESC
-            LIMIT 200
-        """
-        df = df_from_query(q, params)
-        if df.empty:
-            st.info("No tickets found for this tab.")
-        else:
-            st.dataframe(df, use_container_width=True)
-
-    with tab_resolved:
-        if len(resolved_statuses) == 0:
-            st.info("No 'resolved' statuses configured.")
-        else:
-            placeholders = ",".join(["?"] * len(resolved_statuses))
-            list_tickets(f"WHERE LOWER(st.status) IN ({placeholders})", resolved_statuses)
-
-    with tab_not_resolved:
-        if len(not_resolved_statuses) == 0:
-            st.info("No 'not resolved' statuses configured.")
-        else:
-            placeholders = ",".join(["?"] * len(not_resolved_statuses))
-            list_tickets(f"WHERE LOWER(st.status) IN ({placeholders})", not_resolved_statuses)
+    tab_labels = {'resolved': "Resolved", 'not_resolved': "Not Resolved", 'ongoing': "Ongoing"}
+    tabs = st.tabs([f"{label} ({counts['class'][cls]})" for cls, label in tab_labels.items()])
+    page_cursors = st.session_state.setdefault('ticket_cursors', {})
+
+    for tab, status_class in zip(tabs, tab_labels):
+        with tab:
+            cursors = page_cursors.setdefault(status_class, [None])
+            tickets_df = get_tickets_page(status_class, before=cursors[-1])
+            if tickets_df.empty:
+                st.info("No tickets found for this tab.")
+            else:
+                st.dataframe(tickets_df.drop(columns='sort_key'), use_container_width=True)
 
-    with tab_ongoing:
-        if len(ongoing_statuses) == 0:
-            st.info("No 'ongoing' statuses configured.")
-        else:
-            placeholders = ",".join(["?"] * len(ongoing_statuses))
-            list_tickets(f"WHERE LOWER(st.status) IN ({placeholders})", ongoing_statuses)
+            nav1, nav2, nav3 = st.columns([1, 2, 1])
+            with nav1:
+                if len(cursors) > 1 and st.button("Newer", key=f"tickets_newer_{status_class}"):
+                    cursors.pop()
+                    st.rerun()
+            with nav2:
+                pages = max(1, math.ceil(counts['class'][status_class] / TICKET_PAGE_SIZE))
+                st.caption(f"Page {len(cursors)} of {pages}")
+            with nav3:
+                if len(tickets_df) == TICKET_PAGE_SIZE and st.button("Older", key=f"tickets_older_{status_class}"):
+                    last = tickets_df.iloc[-1]
+                    cursors.append((last['sort_key'], int(last['id'])))
+                    st.rerun()
 
 
 def render_admin_settings():
@@ -3462,12 +8912,11 @@ def render_admin_settings():
     
     with stats_col2:
         if column_exists('usage', 'data_used_gb'):
-            total_usage = exec_query("SELECT COALESCE(SUM(data_used_gb), 0) FROM usage", fetch=True)[0][0]
+            total_usage = get_total_usage_gb()
             st.metric("Total Data Usage", f"{total_usage:.0f} GB")
         
-        if column_exists('support_tickets', 'id'):
-            total_tickets = exec_query("SELECT COUNT(*) FROM support_tickets", fetch=True)[0][0]
-            st.metric("Total Support Tickets", total_tickets)
+        total_tickets = sum(get_ticket_counts()['status'].values())
+        st.metric("Total Support Tickets", total_tickets)
     
     with stats_col3:
         db_size = os.path.getsize(DB_PATH) / (1024 * 1024) if os.path.exists(DB_PATH) else 0
@@ -3477,6 +8926,115 @@ def render_admin_settings():
             model_size = os.path.getsize('plan_recommendation_model.pkl') / (1024 * 1024)
             st.metric("ML Model Size", f"{model_size:.2f} MB")
 
+    st.subheader("📨 Notification Delivery")
+    st.caption("New notifications are queued from user notification preferences when a delivery run starts.")
+    queue_stats = get_delivery_queue_stats()
+    if not queue_stats.empty:
+        st.dataframe(queue_stats.pivot(index='channel', columns='status', values='count').fillna(0).astype(int),
+                     use_container_width=True)
+    else:
+        st.info("Delivery queue is empty.")
+    if st.button("Deliver Pending Notifications"):
+        with st.spinner("Delivering notifications..."):
+            summary = run_notification_delivery()
+        st.success(f"Queued {summary['queued']} new deliveries. Delivered {summary['sent']} messages "
+                   f"({summary['failed']} failed) at {summary['messages_per_second']:.0f} msg/s")
+
+    st.subheader("💳 Billing Run")
+    due_count = count_subscriptions_due()
+    st.caption(f"{due_count} auto-renewing subscriptions are due for renewal today.")
+    if st.button("Run Billing Now", disabled=due_count == 0):
+        with st.spinner("Renewing subscriptions..."):
+            result = run_billing()
+        st.success(f"Renewed {result['renewed']} subscriptions, billed ₹{result['billed_amount']:,.2f} "
+                   f"({result['subscriptions_per_second']:.0f} subscriptions/s)")
+
+    st.subheader("🔀 Plan Migration")
+    plan_names = {p['id']: f"{p['name']} (₹{p['price']:,.0f})" for p in get_all_plans()}
+    col1, col2 = st.columns(2)
+    with col1:
+        source_id = st.selectbox("Move subscribers from", list(plan_names), format_func=plan_names.get, key="migration_source")
+    with col2:
+        target_id = st.selectbox("To", [pid for pid in plan_names if pid != source_id], format_func=plan_names.get,
+                                 key="migration_target")
+    preview = st.session_state.get('plan_migration_preview')
+    if preview and preview['pair'] != (source_id, target_id):
+        preview = st.session_state['plan_migration_preview'] = None
+    if st.button("Preview Impact", disabled=target_id is None):
+        impact = migrate_plan_subscribers(source_id, target_id, dry_run=True)
+        preview = st.session_state['plan_migration_preview'] = dict(impact, pair=(source_id, target_id))
+    if preview:
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Subscribers", preview['subscriptions'])
+        col2.metric("Prorated Charges", f"₹{preview['charged_amount']:,.2f}", f"{preview['charges']} users", delta_color="off")
+        col3.metric("Prorated Credits", f"₹{preview['credited_amount']:,.2f}", f"{preview['credits']} users", delta_color="off")
+        col4.metric("Monthly Revenue", f"₹{preview['monthly_revenue_change']:+,.2f}")
+        if st.button("Migrate Subscribers", disabled=preview['subscriptions'] == 0):
+            with st.spinner("Migrating subscriptions..."):
+                result = migrate_plan_subscribers(source_id, target_id)
+            st.session_state['plan_migration_preview'] = None
+            st.success(f"Moved {result['subscriptions']} subscriptions to {result['target_plan']}: "
+                       f"charged ₹{result['charged_amount']:,.2f}, credited ₹{result['credited_amount']:,.2f} "
+                       f"({result['subscriptions_per_second']:.0f} subscriptions/s)")
+
+    st.subheader("🔁 Dunning")
+    dunning = get_dunning_stats()
+    st.caption(f"{dunning.get('active', 0)} failed payments awaiting retry ({dunning['due']} due now), "
+               f"{dunning.get('recovered', 0)} recovered, {dunning.get('suspended', 0)} suspended.")
+    if not get_payment_gateway_url():
+        st.caption("Set PAYMENT_GATEWAY_URL to retry them; without a gateway failed payments stay queued.")
+    if st.button("Retry Failed Payments", disabled=not get_payment_gateway_url()):
+        with st.spinner("Retrying failed payments..."):
+            result = run_dunning()
+        st.success(f"Retried {result['retried']} payments: {result['recovered']} recovered, "
+                   f"{result['rescheduled']} rescheduled, {result['suspended']} subscriptions suspended "
+                   f"({result['enrolled']} newly enrolled)")
+
+    st.subheader("🔗 Payment Reconciliation")
+    # Counting unlinked payments scans the whole table, so it only runs on request
+    last_run = exec_query(
+        "SELECT finished_date, payments_scanned, linked, exceptions FROM reconciliation_runs WHERE status = 'completed' ORDER BY id DESC LIMIT 1",
+        fetch=True
+    )
+    if last_run:
+        st.caption(f"Last run {last_run[0]['finished_date'][:16].replace('T', ' ')}: scanned {last_run[0]['payments_scanned']} "
+                   f"payments, linked {last_run[0]['linked']}, {last_run[0]['exceptions']} exceptions.")
+    if st.button("Count Unlinked Payments"):
+        orphans = exec_query("SELECT COUNT(*) FROM payments WHERE COALESCE(subscription_id, 0) = 0", fetch=True)[0][0]
+        st.caption(f"{orphans} payments are not linked to a subscription.")
+    if st.button("Reconcile Payments"):
+        bar = st.progress(0.0)
+        result = run_reconciliation(progress=lambda done, total: bar.progress(min(1.0, done / max(total, 1))))
+        st.success(f"Scanned {result['payments_scanned']} payments: linked {result['linked']}, "
+                   f"{result['exceptions']} exceptions")
+    exceptions_df = get_reconciliation_exceptions(limit=1000)
+    if not exceptions_df.empty:
+        with st.expander(f"Exceptions from the last run ({len(exceptions_df)} shown)"):
+            st.dataframe(exceptions_df, use_container_width=True)
+            st.download_button("Download CSV", exceptions_df.to_csv(index=False), file_name="reconciliation_exceptions.csv")
+
+    st.subheader("📶 Data Quotas")
+    quota_counts = exec_query(
+        "SELECT COUNT(*), COALESCE(SUM(limit_gb IS NOT NULL AND used_gb >= limit_gb), 0) FROM quota_usage WHERE active",
+        fetch=True,
+    )[0]
+    st.caption(f"{quota_counts[0]} active subscriptions tracked, {quota_counts[1]} over their data limit this period.")
+    if st.button("Rebuild Quota Counters"):
+        with st.spinner("Reconciling quota counters with usage..."):
+            result = rebuild_quota_usage()
+        st.success(f"Checked {result['active_quotas']} quotas: corrected {result['corrected']} "
+                   f"(largest drift {result['max_drift_gb']:.2f} GB)")
+
+    st.subheader("🧹 Notification Retention")
+    st.caption("Retention (days): " + ", ".join(f"{k}: {v}" for k, v in NOTIFICATION_RETENTION_DAYS.items())
+               + f"; other types: {NOTIFICATION_RETENTION_DEFAULT_DAYS}")
+    archive_deleted = st.checkbox("Archive purged notifications (gzip)", value=True)
+    if st.button("Purge Expired Notifications"):
+        with st.spinner("Purging expired notifications..."):
+            result = run_notification_retention(archive=archive_deleted)
+        st.success(f"Deleted {result['notifications_deleted']} notifications and {result['outbox_rows_deleted']} delivery records; "
+                   f"{result['reclaimed_bytes'] / 1024:.0f} KB reclaimed for reuse")
+
 def evaluate_model():
     """Evaluate the ML model performance"""
     if not os.path.exists('plan_recommendation_model.pkl'):
@@ -3678,5 +9236,357 @@ def main():
     else:
         user_dashboard(user)
 
+# ---------------------------
+# Command Line (background jobs)
+# ---------------------------
+def _print_summary(summary):
+    for k, v in summary.items():
+        print(f"{k}: {v}")
+
+
+def _cli_deliver_notifications(args):
+    if args.benchmark:
+        summary = benchmark_notification_delivery(messages=args.benchmark, workers=args.workers, batch_size=args.batch_size)
+    else:
+        summary = run_notification_delivery(workers=args.workers, batch_size=args.batch_size, drain=not args.follow)
+    _print_summary(summary)
+
+
+def _cli_purge_notifications(args):
+    _print_summary(run_notification_retention(batch_size=args.batch_size, archive=args.archive,
+                                              vacuum=args.vacuum, pause_seconds=args.pause))
+
+
+def _cli_billing_run(args):
+    _print_summary(run_billing(as_of=args.as_of, chunk_size=args.chunk_size, gateway_url=args.gateway_url))
+
+
+def _cli_migrate_plan(args):
+    _print_summary(migrate_plan_subscribers(args.source, args.target, chunk_size=args.chunk_size,
+                                            dry_run=args.dry_run, gateway_url=args.gateway_url))
+
+
+def _cli_dunning_run(args):
+    now = pd.Timestamp(args.as_of).to_pydatetime() if args.as_of else None
+    _print_summary(run_dunning(batch_size=args.batch_size, gateway_url=args.gateway_url, now=now))
+
+
+def _cli_generate_statements(args):
+    formats = tuple(args.formats.split(","))
+    if args.benchmark:
+        _print_summary(benchmark_statements(users=args.benchmark, workers=args.workers, formats=formats,
+                                            store_dir=args.store_dir))
+    else:
+        _print_summary(run_statements(args.period, workers=args.workers, formats=formats, chunk_users=args.chunk_users,
+                                      store_dir=args.store_dir))
+
+
+def _cli_reconcile_payments(args):
+    summary = run_reconciliation(
+        chunk_rows=args.chunk_rows, grace_days=args.grace_days,
+        progress=lambda done, total: print(f"... {done}/{total} payments reconciled"),
+    )
+    _print_summary(summary)
+    if args.report:
+        rows = write_reconciliation_report(args.report, summary['run_id'])
+        print(f"Wrote {rows} exceptions to {args.report}")
+
+
+def _cli_ingest_usage(args):
+    if args.benchmark:
+        _print_summary(benchmark_usage_ingest(records=args.benchmark, batch_size=args.batch_size))
+    else:
+        _print_summary(ingest_usage_files(args.files or ['-'], batch_size=args.batch_size))
+
+
+def _cli_usage_server(args):
+    serve_usage_ingest(args.host, args.port)
+
+
+def _cli_import_usage(args):
+    if args.benchmark:
+        _print_summary(benchmark_usage_import(rows=args.benchmark, chunk_mb=args.chunk_mb, use_mmap=args.mmap))
+        return
+    for path in args.files:
+        _print_summary(import_usage_file(
+            path, chunk_mb=args.chunk_mb, use_mmap=args.mmap, restart=args.restart, offset=args.offset,
+            progress=lambda done, total: print(f"... {done / max(total, 1):.0%} of {path}"),
+        ))
+
+
+def _cli_pack_usage(args):
+    if args.benchmark:
+        _print_summary(benchmark_usage_packing(users=args.benchmark))
+    else:
+        _print_summary(pack_usage(before=args.before, chunk_users=args.chunk_users, vacuum=args.vacuum))
+
+
+def _cli_quota_rebuild(args):
+    _print_summary(rebuild_quota_usage())
+    if args.benchmark:
+        _print_summary(benchmark_quota_checks(checks=args.benchmark))
+
+
+def _cli_usage_heatmap(args):
+    if args.benchmark:
+        _print_summary(benchmark_usage_heatmap(users=args.benchmark))
+        return
+    heat = get_usage_heatmap(user_id=args.user_id, city=args.city, start=args.start, end=args.end)
+    print(heat.round(3).to_string())
+
+
+def _cli_sla_refresh(args):
+    _print_summary(refresh_ticket_sla(full=args.full))
+    print(get_sla_percentiles(args.by).to_string(index=False))
+
+
+def _cli_ticket_queue(args):
+    if args.benchmark:
+        _print_summary(benchmark_ticket_queue(tickets=args.benchmark, agents=args.agents, seconds=args.seconds))
+    else:
+        _print_summary(get_ticket_queue_stats())
+
+
+def _cli_search(args):
+    if args.rebuild:
+        _print_summary(rebuild_search_index(optimize=True))
+    elif args.benchmark:
+        _print_summary(benchmark_search(rows=args.benchmark))
+    else:
+        for r in search_index(" ".join(args.query), kinds=args.kind, limit=args.limit, markers=("[", "]")):
+            print(f"{r['kind']:<7} {r['id']:>8}  {r['title']}\n{'':17}{r['snippet']}")
+
+
+def _cli_import_users(args):
+    if args.benchmark:
+        _print_summary(benchmark_user_import(rows=args.benchmark, workers=args.workers))
+    else:
+        _print_summary(import_users_csv(args.file, chunk_rows=args.chunk_rows, workers=args.workers,
+                                        error_report=args.errors))
+
+
+def _cli_export_users(args):
+    _print_summary({'file': args.file, 'rows_written': export_users_csv(args.file, chunk_rows=args.chunk_rows)})
+
+
+def _cli_import_plans(args):
+    if args.benchmark:
+        _print_summary(benchmark_plan_import(plans=args.benchmark))
+        return
+    diff = diff_plan_catalog(pd.read_csv(args.file))
+    if not diff['errors'].empty:
+        print(diff['errors'].to_string(index=False))
+    if args.dry_run:
+        _print_summary({'would_create': len(diff['insert']), 'would_update': len(diff['update']),
+                        'unchanged': diff['unchanged'], 'rejected': len(diff['errors'])})
+    else:
+        _print_summary(apply_plan_catalog(diff))
+
+
+def _cli_plan_index(args):
+    _print_summary(benchmark_plan_index(plans=args.benchmark, queries=args.queries))
+
+
+def _cli_compare_plans(args):
+    if args.benchmark:
+        _print_summary(benchmark_plan_comparison(plans=args.benchmark))
+    elif args.plan_ids:
+        print(get_plan_comparison(args.plan_ids, monthly_gb=args.monthly_gb).to_string(index=False))
+    else:
+        print(get_popular_comparisons(limit=args.limit).to_string(index=False))
+
+
+def _cli_mock_gateway(args):
+    MockGatewayServer(host=args.host, port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      failure_rate=args.failure_rate, decline_rate=args.decline_rate).serve_forever()
+
+
+def _cli_gateway_benchmark(args):
+    _print_summary(benchmark_payment_gateway(charges=args.charges, concurrency=args.concurrency,
+                                             latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                             failure_rate=args.failure_rate, decline_rate=args.decline_rate,
+                                             timeout=args.timeout))
+
+
+def run_cli(argv):
+    """Entry point for jobs run outside the UI: python app.py [--db PATH] <command> ...
+
+    The web app itself is still started with `streamlit run app.py`.
+    """
+    import argparse
+    global DB_PATH
+
+    parser = argparse.ArgumentParser(prog="app.py", description="Trailblazer background jobs")
+    parser.add_argument("--db", help="SQLite database to operate on (default: broadband.db next to app.py)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("deliver-notifications", help="Deliver queued email/SMS notifications")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--batch-size", type=int, default=200)
+    p.add_argument("--follow", action="store_true", help="Keep polling for new messages instead of draining once")
+    p.add_argument("--benchmark", type=int, metavar="N", help="Seed N synthetic messages and deliver them to the local sinks")
+    p.set_defaults(func=_cli_deliver_notifications)
+
+    p = commands.add_parser("purge-notifications", help="Delete notifications past their retention period")
+    p.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    p.add_argument("--archive", action="store_true", help="Write purged rows to archive/*.jsonl.gz")
+    p.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to shrink the database file")
+    p.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+    p.set_defaults(func=_cli_purge_notifications)
+
+    p = commands.add_parser("billing-run", help="Renew and bill auto-renewing subscriptions that are due")
+    p.add_argument("--as-of", help="Billing date (YYYY-MM-DD), defaults to today")
+    p.add_argument("--chunk-size", type=int, default=BILLING_CHUNK_SIZE)
+    p.add_argument("--gateway-url", help="Charge autopay renewals through this gateway (default: PAYMENT_GATEWAY_URL)")
+    p.set_defaults(func=_cli_billing_run)
+
+    p = commands.add_parser("migrate-plan", help="Move every active subscriber of one plan to another with proration")
+    p.add_argument("source", type=int, help="Plan id to move subscribers off")
+    p.add_argument("target", type=int, help="Plan id to move them to")
+    p.add_argument("--dry-run", action="store_true", help="Report the revenue impact without changing anything")
+    p.add_argument("--chunk-size", type=int, default=PLAN_MIGRATION_CHUNK_SIZE)
+    p.add_argument("--gateway-url", help="Charge autopay proration through this gateway (default: PAYMENT_GATEWAY_URL)")
+    p.set_defaults(func=_cli_migrate_plan)
+
+    p = commands.add_parser("dunning-run", help="Retry failed payments that are due and suspend persistent failures")
+    p.add_argument("--batch-size", type=int, default=DUNNING_BATCH_SIZE)
+    p.add_argument("--as-of", help="Treat this ISO date/time as now (default: current time)")
+    p.add_argument("--gateway-url", help="Charge retries through this gateway (default: PAYMENT_GATEWAY_URL)")
+    p.set_defaults(func=_cli_dunning_run)
+
+    p = commands.add_parser("generate-statements", help="Render a month's statements for every user in a process pool")
+    p.add_argument("--period", help="YYYY-MM (default: last month)")
+    p.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    p.add_argument("--formats", default=",".join(STATEMENT_FORMATS))
+    p.add_argument("--chunk-users", type=int, default=STATEMENT_CHUNK_USERS)
+    p.add_argument("--store-dir", default=STATEMENT_DIR)
+    p.add_argument("--benchmark", type=int, metavar="USERS", help="Seed USERS synthetic users into the database and time them")
+    p.set_defaults(func=_cli_generate_statements)
+
+    p = commands.add_parser("reconcile-payments", help="Link orphaned payments to subscriptions and report mismatches")
+    p.add_argument("--chunk-rows", type=int, default=RECONCILE_CHUNK_ROWS)
+    p.add_argument("--grace-days", type=int, default=RECONCILE_GRACE_DAYS)
+    p.add_argument("--report", metavar="CSV", help="Write the exceptions report to this file")
+    p.set_defaults(func=_cli_reconcile_payments)
+
+    p = commands.add_parser("ingest-usage", help="Ingest JSON-lines accounting records into daily usage")
+    p.add_argument("files", nargs="*", help="JSON-lines files, optionally .gz (default: stdin)")
+    p.add_argument("--batch-size", type=int, default=USAGE_INGEST_BATCH)
+    p.add_argument("--benchmark", type=int, metavar="RECORDS", help="Ingest this many synthetic records instead")
+    p.set_defaults(func=_cli_ingest_usage)
+
+    p = commands.add_parser("import-usage", help="Bulk import usage CSV exports (.csv or .csv.gz), resumable")
+    p.add_argument("files", nargs="*")
+    p.add_argument("--chunk-mb", type=int, default=32, help="Size of each parsed block and transaction")
+    p.add_argument("--mmap", action="store_true", help="Memory-map uncompressed files instead of reading them")
+    p.add_argument("--restart", action="store_true", help="Ignore the saved checkpoint and start from the top")
+    p.add_argument("--offset", type=int, help="Start at this byte offset (must be the start of a line)")
+    p.add_argument("--benchmark", type=int, metavar="ROWS", help="Import a synthetic file of ROWS rows instead")
+    p.set_defaults(func=_cli_import_usage)
+
+    p = commands.add_parser("pack-usage", help="Pack daily usage of closed months into per-user-month BLOBs")
+    p.add_argument("--before", help="Pack months before this date (default: the current month)")
+    p.add_argument("--chunk-users", type=int, default=2000)
+    p.add_argument("--vacuum", action="store_true", help="Shrink the database file afterwards")
+    p.add_argument("--benchmark", type=int, metavar="USERS", help="Seed a year of usage for USERS users and compare")
+    p.set_defaults(func=_cli_pack_usage)
+
+    p = commands.add_parser("quota-rebuild", help="Reconcile period-to-date quota usage against usage")
+    p.add_argument("--benchmark", type=int, metavar="CHECKS", help="Then time CHECKS in-memory quota lookups")
+    p.set_defaults(func=_cli_quota_rebuild)
+
+    p = commands.add_parser("usage-heatmap", help="Print a weekday x hour usage heatmap for a user or city")
+    p.add_argument("--user-id", type=int)
+    p.add_argument("--city")
+    p.add_argument("--start", help="YYYY-MM-DD")
+    p.add_argument("--end", help="YYYY-MM-DD")
+    p.add_argument("--benchmark", type=int, metavar="USERS", help="Seed a month of hourly usage for USERS users and time a city heatmap")
+    p.set_defaults(func=_cli_usage_heatmap)
+
+    p = commands.add_parser("sla-refresh", help="Fold newly resolved tickets into the SLA rollup and print percentiles")
+    p.add_argument("--full", action="store_true", help="Rebuild the rollup from all resolved tickets")
+    p.add_argument("--by", choices=list(SLA_DIMENSIONS), default='all')
+    p.set_defaults(func=_cli_sla_refresh)
+
+    p = commands.add_parser("ticket-queue", help="Show the ticket assignment queue, or benchmark concurrent agents")
+    p.add_argument("--benchmark", type=int, metavar="TICKETS", help="Seed TICKETS open tickets and run simulated agents")
+    p.add_argument("--agents", type=int, default=32)
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.set_defaults(func=_cli_ticket_queue)
+
+    p = commands.add_parser("search", help="Full-text search over tickets, users and plans")
+    p.add_argument("query", nargs="*")
+    p.add_argument("--kind", action="append", choices=list(SEARCH_INDEXES), help="Limit to one kind (repeatable)")
+    p.add_argument("--limit", type=int, default=SEARCH_RESULT_LIMIT)
+    p.add_argument("--rebuild", action="store_true", help="Rebuild and optimize the search indexes")
+    p.add_argument("--benchmark", type=int, metavar="ROWS", help="Time searches over ROWS synthetic tickets")
+    p.set_defaults(func=_cli_search)
+
+    p = commands.add_parser("import-users", help="Bulk-create users from a CSV export")
+    p.add_argument("file", nargs="?")
+    p.add_argument("--chunk-rows", type=int, default=USER_IMPORT_CHUNK_ROWS)
+    p.add_argument("--workers", type=int, help="Password hashing processes (default: CPU count)")
+    p.add_argument("--errors", default="user_import_errors.csv", help="Where to write rejected rows")
+    p.add_argument("--benchmark", type=int, metavar="ROWS", help="Import ROWS synthetic users on a scratch database")
+    p.set_defaults(func=_cli_import_users)
+
+    p = commands.add_parser("export-users", help="Stream the users table to CSV (.csv.gz compresses)")
+    p.add_argument("file")
+    p.add_argument("--chunk-rows", type=int, default=USER_IMPORT_CHUNK_ROWS)
+    p.set_defaults(func=_cli_export_users)
+
+    p = commands.add_parser("import-plans", help="Create and update plans (matched by name) from a CSV catalog")
+    p.add_argument("file", nargs="?")
+    p.add_argument("--dry-run", action="store_true", help="Only report what would change")
+    p.add_argument("--benchmark", type=int, metavar="PLANS", help="Import and re-import PLANS synthetic plans")
+    p.set_defaults(func=_cli_import_plans)
+
+    p = commands.add_parser("plan-index", help="Benchmark the in-memory plan index against list filtering")
+    p.add_argument("--benchmark", type=int, default=5000, metavar="PLANS")
+    p.add_argument("--queries", type=int, default=2000)
+    p.set_defaults(func=_cli_plan_index)
+
+    p = commands.add_parser("compare-plans", help="Compare plans by id, or list the most saved comparisons")
+    p.add_argument("plan_ids", nargs="*", type=int)
+    p.add_argument("--monthly-gb", type=float, help="Projected usage to cost each plan for")
+    p.add_argument("--limit", type=int, default=10)
+    p.add_argument("--benchmark", type=int, metavar="PLANS", help="Time computed vs cached metrics for PLANS plans")
+    p.set_defaults(func=_cli_compare_plans)
+
+    p = commands.add_parser("usage-server", help="Accept accounting record batches over HTTP (POST /usage)")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8098)
+    p.set_defaults(func=_cli_usage_server)
+
+    for name, help_text in (("mock-gateway", "Run a local mock payment gateway"),
+                            ("gateway-benchmark", "Benchmark concurrent charging against a local mock gateway")):
+        p = commands.add_parser(name, help=help_text)
+        p.add_argument("--latency-ms", type=float, default=50.0)
+        p.add_argument("--jitter-ms", type=float, default=20.0)
+        p.add_argument("--failure-rate", type=float, default=0.05, help="Share of requests answered with 503")
+        p.add_argument("--decline-rate", type=float, default=0.02, help="Share of charges declined")
+        if name == "mock-gateway":
+            p.add_argument("--host", default="127.0.0.1")
+            p.add_argument("--port", type=int, default=8099)
+            p.set_defaults(func=_cli_mock_gateway)
+        else:
+            p.add_argument("--charges", type=int, default=5000)
+            p.add_argument("--concurrency", type=int, default=GATEWAY_CONCURRENCY)
+            p.add_argument("--timeout", type=float, default=GATEWAY_TIMEOUT_SECONDS)
+            p.set_defaults(func=_cli_gateway_benchmark)
+
+    args = parser.parse_args(argv)
+    # Benchmarks seed synthetic rows, so they never fall back to the default database
+    if args.db is None and getattr(args, 'benchmark', None) and args.command not in ("plan-index", "quota-rebuild"):
+        parser.error(f"{args.command} --benchmark writes synthetic data; pass --db with a scratch database path")
+    DB_PATH = args.db or DB_PATH
+    create_tables()
+    migrate_database()
+    args.func(args)
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
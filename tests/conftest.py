@@ -0,0 +1,74 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """The app module pointed at a freshly created and migrated scratch database"""
+    monkeypatch.setattr(app, "DB_PATH", str(tmp_path / "broadband.db"))
+    monkeypatch.delenv("PAYMENT_GATEWAY_URL", raising=False)
+    # Module-level caches are keyed by catalog version, which restarts at 0 per database
+    monkeypatch.setattr(app, "_PLAN_CACHE", {'version': None, 'plans': []})
+    monkeypatch.setattr(app, "_COMPARISON_CACHE", {})
+    monkeypatch.setattr(app, "PLAN_INDEX", app.PlanIndex())
+    monkeypatch.setattr(app, "QUOTA_ENGINE", app.QuotaEngine())
+    app.create_tables()
+    app.migrate_database()
+    return app
+
+
+@pytest.fixture
+def rows(db):
+    """Run a query against the scratch database and return its rows as tuples"""
+    return lambda sql, *params: [tuple(r) for r in db.exec_query(sql, params, fetch=True)]
+
+
+def _insert(table, **values):
+    conn = app.get_conn()
+    cur = conn.execute(
+        f"INSERT INTO {table} ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+        tuple(values.values())
+    )
+    conn.commit()
+    conn.close()
+    return cur.lastrowid
+
+
+@pytest.fixture
+def seed(db):
+    """Row factories for plans, users and subscriptions in the scratch database"""
+    class Seed:
+        @staticmethod
+        def plan(name="Home Essential", price=499.0, validity_days=30, data_limit_gb=100.0, is_unlimited=0):
+            return _insert('plans', name=name, speed_mbps=50, data_limit_gb=data_limit_gb, price=price,
+                           validity_days=validity_days, is_unlimited=is_unlimited)
+
+        @staticmethod
+        def user(username, autopay=0):
+            return _insert('users', username=username, role='customer', name=username.title(),
+                           email=f"{username}@example.com", is_autopay_enabled=autopay)
+
+        @staticmethod
+        def subscription(user_id, plan_id, start_date, end_date, status='active', auto_renew=1, renewal_count=0):
+            return _insert('subscriptions', user_id=user_id, plan_id=plan_id, start_date=start_date,
+                           end_date=end_date, status=status, auto_renew=auto_renew, renewal_count=renewal_count)
+
+        @staticmethod
+        def payment(user_id, amount, status, subscription_id=None, payment_date=None):
+            return _insert('payments', user_id=user_id, subscription_id=subscription_id, amount=amount,
+                           status=status, payment_date=payment_date or app.datetime.utcnow().isoformat())
+
+        @staticmethod
+        def ticket(user_id, status='open', priority='medium', created_date=None, category='technical',
+                   subject="Slow speeds", description="Speeds drop every evening"):
+            return _insert('support_tickets', user_id=user_id, subject=subject, description=description,
+                           category=category, status=status, priority=priority,
+                           created_date=created_date or app.datetime.utcnow().isoformat())
+
+    return Seed
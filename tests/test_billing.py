@@ -0,0 +1,150 @@
+import pytest
+
+
+@pytest.fixture
+def due(seed):
+    plan = seed.plan(price=500.0)
+    autopay = seed.subscription(seed.user('asha', autopay=1), plan, '2026-01-01', '2026-01-31', renewal_count=1)
+    invoiced = seed.subscription(seed.user('ravi'), plan, '2026-01-01', '2026-01-31')
+    later = seed.subscription(seed.user('meera'), plan, '2026-01-20', '2026-02-19')
+    return autopay, invoiced, later
+
+
+def test_billing_run_renews_due_subscriptions(db, due, rows):
+    autopay, invoiced, later = due
+    result = db.run_billing(as_of='2026-01-31')
+
+    assert result['renewed'] == 2
+    status = dict(rows("SELECT id, status FROM subscriptions"))
+    assert (status[autopay], status[invoiced], status[later]) == ('expired', 'expired', 'active')
+    renewals = rows("SELECT start_date, end_date, renewal_count FROM subscriptions WHERE created_date IS NOT NULL ORDER BY id")
+    assert renewals == [('2026-01-31', '2026-03-02', 2), ('2026-01-31', '2026-03-02', 1)]
+    # 500 + 18% GST - 5% loyalty discount; autopay is charged, everyone else invoiced
+    assert rows("SELECT amount, status, payment_method FROM payments ORDER BY id") == [
+        (565.0, 'paid', 'autopay'), (565.0, 'pending', 'invoice')]
+    assert rows("SELECT COUNT(*) FROM notifications WHERE notification_type = 'subscription_renewed'") == [(2,)]
+
+
+def test_billing_run_is_idempotent(db, due, rows):
+    db.run_billing(as_of='2026-01-31')
+    again = db.run_billing(as_of='2026-01-31')
+
+    assert again['renewed'] == 0
+    assert rows("SELECT COUNT(*) FROM payments") == [(2,)]
+    assert rows("SELECT COUNT(*) FROM subscriptions WHERE status = 'active'") == [(3,)]
+
+
+def test_billing_run_resumes_after_a_failed_chunk(db, due, monkeypatch, rows):
+    renew_chunk = db._renew_chunk
+    calls = []
+
+    def crash_on_second_chunk(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("worker died")
+        return renew_chunk(*args, **kwargs)
+
+    monkeypatch.setattr(db, "_renew_chunk", crash_on_second_chunk)
+    with pytest.raises(RuntimeError):
+        db.run_billing(as_of='2026-01-31', chunk_size=1)
+    assert rows("SELECT COUNT(*) FROM payments") == [(1,)]
+
+    monkeypatch.setattr(db, "_renew_chunk", renew_chunk)
+    result = db.run_billing(as_of='2026-01-31', chunk_size=1)
+    assert result['renewed'] == 1
+    assert rows("SELECT COUNT(*), COUNT(DISTINCT transaction_id) FROM payments") == [(2, 2)]
+    assert rows("SELECT COUNT(*) FROM billing_runs WHERE status = 'completed'") == [(1,)]
+
+
+def test_subscribe_user_to_plan_returns_the_new_subscription(db, seed, rows):
+    plan = seed.plan(validity_days=30)
+    user = seed.user('asha')
+    first = db.subscribe_user_to_plan(user, plan)
+    second = db.subscribe_user_to_plan(user, plan)
+
+    assert second != first
+    assert dict(rows("SELECT id, status FROM subscriptions")) == {first: 'cancelled', second: 'active'}
+
+
+def test_billing_history_pages_reach_undated_payments(db, seed, rows):
+    user = seed.user('asha')
+    ids = [seed.payment(user, 100.0 + i, 'paid', payment_date=f"2026-0{i + 1}-01T10:00:00") for i in range(3)]
+    undated = [seed.payment(user, 50.0, 'paid') for _ in range(3)]
+    db.exec_query("UPDATE payments SET payment_date = NULL WHERE id IN (?, ?, ?)", tuple(undated))
+
+    seen, before = [], None
+    while True:
+        page = db.get_billing_history(user, before=before, limit=2)
+        if page.empty:
+            break
+        seen += page['id'].tolist()
+        before = (page['sort_key'].iloc[-1], int(page['id'].iloc[-1]))
+    assert seen == ids[::-1] + undated[::-1]
+
+
+def _settle_payments(db, seed, rows, user):
+    """Payments through every status transition the app makes; 590 + 236 + 118 - 200 + 475 to the balance"""
+    def pending(amount, tax=0.0, discount=0.0, status='pending'):
+        db.exec_query("INSERT INTO payments (user_id, amount, status, payment_date, tax_amount, discount) "
+                      "VALUES (?, ?, ?, ?, ?, ?)", (user, amount, status, db.datetime.utcnow().isoformat(), tax, discount))
+        return rows("SELECT MAX(id) FROM payments")[0][0]
+
+    seed.payment(user, 590.0, 'paid')
+    settled = pending(236.0, tax=36.0)
+    db.exec_query("UPDATE payments SET status = 'paid' WHERE id = ?", (settled,))
+    retried = seed.payment(user, 118.0, 'failed')
+    db.exec_query("UPDATE payments SET status = 'paid' WHERE id = ? AND status = 'failed'", (retried,))
+    declined = pending(100.0)
+    db.exec_query("UPDATE payments SET status = 'failed' WHERE id = ?", (declined,))
+    assert db.process_refund(user, 200.0)
+    pending(475.0, tax=75.0, discount=25.0, status='paid')
+
+
+def _ledger_state(rows):
+    return (rows("SELECT user_id, payment_id, entry_type, amount, balance_after FROM ledger_entries ORDER BY id"),
+            rows("SELECT user_id, balance, total_paid, total_tax, total_discount, total_refunded, paid_count, "
+                 "failed_count, last_payment_date FROM account_balances ORDER BY user_id"))
+
+
+def test_account_balance_matches_the_ledger_after_each_transition(db, seed, rows):
+    asha, ravi = seed.user('asha'), seed.user('ravi')
+    _settle_payments(db, seed, rows, asha)
+    seed.payment(ravi, 300.0, 'paid')
+
+    assert rows("""
+        SELECT b.user_id, b.balance, SUM(l.amount),
+               (SELECT balance_after FROM ledger_entries WHERE user_id = b.user_id ORDER BY id DESC LIMIT 1)
+        FROM account_balances b JOIN ledger_entries l ON l.user_id = b.user_id
+        GROUP BY b.user_id ORDER BY b.user_id""") == [(asha, 1219.0, 1219.0, 1219.0), (ravi, 300.0, 300.0, 300.0)]
+    assert rows("SELECT total_paid, total_tax, total_discount, total_refunded, paid_count, failed_count "
+                "FROM account_balances WHERE user_id = ?", asha) == [(1419.0, 111.0, 25.0, 200.0, 4, 1)]
+    assert rows("SELECT entry_type, amount FROM ledger_entries WHERE user_id = ? AND entry_type != 'charge'", asha) == [
+        ('tax', 36.0), ('refund', -200.0), ('tax', 75.0), ('discount', -25.0)]
+
+
+def test_rebuild_account_ledger_is_idempotent(db, seed, rows):
+    asha = seed.user('asha')
+    _settle_payments(db, seed, rows, asha)
+    posted = _ledger_state(rows)
+
+    assert db.rebuild_account_ledger() == (0, 1)
+    assert db.rebuild_account_ledger() == (0, 1)
+    assert _ledger_state(rows) == posted
+
+
+def test_rebuild_account_ledger_posts_payments_from_before_the_triggers(db, seed, rows):
+    asha = seed.user('asha')
+    db.exec_query("DROP TRIGGER trg_payments_ledger_insert")
+    db.exec_query("DROP TRIGGER trg_payments_ledger_update")
+    _settle_payments(db, seed, rows, asha)
+    db.create_tables()
+    assert rows("SELECT COUNT(*) FROM ledger_entries") == [(0,)]
+
+    posted, accounts = db.rebuild_account_ledger()
+    assert (posted, accounts) == (8, 1)
+    ledger, balances = _ledger_state(rows)
+    assert balances[0][1:8] == (1219.0, 1419.0, 111.0, 25.0, 200.0, 4, 1)
+    assert ledger[-1][4] == sum(entry[3] for entry in ledger) == 1219.0
+
+    assert db.rebuild_account_ledger() == (0, 1)
+    assert _ledger_state(rows) == (ledger, balances)
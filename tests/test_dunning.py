@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+NOW = datetime(2026, 3, 1, 9, 0)
+
+
+@pytest.fixture
+def failed(db, seed):
+    plan = seed.plan(price=500.0)
+    user = seed.user('asha')
+    billed = seed.subscription(user, plan, '2026-02-20', '2026-03-22')
+    other = seed.subscription(user, plan, '2026-02-01', '2026-03-03')
+    payment = seed.payment(user, 590.0, 'failed', subscription_id=billed, payment_date=(NOW - timedelta(days=2)).isoformat())
+    seed.payment(user, 590.0, 'failed', subscription_id=other, payment_date='2025-06-01T10:00:00')
+    return user, billed, other, payment
+
+
+def test_without_a_gateway_failures_are_enrolled_but_not_collected(db, failed, rows):
+    user, _, _, payment = failed
+    result = db.run_dunning(now=NOW)
+
+    assert (result['enrolled'], result['retried'], result['recovered']) == (1, 0, 0)
+    assert rows("SELECT status FROM payments WHERE id = ?", payment) == [('failed',)]
+    assert rows("SELECT payment_id, status FROM dunning_queue") == [(payment, 'active')]
+    assert rows("SELECT COALESCE(SUM(balance), 0) FROM account_balances") == [(0,)]
+
+    later = db.run_dunning(now=NOW + timedelta(days=30))
+    assert (later['enrolled'], later['retried'], later['due']) == (0, 0, 1)
+    assert rows("SELECT status FROM payments WHERE id = ?", payment) == [('failed',)]
+
+
+def test_old_failures_are_not_enrolled_or_notified(db, failed, rows):
+    db.run_dunning(now=NOW)
+    assert rows("SELECT COUNT(*) FROM dunning_queue") == [(1,)]
+    assert rows("SELECT notification_type FROM notifications") == [('payment_failed',)]
+
+
+def test_recovered_payment_posts_to_the_ledger(db, failed, monkeypatch, rows):
+    user, _, _, payment = failed
+    monkeypatch.setattr(db, "_charge_dunning_batch", lambda batch, url: [{'status': 'paid', 'error': None}] * len(batch))
+    db.run_dunning(now=NOW)
+    result = db.run_dunning(gateway_url="http://gw.local", now=NOW + timedelta(days=1))
+
+    assert result['recovered'] == 1
+    assert rows("SELECT status FROM payments WHERE id = ?", payment) == [('paid',)]
+    assert rows("SELECT balance FROM account_balances WHERE user_id = ?", user) == [(590.0,)]
+
+
+def test_persistent_failure_suspends_only_the_billed_subscription(db, failed, monkeypatch, rows):
+    _, billed, other, _ = failed
+    monkeypatch.setattr(db, "_charge_dunning_batch",
+                        lambda batch, url: [{'status': 'failed', 'error': 'declined'}] * len(batch))
+    now = NOW
+    for _ in range(db.DUNNING_MAX_FAILURES + 1):
+        db.run_dunning(gateway_url="http://gw.local", now=now)
+        now += timedelta(days=8)
+
+    assert rows("SELECT status, failures FROM dunning_queue") == [('suspended', db.DUNNING_MAX_FAILURES)]
+    status = dict(rows("SELECT id, status FROM subscriptions"))
+    assert (status[billed], status[other]) == ('suspended', 'active')
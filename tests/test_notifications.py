@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+
+def test_retention_covers_every_notification_type(db, seed, rows):
+    user = seed.user('asha')
+    now = datetime.utcnow()
+    conn = db.get_conn()
+    conn.executemany(
+        "INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, 'x', ?, ?)",
+        [(user, 'quota_warning', (now - timedelta(days=90)).isoformat()),
+         (user, 'quota_warning', (now - timedelta(days=10)).isoformat()),
+         (user, 'subscription_renewed', (now - timedelta(days=400)).isoformat()),
+         (user, 'something_new', (now - timedelta(days=400)).isoformat()),
+         (user, None, (now - timedelta(days=400)).isoformat()),
+         (user, 'something_new', (now - timedelta(days=30)).isoformat())]
+    )
+    conn.commit()
+    conn.close()
+
+    result = db.run_notification_retention()
+
+    assert result['notifications_deleted'] == 4
+    assert sorted(rows("SELECT notification_type FROM notifications")) == [('quota_warning',), ('something_new',)]
+
+
+def _notify(db, user, count):
+    conn = db.get_conn()
+    ids = [conn.execute("INSERT INTO notifications (user_id, message, notification_type, created_date) VALUES (?, 'x', NULL, ?)",
+                        (user, datetime.utcnow().isoformat())).lastrowid for _ in range(count)]
+    conn.commit()
+    conn.close()
+    return ids
+
+
+def test_mark_all_read_stops_at_the_newest_seen_id(db, seed, rows):
+    user, other = seed.user('asha'), seed.user('ravi')
+    ids = _notify(db, user, 4)
+    _notify(db, other, 1)
+
+    assert db.mark_all_read(user, up_to_id=ids[1]) == 2
+    assert rows("SELECT id FROM notifications WHERE user_id = ? AND is_read = 0 ORDER BY id", user) == [(ids[2],), (ids[3],)]
+    assert (db.get_unread_notification_count(user), db.get_unread_notification_count(other)) == (2, 1)
+    assert db.mark_all_read(user) == 2
+    assert db.get_unread_notification_count(user) == 0
+
+
+def test_unread_counters_match_a_recount(db, seed, rows):
+    users = [seed.user(name) for name in ('asha', 'ravi', 'meera')]
+    ids = [i for user in users for i in _notify(db, user, 3)]
+    db.mark_notification_read(ids[0])
+    db.mark_notification_read(ids[0])
+    db.exec_query("UPDATE notifications SET is_read = 0 WHERE id = ?", (ids[0],))
+    db.exec_query("UPDATE notifications SET is_read = 1 WHERE id IN (?, ?)", (ids[3], ids[4]))
+    db.exec_query("DELETE FROM notifications WHERE id IN (?, ?)", (ids[5], ids[6]))
+
+    recount = "SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id ORDER BY user_id"
+    expected = rows(recount)
+    assert expected == [(users[0], 3), (users[2], 2)]
+    assert [(u, db.get_unread_notification_count(u)) for u, _ in expected] == expected
+    assert db.get_unread_notification_count(users[1]) == 0
+    db.rebuild_notification_counters()
+    assert rows("SELECT user_id, unread_count FROM notification_counters WHERE unread_count > 0 ORDER BY user_id") == expected
@@ -0,0 +1,58 @@
+import pytest
+
+
+def test_gateway_url_scheme(db):
+    assert (db.HttpPaymentGateway("http://gw.local/v1").port, db.HttpPaymentGateway("http://gw.local/v1").ssl) == (80, None)
+    secure = db.HttpPaymentGateway("https://gw.example.com/v1")
+    assert secure.port == 443 and secure.ssl is not None
+    for url in ("ftp://gw.example.com", "gw.example.com:8099"):
+        with pytest.raises(ValueError):
+            db.HttpPaymentGateway(url)
+
+
+def test_charges_are_idempotent_against_the_mock_gateway(db):
+    server = db.MockGatewayServer(latency_ms=1, jitter_ms=0, seed=7).start()
+    try:
+        charges = [{'transaction_id': f"T{i}", 'user_id': i, 'amount': 100.0} for i in range(5)]
+        first = db.charge_payments(charges, gateway_url=server.url)
+        again = db.charge_payments(charges, gateway_url=server.url)
+    finally:
+        server.stop()
+    assert [r['status'] for r in first] == ['paid'] * 5
+    assert [r['reference'] for r in again] == [r['reference'] for r in first]
+    assert server.charges == 5
+
+
+def test_billing_records_charges_for_subscriptions_cancelled_meanwhile(db, seed, monkeypatch, rows):
+    plan = seed.plan(name="Home Essential", price=500.0)
+    user = seed.user('asha', autopay=1)
+    sub = seed.subscription(user, plan, '2026-01-01', '2026-01-31')
+
+    def charge_then_cancel(due, gateway_url):
+        # The gateway captures the charge; the user cancels before the chunk commits
+        db.exec_query("UPDATE subscriptions SET status = 'cancelled' WHERE id = ?", (sub,))
+        return db.np.array(['paid'], dtype=object)
+
+    monkeypatch.setattr(db, "_charge_renewals", charge_then_cancel)
+    result = db.run_billing(as_of='2026-01-31', gateway_url="http://gw.local")
+
+    assert (result['renewed'], result['unapplied_charges']) == (0, 1)
+    assert rows("SELECT subscription_id, amount, status, transaction_id FROM payments") == [
+        (sub, 565.0, 'paid', f"REN{sub:010d}")]
+    assert rows("SELECT balance FROM account_balances WHERE user_id = ?", user) == [(565.0,)]
+    assert rows("SELECT notification_type FROM notifications") == [('payment_credit',)]
+
+
+def test_billing_records_nothing_for_uncharged_subscriptions_cancelled_meanwhile(db, seed, monkeypatch, rows):
+    plan = seed.plan(name="Home Essential", price=500.0)
+    sub = seed.subscription(seed.user('ravi', autopay=0), plan, '2026-01-01', '2026-01-31')
+
+    def cancel_without_charging(due, gateway_url):
+        db.exec_query("UPDATE subscriptions SET status = 'cancelled' WHERE id = ?", (sub,))
+        return db.np.array(['paid'], dtype=object)
+
+    monkeypatch.setattr(db, "_charge_renewals", cancel_without_charging)
+    result = db.run_billing(as_of='2026-01-31', gateway_url="http://gw.local")
+
+    assert (result['renewed'], result['unapplied_charges']) == (0, 0)
+    assert rows("SELECT COUNT(*) FROM payments") == [(0,)]
@@ -0,0 +1,91 @@
+import math
+
+import pytest
+
+
+@pytest.fixture
+def plans(db, seed):
+    """Lite, Plus (a 90-day pack), Unlimited and Slow, which Lite and Plus both beat"""
+    ids = {}
+    for name, price, validity, limit, unlimited, speed in (("Lite", 300.0, 30, 100.0, 0, 50),
+                                                           ("Plus", 1200.0, 90, 600.0, 0, 100),
+                                                           ("Unlimited", 800.0, 30, 0.0, 1, 200),
+                                                           ("Slow", 450.0, 30, 100.0, 0, 50)):
+        ids[name] = seed.plan(name=name, price=price, validity_days=validity, data_limit_gb=limit, is_unlimited=unlimited)
+        db.exec_query("UPDATE plans SET speed_mbps = ? WHERE id = ?", (speed, ids[name]))
+    return ids
+
+
+def _close(actual, expected):
+    actual = list(actual)
+    return len(actual) == len(expected) and all(
+        (math.isnan(a) and math.isnan(e)) or math.isclose(a, e) for a, e in zip(actual, expected))
+
+
+def test_metrics_match_hand_computed_costs(db, plans):
+    names = ["Unlimited", "Lite", "Slow", "Plus"]
+    frame = db.get_plan_comparison([plans[n] for n in names], monthly_gb=250)
+
+    assert frame['name'].tolist() == names
+    assert _close(frame['monthly_price'], [800.0, 300.0, 450.0, 400.0])
+    assert _close(frame['price_per_gb'], [math.nan, 3.0, 4.5, 2.0])
+    assert _close(frame['mbps_per_rupee'], [200 / 800, 50 / 300, 50 / 450, 100 / 1200])
+    assert _close(frame['upload_mbps'], [20.0, 5.0, 5.0, 10.0])
+    assert frame['dominated_by'].tolist() == ["", "", "Lite, Plus", ""]
+    # 250 GB needs three 100 GB packs of Lite and Slow, one of Plus
+    assert frame['covers_usage'].tolist() == [True, False, False, True]
+    assert _close(frame['cost_for_usage'], [800.0, 900.0, 1350.0, 400.0])
+
+
+def test_set_key_ignores_order_and_repeats(db, plans):
+    lite, plus = plans["Lite"], plans["Plus"]
+    assert db.comparison_set_key([plus, lite, lite]) == db.comparison_set_key([str(lite), plus])
+    assert db.comparison_set_key([lite, plus])[1] == f"{lite},{plus}"
+
+    frame = db.get_plan_comparison([plus, lite, plus])
+    assert frame['name'].tolist() == ["Plus", "Lite"]
+    assert db.get_plan_comparison([lite, plus])['name'].tolist() == ["Lite", "Plus"]
+
+
+def test_metrics_are_stored_per_catalog_version(db, plans, monkeypatch, rows):
+    ids = [plans["Lite"], plans["Plus"]]
+    set_hash, canonical = db.comparison_set_key(ids)
+    first = db.get_plan_comparison(ids)
+    version = db.plan_catalog_version()
+    assert rows("SELECT plan_ids, hits, catalog_version FROM plan_comparison_sets WHERE set_hash = ?", set_hash) == [
+        (canonical, 0, version)]
+
+    compute = db.plan_comparison_metrics
+    monkeypatch.setattr(db, "plan_comparison_metrics", lambda plans: pytest.fail("recomputed"))
+    db._COMPARISON_CACHE.clear()
+    stored = db.get_plan_comparison(ids)
+    assert stored[['name', 'monthly_price', 'dominated_by']].values.tolist() == \
+        first[['name', 'monthly_price', 'dominated_by']].values.tolist()
+    assert _close(stored['price_per_gb'], first['price_per_gb'].tolist())
+
+    monkeypatch.setattr(db, "plan_comparison_metrics", compute)
+    db.exec_query("UPDATE plans SET price = 150 WHERE id = ?", (plans["Lite"],))
+    assert db.get_plan_comparison(ids)['monthly_price'].tolist() == [150.0, 400.0]
+    assert rows("SELECT catalog_version FROM plan_comparison_sets WHERE set_hash = ?", set_hash) == [
+        (db.plan_catalog_version(),)]
+
+
+def test_saved_sets_are_counted_and_rebuilt_from_history(db, seed, plans, rows):
+    asha, ravi = seed.user('asha'), seed.user('ravi')
+    lite, plus, slow = plans["Lite"], plans["Plus"], plans["Slow"]
+    db.save_plan_comparison(asha, [plus, lite])
+    db.save_plan_comparison(ravi, [lite, plus, lite])
+    db.save_plan_comparison(ravi, [slow, lite])
+
+    counts = rows("SELECT plan_ids, hits FROM plan_comparison_sets ORDER BY hits DESC")
+    assert counts == [(f"{lite},{plus}", 2), (f"{lite},{slow}", 1)]
+    assert rows("SELECT user_id, plan_ids FROM plan_comparisons ORDER BY id") == [
+        (asha, f"{lite},{plus}"), (ravi, f"{lite},{plus}"), (ravi, f"{lite},{slow}")]
+
+    # History written before canonical lists may hold unsorted ids
+    db.exec_query("INSERT INTO plan_comparisons (user_id, plan_ids, created_date) VALUES (?, ?, ?)",
+                  (asha, f"{slow},{lite}", "2026-01-01T00:00:00"))
+    assert db.rebuild_plan_comparison_sets() == 2
+    assert db.rebuild_plan_comparison_sets() == 2
+    assert rows("SELECT plan_ids, hits FROM plan_comparison_sets ORDER BY plan_ids") == [
+        (f"{lite},{plus}", 2), (f"{lite},{slow}", 2)]
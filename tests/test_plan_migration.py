@@ -0,0 +1,98 @@
+import pytest
+
+
+@pytest.fixture
+def plans(seed):
+    return seed.plan(name="Home Essential", price=300.0), seed.plan(name="Home Plus", price=500.0)
+
+
+@pytest.fixture
+def subscribers(db, seed, plans):
+    # 20 of 30 days left in the current period
+    today = db.datetime.utcnow().date()
+    start, end = (today - db.timedelta(days=10)).isoformat(), (today + db.timedelta(days=20)).isoformat()
+    source, _ = plans
+    return [seed.subscription(seed.user(name, autopay=autopay), source, start, end)
+            for name, autopay in (('asha', 1), ('ravi', 0), ('meera', 1))]
+
+
+def test_dry_run_writes_nothing(db, plans, subscribers, rows):
+    source, target = plans
+    preview = db.migrate_plan_subscribers(source, target, dry_run=True)
+
+    assert rows("SELECT COUNT(*) FROM payments") == [(0,)]
+    assert rows("SELECT COUNT(*) FROM plan_migration_runs") == [(0,)]
+    assert rows("SELECT COUNT(*) FROM subscriptions WHERE plan_id = ?", source) == [(3,)]
+
+    result = db.migrate_plan_subscribers(source, target)
+    for key in ('subscriptions', 'charges', 'charged_amount', 'credits', 'net_prorated_revenue'):
+        assert preview[key] == result[key]
+
+
+def test_migration_prorates_the_rest_of_the_period(db, plans, subscribers, rows):
+    source, target = plans
+    result = db.migrate_plan_subscribers(source, target)
+
+    # (500 - 300) * 20 / 30; autopay is charged, everyone else invoiced
+    assert (result['subscriptions'], result['charged_amount']) == (3, 399.99)
+    assert rows("SELECT amount, status, payment_method FROM payments ORDER BY id") == [
+        (133.33, 'paid', 'autopay'), (133.33, 'pending', 'invoice'), (133.33, 'paid', 'autopay')]
+    assert rows("SELECT COUNT(*) FROM subscriptions WHERE plan_id = ? AND status = 'active'", target) == [(3,)]
+    assert rows("SELECT COUNT(*) FROM subscriptions WHERE status = 'migrated'") == [(3,)]
+
+
+def test_downgrade_is_credited(db, seed, plans, subscribers, rows):
+    source, _ = plans
+    result = db.migrate_plan_subscribers(source, seed.plan(name="Home Lite", price=100.0))
+
+    assert (result['credits'], result['credited_amount']) == (3, 399.99)
+    assert rows("SELECT DISTINCT amount, status, payment_method FROM payments WHERE amount < 0") == [
+        (-133.33, 'refunded', 'account_credit')]
+
+
+def test_migration_is_idempotent(db, plans, subscribers, rows):
+    source, target = plans
+    db.migrate_plan_subscribers(source, target)
+    again = db.migrate_plan_subscribers(source, target)
+
+    assert again['subscriptions'] == 0
+    assert rows("SELECT COUNT(*) FROM payments") == [(3,)]
+
+
+def test_migration_resumes_after_a_failed_chunk(db, plans, subscribers, monkeypatch, rows):
+    source, target = plans
+    migrate_chunk = db._migrate_chunk
+    calls = []
+
+    def crash_on_second_chunk(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("worker died")
+        return migrate_chunk(*args, **kwargs)
+
+    monkeypatch.setattr(db, "_migrate_chunk", crash_on_second_chunk)
+    with pytest.raises(RuntimeError):
+        db.migrate_plan_subscribers(source, target, chunk_size=1)
+    assert rows("SELECT COUNT(*) FROM payments") == [(1,)]
+
+    monkeypatch.setattr(db, "_migrate_chunk", migrate_chunk)
+    result = db.migrate_plan_subscribers(source, target, chunk_size=1)
+    assert result['subscriptions'] == 2
+    assert rows("SELECT COUNT(*), COUNT(DISTINCT transaction_id) FROM payments") == [(3, 3)]
+    assert rows("SELECT status, migrated FROM plan_migration_runs") == [('completed', 3)]
+
+
+def test_migration_records_charges_for_subscriptions_cancelled_meanwhile(db, plans, subscribers, monkeypatch, rows):
+    source, target = plans
+    cancelled = subscribers[0]
+
+    def charge_then_cancel(due, amounts, gateway_url):
+        db.exec_query("UPDATE subscriptions SET status = 'cancelled' WHERE id = ?", (cancelled,))
+        return db.np.array(['paid'] * len(due), dtype=object)
+
+    monkeypatch.setattr(db, "_charge_migrations", charge_then_cancel)
+    result = db.migrate_plan_subscribers(source, target, gateway_url="http://gw.local")
+
+    assert (result['subscriptions'], result['unapplied_charges']) == (2, 1)
+    assert rows("SELECT amount, status FROM payments WHERE subscription_id = ?", cancelled) == [(133.33, 'paid')]
+    assert rows("SELECT COUNT(*) FROM notifications WHERE notification_type = 'payment_credit'") == [(1,)]
@@ -0,0 +1,130 @@
+import io
+import itertools
+import math
+
+import pandas as pd
+
+
+def _csv(text):
+    return pd.read_csv(io.StringIO(text))
+
+
+def test_is_unlimited_accepts_numbers_and_text(db):
+    frame = _csv("name,speed_mbps,data_limit_gb,price,validity_days,description,is_unlimited\n" + "".join(
+        f"P{i},100,500,499,30,,{flag}\n" for i, flag in enumerate(('yes', '1', '1.0', 'True', '0', 'no', ''))))
+    clean, errors = db.coerce_plan_frame(frame)
+    assert errors == {}
+    assert clean['is_unlimited'].tolist() == [1, 1, 1, 1, 0, 0, 0]
+
+
+def test_updates_only_touch_columns_in_the_csv(db, seed, rows):
+    plan = seed.plan(name="Home Essential", price=499.0)
+    db.exec_query("UPDATE plans SET description = 'Keep me', plan_type = 'premium', features = 'Router', "
+                  "upload_speed_mbps = 20 WHERE id = ?", (plan,))
+    diff = db.diff_plan_catalog(_csv(
+        "name,speed_mbps,data_limit_gb,price,validity_days,description\n"
+        "Home Essential,50,100,549,30,Keep me\n"
+        "Home Max,300,1000,999,30,\n"))
+
+    assert diff['update'][['id', 'changed']].values.tolist() == [[plan, 'price']]
+    result = db.apply_plan_catalog(diff)
+    assert (result['created'], result['updated'], result['unchanged']) == (1, 1, 0)
+    assert rows("SELECT name, price, description, plan_type, features, upload_speed_mbps FROM plans ORDER BY id") == [
+        ('Home Essential', 549.0, 'Keep me', 'premium', 'Router', 20),
+        ('Home Max', 999.0, '', 'standard', '', 30)]
+
+    again = db.diff_plan_catalog(_csv(
+        "name,speed_mbps,data_limit_gb,price,validity_days,description\n"
+        "Home Essential,50,100,549,30,Keep me\n"))
+    assert (len(again['insert']), len(again['update']), again['unchanged']) == (0, 0, 1)
+
+
+def test_rejected_rows_report_their_csv_line(db):
+    diff = db.diff_plan_catalog(_csv(
+        "name,speed_mbps,data_limit_gb,price,validity_days,description\n"
+        "Fibre 100,100,500,499,30,\n"
+        ",100,500,499,30,\n"
+        "Fibre 200,fast,500,499,30,\n"
+        "Fibre 300,300,500,-1,30,\n"
+        "Fibre 100,100,500,449,30,\n"))
+
+    assert diff['errors'].values.tolist() == [
+        [2, 'Fibre 100', 'superseded by a later row with the same name'],
+        [3, '', 'missing name'],
+        [4, 'Fibre 200', 'speed_mbps must be a positive number'],
+        [5, 'Fibre 300', 'price must be zero or more'],
+    ]
+    assert diff['insert'][['name', 'price']].values.tolist() == [['Fibre 100', 449.0]]
+
+
+def _catalog():
+    # Prices and speeds sit on every filter boundary; in price order like get_all_plans()
+    return [{'id': i, 'name': name, 'price': price, 'speed_mbps': speed, 'data_limit_gb': limit,
+             'plan_type': plan_type, 'is_unlimited': unlimited}
+            for i, (name, price, speed, limit, plan_type, unlimited) in enumerate((
+                ("Fibre Lite", 499.99, 50, 100.0, 'basic', 0),
+                ("Fibre Start", 500.0, 100, 250.0, 'Basic', 0),
+                ("Fibre Max", 750.0, 101, 0.0, 'premium', 1),
+                ("Home Plus", 1000.0, 500, 500.0, 'standard', 0),
+                ("Home Max", 1000.01, 501, 1000.0, 'premium', 1),
+                ("Home Ultra", 1500.0, 1000, 2000.0, None, 0)))]
+
+
+def test_index_filters_match_list_comprehensions(db):
+    catalog = _catalog()
+    index = db.PlanIndex(refresh_seconds=None)
+    index.load(catalog)
+    by_price = {
+        "Under ₹500": lambda p: p['price'] < 500,
+        "₹500-₹1000": lambda p: 500 <= p['price'] <= 1000,
+        "Above ₹1000": lambda p: p['price'] > 1000,
+    }
+    by_speed = {
+        "Up to 100 Mbps": lambda p: p['speed_mbps'] <= 100,
+        "100-500 Mbps": lambda p: 100 < p['speed_mbps'] <= 500,
+        "500+ Mbps": lambda p: p['speed_mbps'] > 500,
+    }
+    assert list(by_price) == list(db.PLAN_PRICE_FILTERS) and list(by_speed) == list(db.PLAN_SPEED_FILTERS)
+
+    for price, speed, plan_type in itertools.product([None, *by_price], [None, *by_speed],
+                                                     [None, "Basic", "Premium", "Elite"]):
+        ranges = {}
+        expected = catalog
+        if price:
+            ranges['price'] = db.PLAN_PRICE_FILTERS[price]
+            expected = [p for p in expected if by_price[price](p)]
+        if speed:
+            ranges['speed_mbps'] = db.PLAN_SPEED_FILTERS[speed]
+            expected = [p for p in expected if by_speed[speed](p)]
+        if plan_type:
+            expected = [p for p in expected if (p.get('plan_type') or 'basic').lower() == plan_type.lower()]
+        assert index.filter(plan_type=plan_type, **ranges) == expected, (price, speed, plan_type)
+
+    assert [p['name'] for p in index.filter(price=db.PLAN_PRICE_FILTERS["Under ₹500"])] == ["Fibre Lite"]
+
+
+def test_price_per_gb_leaves_out_unlimited_plans(db):
+    index = db.PlanIndex(refresh_seconds=None)
+    index.load(_catalog())
+
+    per_gb = index._state['values']['price_per_gb']
+    assert [math.isnan(v) for v in per_gb] == [False, False, True, False, True, False]
+    assert [p['name'] for p in index.filter(price_per_gb=(None, None))] == [
+        "Fibre Lite", "Fibre Start", "Home Plus", "Home Ultra"]
+    assert [p['name'] for p in index.filter(price_per_gb=(1.0, 2.0))] == ["Fibre Start", "Home Plus"]
+    assert [p['name'] for p in index.filter(is_unlimited=True)] == ["Fibre Max", "Home Max"]
+
+
+def test_name_prefix_lookup_is_case_insensitive_in_price_order(db, seed):
+    for name, price in (("Home Max", 1200.0), ("Fibre 100", 499.0), ("home Lite", 299.0), ("Homestead", 799.0)):
+        seed.plan(name=name, price=price)
+    index = db.PlanIndex(refresh_seconds=0)
+
+    assert index.names("home ") == ["home Lite", "Home Max"]
+    assert index.names("HOME") == ["home Lite", "Homestead", "Home Max"]
+    assert index.names("Fibre 2") == []
+    assert index.names() == ["home Lite", "Fibre 100", "Homestead", "Home Max"]
+    assert index.get("Home Max")['price'] == 1200.0 and index.get("home max") is None
+
+    seed.plan(name="Home Air", price=399.0)
+    assert index.names("home ") == ["home Lite", "Home Air", "Home Max"]
@@ -0,0 +1,67 @@
+from datetime import date, timedelta
+
+
+def test_rebuild_only_notifies_for_open_periods(db, seed, rows):
+    plan = seed.plan(data_limit_gb=10.0)
+    today = date.today()
+    closed = seed.subscription(seed.user('asha'), plan, '2025-01-01', '2025-01-31')
+    current = seed.subscription(seed.user('ravi'), plan, (today - timedelta(days=5)).isoformat(),
+                                (today + timedelta(days=25)).isoformat())
+    conn = db.get_conn()
+    conn.executemany(
+        "INSERT INTO usage (user_id, date, data_used_gb) SELECT user_id, ?, ? FROM subscriptions WHERE id = ?",
+        [('2025-01-10', 12.0, closed), (today.isoformat(), 9.0, current)]
+    )
+    # Start over as a database that predates the quota triggers would
+    conn.execute("DELETE FROM quota_usage")
+    conn.execute("DELETE FROM quota_events")
+    conn.execute("DELETE FROM notifications")
+    conn.commit()
+    conn.close()
+
+    result = db.rebuild_quota_usage()
+
+    assert result['corrected'] == 2
+    assert dict(rows("SELECT subscription_id, used_gb FROM quota_usage")) == {closed: 12.0, current: 9.0}
+    assert rows("SELECT subscription_id, threshold FROM quota_events") == [(current, 80)]
+    assert rows("SELECT notification_type FROM notifications") == [('quota_warning',)]
+
+
+def test_engine_picks_the_current_subscription_across_unlimited_plans(db, seed):
+    capped, unlimited = seed.plan(data_limit_gb=10.0), seed.plan(name="Unlimited", data_limit_gb=None, is_unlimited=1)
+    today = date.today()
+    start, end = (today - timedelta(days=5)).isoformat(), (today + timedelta(days=25)).isoformat()
+    asha = seed.user('asha')
+    seed.subscription(asha, capped, start, end)
+    newest = seed.subscription(asha, unlimited, start, end)
+    later = seed.user('meera')
+    seed.subscription(later, capped, start, end)
+    db.exec_query("INSERT INTO usage (user_id, date, data_used_gb) VALUES (?, ?, 12.0)", (later, today.isoformat()))
+
+    # A capped and an unlimited plan over the same period used to break max() over the entries
+    engine = db.QuotaEngine(refresh_seconds=3600)
+    assert engine.refresh() > 0
+    assert engine.status(asha)['subscription_id'] == newest
+    assert engine.is_over_quota(later)
+    assert engine.refresh() == 0
+
+
+def test_plan_changes_keep_usage_that_was_packed(db, seed, rows):
+    capped, bigger = seed.plan(data_limit_gb=10.0), seed.plan(name="Home Plus", data_limit_gb=50.0)
+    today = date.today()
+    user = seed.user('asha')
+    sub = seed.subscription(user, capped, (today - timedelta(days=40)).isoformat(), (today + timedelta(days=20)).isoformat())
+    db.exec_query("INSERT INTO usage (user_id, date, data_used_gb) VALUES (?, ?, 5.0), (?, ?, 1.0)",
+                  (user, (today - timedelta(days=39)).isoformat(), user, today.isoformat()))
+    db.pack_usage()
+    assert rows("SELECT COUNT(*) FROM usage") == [(1,)]
+
+    db.exec_query("UPDATE subscriptions SET plan_id = ? WHERE id = ?", (bigger, sub))
+    assert rows("SELECT limit_gb, used_gb FROM quota_usage") == [(50.0, 6.0)]
+    db.exec_query("UPDATE subscriptions SET status = 'upgraded', end_date = ? WHERE id = ?", (today.isoformat(), sub))
+    assert rows("SELECT used_gb, active FROM quota_usage") == [(6.0, 0)]
+
+
+def test_subscriptions_without_dates_have_no_quota(db, seed, rows):
+    seed.subscription(seed.user('asha'), seed.plan(), None, None)
+    assert rows("SELECT COUNT(*) FROM quota_usage") == [(0,)]
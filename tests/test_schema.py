@@ -0,0 +1,36 @@
+import pytest
+
+
+def test_create_tables_on_fresh_database(db):
+    tables = {r[0] for r in db.exec_query("SELECT name FROM sqlite_master WHERE type = 'table'", fetch=True)}
+    assert {'users', 'plans', 'subscriptions', 'payments', 'notifications', 'admins', 'meta'} <= tables
+    assert db.meta_get(db.DB_MIGRATION_FLAG) == '1'
+    assert db.plan_catalog_version() == 0
+
+
+def test_startup_is_repeatable(db):
+    db.create_tables()
+    db.migrate_database()
+    db.ensure_default_admin()
+    assert db.exec_query("SELECT COUNT(*) FROM admins WHERE username = 'admin'", fetch=True)[0][0] == 1
+    assert db.search_index("anything") == []
+
+
+def test_migration_adds_subscription_columns_to_old_databases(db):
+    conn = db.get_conn()
+    conn.execute("DROP TABLE subscriptions")
+    conn.execute("CREATE TABLE subscriptions (id INTEGER PRIMARY KEY, user_id INTEGER, plan_id INTEGER, "
+                 "start_date TEXT, end_date TEXT, status TEXT, auto_renew INTEGER DEFAULT 0)")
+    conn.execute("DELETE FROM meta WHERE k = ?", (db.DB_MIGRATION_FLAG,))
+    conn.commit()
+    conn.close()
+
+    db.migrate_database()
+    assert db.column_exists('subscriptions', 'created_date')
+    assert db.column_exists('subscriptions', 'renewal_count')
+
+
+def test_benchmarks_require_an_explicit_database(db, monkeypatch):
+    monkeypatch.setattr(db, 'create_tables', lambda: pytest.fail("benchmark touched the default database"))
+    with pytest.raises(SystemExit):
+        db.run_cli(["search", "--benchmark", "10"])
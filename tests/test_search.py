@@ -0,0 +1,31 @@
+def test_fts_query_neutralises_operators_and_quotes(db):
+    assert db._fts_query('asha@example.com') == '"asha example com"*'
+    assert db._fts_query('fibre OR "slow" -NEAR(x) *') == '"fibre"* "OR"* "slow"* "NEAR x"*'
+    assert db._fts_query('  "" -- ') == ''
+
+
+def test_search_survives_operator_input(db, seed):
+    user = seed.user('asha')
+    seed.ticket(user, subject='Router "OR" light blinking', description='AND NOT working')
+    for text in ('"', 'OR', 'router AND', 'NEAR(', 'asha@example.com', "won't"):
+        db.search_index(text)
+    assert [r['kind'] for r in db.search_index('asha@example.com')] == ['user']
+    assert db.search_index('') == []
+
+
+def test_search_index_follows_updates_and_deletes(db, seed):
+    user = seed.user('asha')
+    ticket = seed.ticket(user, subject='Router keeps rebooting', description='Every night')
+    assert [(r['kind'], r['id']) for r in db.search_index('rebooting')] == [('ticket', ticket)]
+
+    db.exec_query("UPDATE support_tickets SET subject = 'Fibre cut outside' WHERE id = ?", (ticket,))
+    assert db.search_index('rebooting') == []
+    assert [r['id'] for r in db.search_index('fibre', kinds=['ticket'])] == [ticket]
+
+    db.exec_query("UPDATE users SET city = 'Nagpur' WHERE id = ?", (user,))
+    assert [(r['kind'], r['id']) for r in db.search_index('nagp')] == [('user', user)]
+
+    db.exec_query("DELETE FROM support_tickets WHERE id = ?", (ticket,))
+    assert db.search_index('fibre') == []
+    assert db.rebuild_search_index()['ticket'] == 0
+    assert db.search_index('fibre') == []
@@ -0,0 +1,87 @@
+import hashlib
+import os
+
+import pytest
+
+
+@pytest.fixture
+def march(db, seed):
+    """Two customers with payments in March 2026: asha paid and got a refund, ravi's payment failed"""
+    plan = seed.plan(name="Home Plus", price=500.0)
+    asha, ravi = seed.user('asha'), seed.user('ravi')
+    subscription = seed.subscription(asha, plan, '2026-03-01', '2026-03-31')
+    seed.payment(asha, 590.0, 'paid', subscription_id=subscription, payment_date='2026-03-01T09:00:00')
+    seed.payment(asha, -100.0, 'refunded', subscription_id=subscription, payment_date='2026-03-15T09:00:00')
+    seed.payment(ravi, 590.0, 'failed', payment_date='2026-03-02T09:00:00')
+    seed.payment(ravi, 590.0, 'paid', payment_date='2026-04-01T09:00:00')
+    return asha, ravi
+
+
+def _stored_files(store):
+    return sorted(os.path.join(d, f) for d, _, files in os.walk(store) for f in files)
+
+
+def test_closed_month_is_served_from_the_store_on_the_second_call(db, march, tmp_path, monkeypatch, rows):
+    asha, _ = march
+    store = str(tmp_path / "statements")
+    first = db.generate_user_statement(asha, '2026-03', 'txt', store_dir=store)
+
+    digest = hashlib.sha256(first).hexdigest()
+    assert rows("SELECT user_id, period, format, content_hash, size_bytes FROM statements") == [
+        (asha, '2026-03', 'txt', digest, len(first))]
+    with open(db.statement_path(digest, 'txt', store), 'rb') as fh:
+        assert fh.read() == first
+    assert b"Home Plus" in first and b"Refunded" in first
+
+    def no_rendering(*args):
+        raise AssertionError("rendered again")
+
+    monkeypatch.setattr(db, "build_statement", no_rendering)
+    assert db.generate_user_statement(asha, '2026-03', 'txt', store_dir=store) == first
+
+
+def test_the_same_month_renders_byte_identical_output(db, march, tmp_path):
+    asha, ravi = march
+    for fmt in db.STATEMENT_FORMATS:
+        for user in (asha, ravi):
+            # A fresh store each time, so both calls render
+            first = db.generate_user_statement(user, '2026-03', fmt, store_dir=str(tmp_path / f"{fmt}-{user}-1"))
+            second = db.generate_user_statement(user, '2026-03', fmt, store_dir=str(tmp_path / f"{fmt}-{user}-2"))
+            assert first == second, (fmt, user)
+    assert db.generate_user_statement(ravi, '2026-02', 'txt', store_dir=str(tmp_path)) is None
+
+
+def test_current_month_is_always_rendered(db, seed, tmp_path, rows):
+    asha = seed.user('asha')
+    seed.payment(asha, 590.0, 'paid')
+    period = db.datetime.utcnow().strftime('%Y-%m')
+    store = str(tmp_path / "statements")
+
+    first = db.generate_user_statement(asha, period, 'txt', store_dir=store)
+    seed.payment(asha, 118.0, 'paid')
+    second = db.generate_user_statement(asha, period, 'txt', store_dir=store)
+
+    assert first != second and b"118.00" in second
+    assert rows("SELECT COUNT(*) FROM statements") == [(0,)]
+    assert _stored_files(store) == []
+
+
+def test_statement_run_stores_identical_statements_once(db, march, tmp_path, rows):
+    asha, ravi = march
+    store = str(tmp_path / "statements")
+    result = db.run_statements('2026-03', workers=1, store_dir=store)
+
+    assert (result['users'], result['statements']) == (2, 6)
+    recorded = rows("SELECT user_id, format, content_hash FROM statements ORDER BY user_id, format")
+    files = _stored_files(store)
+    assert len(files) == 6
+    for user, fmt, digest in recorded:
+        # The pool's output is what an on-demand download of the month renders
+        fresh = db.generate_user_statement(user, '2026-03', fmt, store_dir=str(tmp_path / "fresh"))
+        with open(db.statement_path(digest, fmt, store), 'rb') as fh:
+            assert fh.read() == fresh, (user, fmt)
+
+    again = db.run_statements('2026-03', workers=2, chunk_users=1, store_dir=store)
+    assert again['statements'] == 6
+    assert rows("SELECT user_id, format, content_hash FROM statements ORDER BY user_id, format") == recorded
+    assert _stored_files(store) == files
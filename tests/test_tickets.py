@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def test_ticket_pages_reach_undated_tickets(db, seed):
+    user = seed.user('asha')
+    dated = [seed.ticket(user, created_date=f"2026-0{i + 1}-01T10:00:00") for i in range(3)]
+    undated = [seed.ticket(user) for _ in range(3)]
+    db.exec_query("UPDATE support_tickets SET created_date = NULL WHERE id IN (?, ?, ?)", tuple(undated))
+    seed.ticket(user, status='resolved')
+
+    seen, before = [], None
+    while True:
+        page = db.get_tickets_page('ongoing', before=before, limit=2)
+        if page.empty:
+            break
+        seen += page['id'].tolist()
+        before = (page['sort_key'].iloc[-1], int(page['id'].iloc[-1]))
+    assert seen == dated[::-1] + undated[::-1]
+
+
+def test_leased_tickets_go_to_one_agent_in_priority_order(db, seed):
+    user = seed.user('asha')
+    low = seed.ticket(user, priority='low')
+    urgent = seed.ticket(user, priority='urgent')
+
+    assert db.claim_next_ticket('agent-a')['ticket_id'] == urgent
+    assert db.claim_next_ticket('agent-b')['ticket_id'] == low
+    assert db.claim_next_ticket('agent-c') is None
+    assert db.get_ticket_queue_stats()['claimed'] == 2
+
+
+def test_expired_lease_is_reclaimed_and_blocks_the_old_agent(db, seed, rows):
+    ticket = seed.ticket(seed.user('asha'))
+    db.claim_next_ticket('agent-a', now=db.utcnow_naive() - timedelta(hours=2))
+
+    reclaimed = db.claim_next_ticket('agent-b')
+    assert (reclaimed['ticket_id'], reclaimed['claims']) == (ticket, 2)
+    assert db.complete_ticket(ticket, 'agent-a')[0] is False
+    assert db.renew_ticket_lease(ticket, 'agent-a') is False
+
+    assert db.complete_ticket(ticket, 'agent-b')[0] is True
+    assert rows("SELECT status, status_class FROM support_tickets") == [('resolved', 'resolved')]
+    assert rows("SELECT COUNT(*) FROM ticket_queue") == [(0,)]
+
+
+def test_completion_is_refused_after_the_lease_expires(db, seed, rows):
+    ticket = seed.ticket(seed.user('asha'))
+    db.claim_next_ticket('agent-a', now=db.utcnow_naive() - timedelta(hours=2))
+
+    ok, message = db.complete_ticket(ticket, 'agent-a')
+    assert not ok and "expired" in message
+    assert rows("SELECT status FROM support_tickets") == [('open',)]
+
+
+def test_ticket_counts_match_a_recount(db, seed, rows):
+    user = seed.user('asha')
+    ids = [seed.ticket(user, status=status, category=category) for status, category in (
+        ('open', 'technical'), ('Resolved ', 'billing'), ('closed', None), ("Won't Fix", 'technical'),
+        ('in_progress', 'billing'), ('escalated', 'technical'))]
+    db.exec_query("UPDATE support_tickets SET status = 'resolved' WHERE id = ?", (ids[0],))
+    db.exec_query("UPDATE support_tickets SET category = 'billing' WHERE id = ?", (ids[3],))
+    db.exec_query("UPDATE support_tickets SET status = 'open', category = NULL WHERE id = ?", (ids[1],))
+    db.exec_query("DELETE FROM support_tickets WHERE id = ?", (ids[4],))
+
+    recount = """
+        SELECT 'status', LOWER(TRIM(COALESCE(status, ''))), COUNT(*) FROM support_tickets GROUP BY 2
+        UNION ALL
+        SELECT 'category', COALESCE(category, ''), COUNT(*) FROM support_tickets GROUP BY 2
+        ORDER BY 1, 2
+    """
+    maintained = "SELECT dimension, value, count FROM support_ticket_counts WHERE count > 0 ORDER BY 1, 2"
+    assert rows(maintained) == rows(recount)
+    for status, status_class in rows("SELECT status, status_class FROM support_tickets"):
+        assert status_class == db.ticket_status_class(status)
+    assert db.get_ticket_counts()['class'] == {'resolved': 1, 'not_resolved': 2, 'ongoing': 2}
+
+    db.rebuild_ticket_counts()
+    assert rows(maintained) == rows(recount)
+
+
+def _resolved(db, seed, user, hours, created=datetime(2026, 1, 1, 9, 0), category='technical'):
+    ticket = seed.ticket(user, status='resolved', category=category, created_date=created.isoformat())
+    db.exec_query("UPDATE support_tickets SET resolved_date = ? WHERE id = ?",
+                  ((created + timedelta(hours=hours)).isoformat(), ticket))
+    return ticket
+
+
+def test_sla_refresh_folds_from_the_watermark(db, seed, rows):
+    user = seed.user('asha')
+    for hours in (1, 2, 4, 4, 2000):
+        _resolved(db, seed, user, hours)
+    seed.ticket(user, created_date=(db.utcnow_naive() - timedelta(days=2)).isoformat())
+
+    assert db.refresh_ticket_sla()['tickets_folded'] == 5
+    assert db.refresh_ticket_sla()['tickets_folded'] == 0
+    # Bucket k covers [SLA_BUCKET_EDGES[k-1], SLA_BUCKET_EDGES[k]); 2000 hours is past the last edge
+    assert rows("SELECT bucket, count FROM ticket_sla_rollup WHERE dimension = 'all' ORDER BY bucket") == [
+        (9, 1), (13, 1), (17, 2), (49, 1)]
+    assert db.get_backlog_ages()['open_tickets'].tolist() == [0, 1, 0, 0, 0, 0]
+
+    # Resolved after the watermark (the 2000-hour ticket), so the next refresh picks it up
+    _resolved(db, seed, user, 1, created=datetime(2026, 6, 1, 9, 0), category='billing')
+    assert db.refresh_ticket_sla()['tickets_folded'] == 1
+    incremental = rows("SELECT dimension, value, bucket, count FROM ticket_sla_rollup ORDER BY 1, 2, 3")
+    assert db.refresh_ticket_sla(full=True)['tickets_folded'] == 6
+    assert rows("SELECT dimension, value, bucket, count FROM ticket_sla_rollup ORDER BY 1, 2, 3") == incremental
+
+
+def test_histogram_percentiles_interpolate_inside_buckets(db):
+    edges = db.SLA_BUCKET_EDGES
+    buckets, counts = [9, 13, 17, 49], [1, 1, 2, 1]
+    # p50 is half a ticket into the two-ticket bucket [edges[16], edges[17])
+    assert db._histogram_percentile(buckets, counts, 50) == pytest.approx(edges[16] + (edges[17] - edges[16]) * 0.25)
+    assert db._histogram_percentile(buckets, counts, 20) == pytest.approx(edges[9])
+    # The overflow bucket has no upper edge, so it reports the last edge
+    assert db._histogram_percentile(buckets, counts, 99) == pytest.approx(edges[-1])
+    assert db._histogram_percentile([0], [4], 50) == pytest.approx(edges[0] / 2)
@@ -0,0 +1,132 @@
+import http.client
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def ingest_server(db):
+    server = db.http.server.ThreadingHTTPServer(('127.0.0.1', 0), db._UsageIngestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def _post(port, body, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.putrequest('POST', '/usage')
+        for name, value in (headers or {'Content-Length': str(len(body))}).items():
+            conn.putheader(name, value)
+        conn.endheaders(body)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def test_duplicate_usage_days_are_merged_not_dropped(db, seed, capsys, rows):
+    user = seed.user('asha')
+    conn = db.get_conn()
+    conn.execute("DROP INDEX idx_usage_user_date")
+    conn.executemany(
+        "INSERT INTO usage (user_id, date, data_used_gb, peak_hour_usage, off_peak_usage, upload_usage, average_speed, session_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(user, '2026-01-05', 2.0, 1.0, 1.0, 0.2, 40.0, 800.0),
+         (user, '2026-01-05', 3.0, 2.0, 1.0, 0.3, 60.0, 400.0),
+         (user, '2026-01-06', 1.5, 1.0, 0.5, 0.1, 30.0, 400.0)]
+    )
+    conn.execute("DELETE FROM meta WHERE k = ?", (db.DB_MIGRATION_FLAG,))
+    conn.commit()
+    conn.close()
+
+    db.create_tables()
+    db.migrate_database()
+
+    assert rows("SELECT date, data_used_gb, peak_hour_usage, upload_usage, average_speed, session_seconds FROM usage ORDER BY date") == [
+        ('2026-01-05', 5.0, 3.0, 0.5, 5.0 * 8000 / 1200, 1200.0),
+        ('2026-01-06', 1.5, 1.0, 0.1, 30.0, 400.0)]
+    assert rows("SELECT COUNT(*) FROM sqlite_master WHERE name = 'idx_usage_user_date'") == [(1,)]
+    assert "Merged 1 duplicate usage rows" in capsys.readouterr().out
+
+    # A later startup leaves the (now unique) usage alone
+    db.create_tables()
+    assert rows("SELECT COUNT(*) FROM usage") == [(2,)]
+
+
+def test_pack_usage_keeps_rows_it_cannot_pack(db, seed, rows):
+    user = seed.user('asha')
+    conn = db.get_conn()
+    conn.executemany(
+        "INSERT INTO usage (user_id, date, data_used_gb, peak_hour_usage, off_peak_usage, upload_usage, average_speed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(user, '2026-01-05', 2.0, 1.0, 1.0, 0.2, 40.0),
+         (user, '2026-01-06', 3.0, 2.0, 1.0, 0.3, 60.0),
+         (user, '2026-01-3x', 9.0, 5.0, 4.0, 1.0, 50.0)]
+    )
+    conn.commit()
+    conn.close()
+
+    result = db.pack_usage(before='2026-02-01')
+
+    assert (result['rows_packed'], result['rows_skipped'], result['months_written']) == (2, 1, 1)
+    assert rows("SELECT date, data_used_gb FROM usage") == [('2026-01-3x', 9.0)]
+    assert rows("SELECT month, days_present, total_gb FROM usage_packed") == [('2026-01', 2, 5.0)]
+
+
+def test_ingest_endpoint_status_codes(db, seed, ingest_server, monkeypatch, rows):
+    user = seed.user('asha')
+    start = int(datetime(2026, 1, 5, 20).timestamp())
+    record = json.dumps({'user_id': user, 'start': start, 'end': start + 3600,
+                         'bytes_down': 2 * 10**9, 'bytes_up': 10**8}).encode()
+
+    assert _post(ingest_server, record)[0] == 200
+    assert rows("SELECT COUNT(*) FROM usage") == [(1,)]
+    assert _post(ingest_server, b"not json")[0] == 400
+    assert _post(ingest_server, record, {'Content-Length': 'abc'})[0] == 400
+
+    def locked(records):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(db, "ingest_usage_records", locked)
+    status, payload = _post(ingest_server, record)
+    assert (status, payload['retry']) == (503, True)
+
+
+def _session(user, start, gb):
+    begin = datetime.fromisoformat(start)
+    return {'user_id': user, 'start': start, 'end': (begin + timedelta(minutes=30)).isoformat(),
+            'bytes_down': int(gb * 1e9), 'bytes_up': 0}
+
+
+def test_hourly_usage_matches_the_daily_peak_split(db, seed, rows):
+    user = seed.user('asha')
+    # 2026-01-05 is a Monday; peak hours are USAGE_PEAK_HOURS (08:00-23:00)
+    db.ingest_usage_records([_session(user, '2026-01-05T20:00:00', 2.0), _session(user, '2026-01-05T03:00:00', 1.0)])
+    db.ingest_usage_records([_session(user, '2026-01-05T20:10:00', 0.5), _session(user, '2026-01-06T23:30:00', 0.25)])
+
+    hourly = db.get_hourly_peak_split(user).sort_values('date').reset_index(drop=True)
+    assert hourly.round(6).values.tolist() == [['2026-01-05', 2.5, 1.0], ['2026-01-06', 0.0, 0.25]]
+    daily = rows("SELECT date, peak_hour_usage, off_peak_usage FROM usage WHERE user_id = ? ORDER BY date", user)
+    assert [(d, round(p, 6), round(o, 6)) for d, p, o in daily] == [tuple(r) for r in hourly.round(6).values.tolist()]
+
+
+def test_city_heatmap_averages_user_days_per_weekday_and_hour(db, seed):
+    asha, ravi, other = seed.user('asha'), seed.user('ravi'), seed.user('meera')
+    db.exec_query("UPDATE users SET city = CASE id WHEN ? THEN 'Pune' ELSE 'Indore' END", (other,))
+    db.ingest_usage_records([
+        _session(asha, '2026-01-05T20:00:00', 2.0),
+        _session(ravi, '2026-01-05T20:00:00', 1.0),
+        _session(ravi, '2026-01-12T09:00:00', 3.0),
+        _session(other, '2026-01-05T20:00:00', 100.0),
+    ])
+
+    heat = db.get_usage_heatmap(city='Indore', start='2026-01-01', end='2026-01-31')
+    assert heat.shape == (7, 24)
+    # Three Indore user-days fall on Mondays: (2 + 1 + 0) / 3 at 20:00 and 3 / 3 at 09:00
+    assert heat.loc['Mon', 20] == pytest.approx(1.0) and heat.loc['Mon', 9] == pytest.approx(1.0)
+    assert heat.loc['Mon'].sum() == pytest.approx(2.0)
+    assert heat.drop(index='Mon').isna().all().all()
+    assert db.get_usage_heatmap(user_id=other).loc['Mon', 20] == pytest.approx(100.0)
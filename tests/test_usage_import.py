@@ -0,0 +1,62 @@
+import gzip
+from datetime import date, timedelta
+
+import pytest
+
+
+def _write_export(path, user, days, compress=False):
+    start = date.today() - timedelta(days=days - 1)
+    lines = ["user_id,date,data_used_gb,peak_hour_usage,off_peak_usage,upload_usage,average_speed"]
+    lines += [f"{user},{start + timedelta(days=i)},{1 + i / 10:.1f},0.5,0.5,0.1,50" for i in range(days)]
+    data = ("\n".join(lines) + "\n").encode()
+    if compress:
+        path = path.with_suffix(".csv.gz")
+        with gzip.open(path, 'wb') as fh:
+            fh.write(data)
+    else:
+        path.write_bytes(data)
+    return str(path), data
+
+
+def test_import_counts_usage_rows_not_trigger_writes(db, seed, tmp_path, rows):
+    user = seed.user('asha')
+    seed.subscription(user, seed.plan(), (date.today() - timedelta(days=20)).isoformat(),
+                      (date.today() + timedelta(days=10)).isoformat())
+    path, _ = _write_export(tmp_path / "usage.csv", user, 10)
+
+    result = db.import_usage_file(path)
+    assert (result['rows_inserted'], result['duplicates_skipped']) == (10, 0)
+    assert rows("SELECT used_gb FROM quota_usage") == [(14.5,)]
+
+    again = db.import_usage_file(path, restart=True)
+    assert (again['rows_inserted'], again['duplicates_skipped']) == (0, 10)
+
+
+def test_import_resumes_after_the_last_committed_chunk(db, seed, tmp_path, rows):
+    user = seed.user('asha')
+    path, _ = _write_export(tmp_path / "usage.csv", user, 40)
+
+    def interrupt(offset, size):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        db.import_usage_file(path, chunk_mb=256 / 1024 / 1024, progress=interrupt)
+    first = rows("SELECT COUNT(*) FROM usage")[0][0]
+    assert 0 < first < 40
+
+    result = db.import_usage_file(path, chunk_mb=256 / 1024 / 1024)
+    assert result['start_offset'] > 0
+    assert (result['rows_read'], result['rows_inserted']) == (40 - first, 40 - first)
+    assert rows("SELECT COUNT(*) FROM usage") == [(40,)]
+
+
+@pytest.mark.parametrize("compress,use_mmap", [(False, False), (False, True), (True, False)])
+def test_line_chunks_split_only_at_line_ends(db, tmp_path, compress, use_mmap):
+    path, data = _write_export(tmp_path / "usage.csv", 1, 30, compress)
+    header = data.index(b"\n") + 1
+
+    chunks = list(db._iter_line_chunks(path, header, 100, use_mmap))
+    assert len(chunks) > 1
+    assert b"".join(c for c, _ in chunks) == data[header:]
+    assert all(c.endswith(b"\n") for c, _ in chunks)
+    assert [end for _, end in chunks] == [header + sum(len(c) for c, _ in chunks[:i + 1]) for i in range(len(chunks))]
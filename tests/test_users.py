@@ -0,0 +1,78 @@
+import csv
+import io
+
+import pytest
+
+
+def _walk(db, **kwargs):
+    seen, after = [], None
+    while True:
+        page = db.get_users_page(after=after, limit=2, **kwargs)
+        if page.empty:
+            return seen
+        seen += page['id'].tolist()
+        # tolist() gives Python values, as the grid's Next button does; numpy ints would bind as blobs
+        after = (page['sort_key'].tolist()[-1], int(page['id'].iloc[-1]))
+
+
+@pytest.fixture
+def users(db, seed):
+    ids = [seed.user(f"user{i}") for i in range(7)]
+    profiles = [('Asha', 'Pune', '2026-01-05'), ('Asha', None, '2026-01-05'), (None, 'Pune', None),
+                ('Ravi', 'Indore', '2026-02-01T10:00:00'), ('Asha', 'Pune', '2026-01-31T23:59:00'),
+                (None, None, '2026-02-01'), ('Ravi', 'Indore', '2025-12-31')]
+    for uid, (name, city, signup) in zip(ids, profiles):
+        db.exec_query("UPDATE users SET name = ?, city = ?, signup_date = ? WHERE id = ?", (name, city, signup, uid))
+    return ids
+
+
+@pytest.mark.parametrize("sort", ['Newest', 'Name', 'City', 'Signup date'])
+def test_user_pages_cover_every_user_once_across_ties(db, users, rows, sort):
+    key, descending = db.USER_GRID_SORTS[sort]
+    expected = [r[0] for r in rows(
+        f"SELECT u.id FROM users u ORDER BY {key} {'DESC' if descending else 'ASC'}, u.id {'DESC' if descending else 'ASC'}")]
+    assert _walk(db, sort=sort) == expected
+    assert sorted(expected) == sorted(users)
+
+
+def test_user_page_filters(db, seed, users):
+    plan = seed.plan()
+    seed.subscription(users[0], plan, '2026-01-01', '2026-01-31')
+    seed.subscription(users[3], plan, '2026-01-01', '2026-01-31', status='cancelled')
+
+    assert _walk(db, sort='Name', filters={'active': True}) == [users[0]]
+    assert set(_walk(db, sort='Name', filters={'active': False})) == set(users) - {users[0]}
+    # signup_to is inclusive of the whole day, whatever the time of signup
+    january = _walk(db, sort='Signup date', filters={'signup_from': '2026-01-01', 'signup_to': '2026-01-31'})
+    assert january == [users[4], users[1], users[0]]
+    assert _walk(db, sort='City', filters={'city': 'Pune', 'signup_from': '2026-01-05'}) == [users[0], users[4]]
+
+
+def test_user_import_reports_rejected_rows_by_line(db, seed, rows):
+    seed.user('asha')
+    source = io.StringIO(
+        "username,password,email\n"
+        "asha,pw,asha@example.com\n"      # line 2: already in the database
+        "bob,pw,bob@example.com\n"
+        "x,pw,\n"                         # line 4: invalid username
+        "carol,,carol@example.com\n"      # line 5: missing password
+        "bob,pw2,\n"                      # line 6: imported by the previous chunk
+        "dave,pw,dave-at-example.com\n"   # line 7: invalid email
+        "erin,pw,\n"
+        "erin,pw,\n"                      # line 9: duplicate within its chunk
+    )
+    report = io.StringIO()
+    result = db.import_users_csv(source, chunk_rows=3, workers=1, error_report=report)
+
+    assert (result['rows_read'], result['users_created'], result['rows_rejected']) == (8, 2, 6)
+    assert list(csv.reader(io.StringIO(report.getvalue())))[1:] == [
+        ['2', 'asha', 'username already exists'],
+        ['4', 'x', 'invalid username (3-64 letters, digits or _.@+-)'],
+        ['5', 'carol', 'missing password'],
+        ['6', 'bob', 'username already exists'],
+        ['7', 'dave', 'invalid email'],
+        ['9', 'erin', 'duplicate username in file'],
+    ]
+    assert rows("SELECT username, email, role FROM users WHERE username IN ('bob', 'erin') ORDER BY id") == [
+        ('bob', 'bob@example.com', 'user'), ('erin', '', 'user')]
+    assert db.verify_password('pw', rows("SELECT password_hash FROM users WHERE username = 'bob'")[0][0])